@@ -0,0 +1,96 @@
+import collections
+import threading
+import time
+
+
+##########################################################
+## VERIFIED TOKEN CACHE
+##########################################################
+
+##
+## Bounded LRU map from a raw JWT to its decoded claims.
+##
+## Entries are only served until the token's "exp" claim, so a cached token
+## never outlives the signature check it replaced.
+##
+class TokenCache:
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self._entries = collections.OrderedDict()  # token -> claims
+        self._lock = threading.Lock()
+        self._counters = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    def get(self, token, now=None):
+        now = time.time() if now is None else now
+
+        with self._lock:
+            claims = self._entries.get(token)
+            if claims is None:
+                self._counters['misses'] += 1
+                return None
+
+            if claims['exp'] <= now:
+                del self._entries[token]
+                self._counters['misses'] += 1
+                return None
+
+            self._entries.move_to_end(token)
+            self._counters['hits'] += 1
+            return claims
+
+    def put(self, token, claims):
+        if self.max_size <= 0:
+            return
+
+        with self._lock:
+            self._entries[token] = claims
+            self._entries.move_to_end(token)
+
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self._counters['evictions'] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._entries), 'max_size': self.max_size, **self._counters}
+
+
+##########################################################
+## REVOKED TOKENS
+##########################################################
+
+##
+## Set of revoked token ids ("jti" claim) with their expiration time.
+##
+## Ids are dropped once the token would have expired anyway, which keeps
+## the set as small as the number of live revoked tokens.
+##
+class RevocationList:
+    def __init__(self):
+        self._revoked = {}  # jti -> exp
+        self._lock = threading.Lock()
+        self.last_sync = 0.0
+
+    def __contains__(self, jti):
+        return jti in self._revoked
+
+    def __len__(self):
+        return len(self._revoked)
+
+    def revoke(self, jti, exp):
+        with self._lock:
+            self._revoked[jti] = exp
+
+    def merge(self, entries, now=None):
+        now = time.time() if now is None else now
+
+        with self._lock:
+            for jti, exp in entries:
+                self._revoked[jti] = exp
+
+            for jti in [jti for jti, exp in self._revoked.items() if exp <= now]:
+                del self._revoked[jti]
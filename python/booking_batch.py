@@ -0,0 +1,319 @@
+from calendar_index import DayIntervals, describe_resource
+from dataclasses import dataclass, field
+from datetime import date, datetime, timedelta
+from staffing import assign_nurse_roles, validate_nurse_teams
+from transactions import RETRYABLE_ERRORS, lock_booking_days
+import calendar
+import psycopg2
+
+APPOINTMENT_DURATION = 30  # Minutes, the app_duration default
+
+APPOINTMENT_FIELDS = ['patient_id', 'doctor_id', 'date', 'hour', 'minutes', 'type', 'room', 'nurses']
+
+
+##########################################################
+## BATCH APPOINTMENTS
+##########################################################
+
+@dataclass
+class BatchAppointment:
+    index: int  # Position in the request
+    patient_id: int
+    doctor_id: int
+    date: date
+    hour: int
+    minutes: int
+    app_type: str
+    room: int
+    nurses: list
+    nurse_ids: list = field(default_factory=list)  # Set by the nurse validation
+    role_ids: list = field(default_factory=list)
+
+    @property
+    def start(self):
+        return self.hour * 60 + self.minutes
+
+    @property
+    def resources(self):
+        nurse_ids = [int(nurse[0]) for nurse in self.nurses if isinstance(nurse, list) and nurse and str(nurse[0]).isdigit()]
+        return [(0, self.doctor_id), (1, self.room)] + [(2, nurse_id) for nurse_id in nurse_ids]
+
+##
+## Parse one appointment of a batch, returns (BatchAppointment, None) or (None, error).
+## The ranges are the ones enforced by the validate_appointment trigger.
+##
+def parse_appointment(index, item):
+    if not isinstance(item, dict):
+        return None, 'Invalid appointment, expected an object'
+
+    for field_name in APPOINTMENT_FIELDS:
+        if field_name not in item:
+            return None, f'{field_name} value not in appointment'
+
+    try:
+        app_date = datetime.strptime(str(item['date']), '%Y-%m-%d').date()
+    except ValueError:
+        return None, f'Invalid date format: {item["date"]}'
+
+    try:
+        appointment = BatchAppointment(
+            index, int(item['patient_id']), int(item['doctor_id']), app_date, int(item['hour']), int(item['minutes']),
+            str(item['type']), int(item['room']), item['nurses']
+        )
+    except (TypeError, ValueError):
+        return None, 'patient_id, doctor_id, hour, minutes and room must be integers'
+
+    if app_date < date.today():
+        return None, 'The appointment date must be in the future'
+    if not 8 <= appointment.hour <= 20 or not 0 <= appointment.minutes <= 59:
+        return None, 'The appointment must start between 8:00 and 20:59'
+    if not 0 <= appointment.room <= 30:
+        return None, 'The appointment room must be between 0 and 30'
+    if not isinstance(appointment.nurses, list) or appointment.nurses == []:
+        return None, 'nurses values is empty'
+
+    return appointment, None
+
+##
+## Appointments of the batch that overlap an earlier one on the same doctor, room or nurse:
+## {index: error}. The earlier appointment keeps the slot.
+##
+def find_batch_conflicts(appointments):
+    days = {}  # (resource_type, resource_id, date) -> DayIntervals
+    conflicts = {}
+
+    for appointment in appointments:
+        start, end = appointment.start, appointment.start + APPOINTMENT_DURATION
+        resources = appointment.resources
+
+        conflict = None
+        for resource in resources:
+            intervals = days.get((*resource, appointment.date))
+            if intervals is not None and intervals.overlaps(start, end):
+                conflict = resource
+                break
+
+        if conflict is not None:
+            conflicts[appointment.index] = f'{describe_resource(conflict)} is already booked at this time by another appointment of the batch!'
+            continue
+
+        for resource in resources:
+            days.setdefault((*resource, appointment.date), DayIntervals()).add(appointment.index, start, end)
+
+    return conflicts
+
+##
+## Validate and insert a batch of appointments in the current transaction.
+##
+## The resources of the whole batch are locked first, then every appointment is checked
+## with one query for the doctors, one for the patients, rooms and doctors availability
+## and one for the nurses. The valid appointments are inserted with one statement per
+## table, as occurrences of "series_id" when given. Returns ({index: appointment_id}, {index: error}).
+##
+## With best_effort the valid appointments are inserted even if others are refused, an
+## appointment rejected by the database itself only loses its own place (one savepoint each).
+## Otherwise nothing is inserted as soon as one appointment is refused.
+##
+def book_appointments(cur, appointments, reference_data, best_effort, series_id=None):
+    errors = {}
+
+    lock_booking_days(cur, {(*resource, appointment.date) for appointment in appointments for resource in appointment.resources})
+
+    # Doctors: exist, take this type of appointment and have a valid license on that date
+    doctors = reference_data.doctors([appointment.doctor_id for appointment in appointments], cur)
+    for appointment in appointments:
+        doctor = doctors.get(appointment.doctor_id)
+        if doctor is None or not doctor.can_perform('appointment', appointment.app_type):
+            errors[appointment.index] = 'Doctor does not exist or the type of appointment does not correspond to the doctor specialisation!'
+        elif not doctor.is_licensed(appointment.date):
+            errors[appointment.index] = f'Doctor {appointment.doctor_id} does not have a valid medical license on {appointment.date}!'
+
+    # Patients, doctors and rooms
+    statement = """
+        SELECT a.position,
+               EXISTS (SELECT 1 FROM patients AS p WHERE p.person_id = a.patient_id),
+               is_resource_available(0, a.doctor_id, booking_period(a.app_date, a.app_hour, a.app_minutes, %s)),
+               is_resource_available(1, a.room, booking_period(a.app_date, a.app_hour, a.app_minutes, %s))
+        FROM unnest(%s::INTEGER[], %s::INTEGER[], %s::BIGINT[], %s::DATE[], %s::INTEGER[], %s::INTEGER[])
+             WITH ORDINALITY AS a(patient_id, doctor_id, room, app_date, app_hour, app_minutes, position)
+        ORDER BY a.position;
+    """
+    values = (
+        APPOINTMENT_DURATION, APPOINTMENT_DURATION,
+        [appointment.patient_id for appointment in appointments], [appointment.doctor_id for appointment in appointments],
+        [appointment.room for appointment in appointments], [appointment.date for appointment in appointments],
+        [appointment.hour for appointment in appointments], [appointment.minutes for appointment in appointments]
+    )
+    cur.execute(statement, values)
+
+    for position, patient_exists, doctor_available, room_available in cur.fetchall():
+        appointment = appointments[position - 1]
+        if appointment.index in errors:
+            continue
+
+        if not patient_exists:
+            errors[appointment.index] = f'Patient {appointment.patient_id} does not exist!'
+        elif not doctor_available:
+            errors[appointment.index] = 'Doctor is already booked at this time!'
+        elif not room_available:
+            errors[appointment.index] = 'Room is already booked at this time!'
+
+    # Nurses
+    teams = validate_nurse_teams(
+        cur, [(appointment.date, appointment.hour, appointment.minutes, appointment.nurses) for appointment in appointments],
+        'CONSULTAS', 0, APPOINTMENT_DURATION
+    )
+    for appointment, (nurse_ids, role_ids, nurse_errors) in zip(appointments, teams):
+        appointment.nurse_ids, appointment.role_ids = nurse_ids, role_ids
+        if nurse_errors and appointment.index not in errors:
+            errors[appointment.index] = nurse_errors
+
+    valid = [appointment for appointment in appointments if appointment.index not in errors]
+    if not valid or (errors and not best_effort):
+        return {}, errors
+
+    if not best_effort:
+        return insert_appointments(cur, valid, series_id), errors
+
+    cur.execute('SAVEPOINT batch;')
+    try:
+        appointment_ids = insert_appointments(cur, valid, series_id)
+        cur.execute('RELEASE SAVEPOINT batch;')
+        return appointment_ids, errors
+
+    except RETRYABLE_ERRORS:
+        raise
+
+    except psycopg2.DatabaseError:
+        cur.execute('ROLLBACK TO SAVEPOINT batch;')
+
+    # An appointment was rejected by a trigger, find which one
+    appointment_ids = {}
+    for appointment in valid:
+        cur.execute('SAVEPOINT batch_appointment;')
+        try:
+            appointment_ids.update(insert_appointments(cur, [appointment], series_id))
+            cur.execute('RELEASE SAVEPOINT batch_appointment;')
+
+        except RETRYABLE_ERRORS:
+            raise
+
+        except psycopg2.DatabaseError as error:
+            cur.execute('ROLLBACK TO SAVEPOINT batch_appointment;')
+            errors[appointment.index] = str(error).split('\n')[0]
+
+    return appointment_ids, errors
+
+##
+## Insert validated appointments, their bills and their nurses: {index: appointment_id}
+##
+def insert_appointments(cur, appointments, series_id=None):
+    nurse_roles = {}
+    for appointment in appointments:
+        for nurse_id, role_id in zip(appointment.nurse_ids, appointment.role_ids):
+            nurse_roles.setdefault(nurse_id, role_id)
+
+    assign_nurse_roles(cur, list(nurse_roles), list(nurse_roles.values()))
+
+    # One bill per appointment for its patient, the create_bill_before_appointment trigger is skipped
+    statement = """
+        SELECT bill_position, bill_id FROM create_appointment_bills(%s::INTEGER[]);
+    """
+    values = ([appointment.patient_id for appointment in appointments], )
+    cur.execute(statement, values)
+
+    # Positions are 1-based indexes of the appointments
+    bill_ids = [None] * len(appointments)
+    for position, bill_id in cur.fetchall():
+        bill_ids[position - 1] = bill_id
+
+    statement = """
+        INSERT INTO appointments (doctor_id, patient_id, app_date, app_hour, app_minutes, app_type, app_room, app_status, bill_id, series_id)
+        SELECT a.doctor_id, a.patient_id, a.app_date, a.app_hour, a.app_minutes, a.app_type, a.app_room, 0, a.bill_id, %s
+        FROM unnest(%s::INTEGER[], %s::INTEGER[], %s::DATE[], %s::INTEGER[], %s::INTEGER[], %s::VARCHAR[], %s::BIGINT[], %s::BIGINT[])
+             AS a(doctor_id, patient_id, app_date, app_hour, app_minutes, app_type, app_room, bill_id)
+        RETURNING appointment_id, bill_id;
+    """
+    values = (
+        series_id,
+        [appointment.doctor_id for appointment in appointments], [appointment.patient_id for appointment in appointments],
+        [appointment.date for appointment in appointments], [appointment.hour for appointment in appointments],
+        [appointment.minutes for appointment in appointments], [appointment.app_type for appointment in appointments],
+        [appointment.room for appointment in appointments], bill_ids
+    )
+    cur.execute(statement, values)
+
+    # Each appointment is matched through its bill, RETURNING does not keep the input order
+    by_bill = dict(zip(bill_ids, appointments))
+    appointment_ids = {by_bill[bill_id].index: appointment_id for appointment_id, bill_id in cur.fetchall()}
+
+    rows = [
+        (appointment_ids[appointment.index], appointment.doctor_id, appointment.patient_id, nurse_id, role_id)
+        for appointment in appointments
+        for nurse_id, role_id in zip(appointment.nurse_ids, appointment.role_ids)
+    ]
+
+    statement = """
+        INSERT INTO roles_appointments (app_id, doctor_id, patient_id, nurse_id, role_id)
+        SELECT * FROM unnest(%s::BIGINT[], %s::INTEGER[], %s::INTEGER[], %s::INTEGER[], %s::BIGINT[]);
+    """
+    values = tuple(list(column) for column in zip(*rows))
+    cur.execute(statement, values)
+
+    return appointment_ids
+
+
+##########################################################
+## APPOINTMENT SERIES
+##########################################################
+
+SERIES_FREQUENCIES = ('weekly', 'monthly')
+
+@dataclass(frozen=True)
+class Recurrence:
+    frequency: str  # weekly or monthly
+    interval: int  # Weeks or months between occurrences
+    count: int  # Number of occurrences
+
+    #
+    # Dates of the occurrences, a monthly series keeps the day of the first date or the last day of shorter months
+    #
+    def dates(self, first_date):
+        dates = []
+        for occurrence in range(self.count):
+            if self.frequency == 'weekly':
+                dates.append(first_date + timedelta(weeks=occurrence * self.interval))
+                continue
+
+            months = first_date.month - 1 + occurrence * self.interval
+            year, month = first_date.year + months // 12, months % 12 + 1
+            dates.append(date(year, month, min(first_date.day, calendar.monthrange(year, month)[1])))
+
+        return dates
+
+##
+## Insert a series and book its occurrences with book_appointments, in the current transaction.
+## With skip_conflicts the occurrences that cannot be booked are left out of the series,
+## otherwise nothing is booked. The series records the occurrences actually booked.
+## Returns (series_id, {index: appointment_id}, {index: error}).
+##
+def book_series(cur, appointments, reference_data, recurrence, first_date, skip_conflicts):
+    statement = """
+        INSERT INTO appointment_series (patient_id, doctor_id, frequency, repeat_interval, occurrences, first_date)
+            VALUES (%s, %s, %s, %s, %s, %s) RETURNING series_id;
+    """
+    values = (
+        appointments[0].patient_id, appointments[0].doctor_id, recurrence.frequency, recurrence.interval, len(appointments),
+        first_date
+    )
+    cur.execute(statement, values)
+
+    series_id = cur.fetchone()[0]
+
+    appointment_ids, errors = book_appointments(cur, appointments, reference_data, skip_conflicts, series_id)
+
+    # Occurrences skipped by a conflict found while booking
+    if appointment_ids and len(appointment_ids) != len(appointments):
+        cur.execute('UPDATE appointment_series SET occurrences = %s WHERE series_id = %s;', (len(appointment_ids), series_id))
+
+    return series_id, appointment_ids, errors
@@ -0,0 +1,163 @@
+from array import array
+import bisect
+import datetime
+import json
+import threading
+
+RESOURCE_NAMES = ('Doctor', 'Room', 'Nurse')  # bookings.resource_type 0, 1, 2
+
+BOOKINGS_CHANNEL = 'bookings'  # pg_notify() channel of the notify_bookings trigger
+
+
+#
+# "Doctor 10", "Room 2", "Nurse 12" for a (resource_type, resource_id) pair
+#
+def describe_resource(resource):
+    resource_type, resource_id = resource
+    return f'{RESOURCE_NAMES[resource_type]} {resource_id}'
+
+
+##########################################################
+## BOOKING CALENDAR
+##########################################################
+
+##
+## Bookings of one resource on one day, sorted by start.
+## Times are minutes since midnight, the exclusion constraint on bookings
+## guarantees the intervals never overlap, so the ends are sorted as well.
+##
+class DayIntervals:
+    __slots__ = ('starts', 'ends', 'booking_ids')
+
+    def __init__(self):
+        self.starts = array('H')
+        self.ends = array('H')
+        self.booking_ids = array('q')
+
+    #
+    # Adding a booking that is already there replaces it: a booking committed between LISTEN
+    # and the initial load is both loaded and notified, it must not be kept twice
+    #
+    def add(self, booking_id, start, end):
+        self.remove(booking_id)
+
+        i = bisect.bisect_right(self.starts, start)
+        self.starts.insert(i, start)
+        self.ends.insert(i, end)
+        self.booking_ids.insert(i, booking_id)
+
+    def remove(self, booking_id):
+        try:
+            i = self.booking_ids.index(booking_id)
+        except ValueError:
+            return
+        del self.starts[i], self.ends[i], self.booking_ids[i]
+
+    def overlaps(self, start, end):
+        i = bisect.bisect_right(self.ends, start)
+        return i < len(self.starts) and self.starts[i] < end
+
+    def __len__(self):
+        return len(self.starts)
+
+
+##
+## In-memory calendar of the future bookings of every doctor, room and nurse.
+##
+## Loaded from the bookings table and kept current by the change feed, it lets the
+## booking endpoints refuse a slot that is already taken before taking a database
+## connection. It only answers "taken": a free slot is still checked by the database,
+## which stays the final authority through the bookings_no_overlap constraint.
+##
+class BookingCalendar:
+    channels = (BOOKINGS_CHANNEL, )
+
+    def __init__(self):
+        self._days = {}  # (resource_type, resource_id, date) -> DayIntervals
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._pruned_on = None
+        self._counters = {'checks': 0, 'conflicts': 0, 'notifications': 0}
+
+    #
+    # First (resource_type, resource_id) of "resources" booked during the event, or None
+    #
+    def find_conflict(self, resources, date, hour, minutes, duration):
+        try:
+            start = int(hour) * 60 + int(minutes)
+            resources = [(int(resource_type), int(resource_id)) for resource_type, resource_id in resources]
+        except (TypeError, ValueError):
+            return None
+
+        with self._lock:
+            if not self._loaded:
+                return None
+
+            self._counters['checks'] += 1
+            for resource in resources:
+                intervals = self._days.get((*resource, date))
+                if intervals is not None and intervals.overlaps(start, start + duration):
+                    self._counters['conflicts'] += 1
+                    return resource
+
+        return None
+
+    def clear(self):
+        with self._lock:
+            self._days.clear()
+            self._loaded = False
+
+    def stats(self):
+        with self._lock:
+            return {
+                'loaded': self._loaded,
+                'days': len(self._days),
+                'bookings': sum(len(intervals) for intervals in self._days.values()),
+                **self._counters
+            }
+
+    def on_connect(self, conn):
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT booking_id, resource_type, resource_id, lower(period), upper(period)
+                FROM bookings
+                WHERE upper(period) >= CURRENT_DATE;
+            """)
+            rows = cur.fetchall()
+
+        with self._lock:
+            self._days.clear()
+            for row in rows:
+                self._add(*row)
+            self._loaded = True
+            self._pruned_on = datetime.date.today()
+
+    def on_notify(self, conn, notifies):
+        with self._lock:
+            self._counters['notifications'] += len(notifies)
+
+            # All the notifications of a transaction are applied together
+            for notify in notifies:
+                change = json.loads(notify.payload)
+                start = datetime.datetime.fromisoformat(change['period_start'])
+                if change['op'] == 'delete':
+                    intervals = self._days.get((change['resource_type'], change['resource_id'], start.date()))
+                    if intervals is not None:
+                        intervals.remove(change['booking_id'])
+                else:
+                    end = datetime.datetime.fromisoformat(change['period_end'])
+                    self._add(change['booking_id'], change['resource_type'], change['resource_id'], start, end)
+
+            today = datetime.date.today()
+            if self._pruned_on != today:
+                self._days = {key: intervals for key, intervals in self._days.items() if key[2] >= today and intervals}
+                self._pruned_on = today
+
+    def _add(self, booking_id, resource_type, resource_id, start, end):
+        key = (resource_type, resource_id, start.date())
+        intervals = self._days.get(key)
+        if intervals is None:
+            intervals = self._days[key] = DayIntervals()
+
+        day_start = datetime.datetime.combine(start.date(), datetime.time())
+        intervals.add(booking_id, (start - day_start) // datetime.timedelta(minutes=1), (end - day_start) // datetime.timedelta(minutes=1))
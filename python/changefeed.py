@@ -0,0 +1,94 @@
+import logging
+import select
+import threading
+import time
+
+import psycopg2
+import psycopg2.extensions
+
+logger = logging.getLogger('logger')
+
+
+##########################################################
+## CHANGE FEED
+##########################################################
+
+##
+## One LISTEN connection per process shared by the in-memory caches.
+##
+## Each subscriber provides:
+##  - channels: the pg_notify() channels it listens to
+##  - on_connect(conn): full load, called after every (re)connection
+##  - on_notify(conn, notifies): apply the notifications received on its channels
+##  - clear(): drop everything, called when the connection is lost
+##
+## LISTEN is issued before the loads, so a change committed during a load is
+## never lost. While disconnected the subscribers are empty and every lookup
+## goes to the database.
+##
+class ChangeFeed:
+    def __init__(self, connect, subscribers, retry_interval=5.0):
+        self._connect = connect
+        self.subscribers = list(subscribers)
+        self.retry_interval = retry_interval
+
+        self._lock = threading.Lock()
+        self._counters = {'connected': False, 'connections': 0, 'notifications': 0}
+
+    def start(self):
+        threading.Thread(target=self._listen_forever, name='change-feed', daemon=True).start()
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counters)
+
+    def _listen_forever(self):
+        while True:
+            conn = None
+            try:
+                conn = self._connect()
+                conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+
+                channels = [channel for subscriber in self.subscribers for channel in subscriber.channels]
+                with conn.cursor() as cur:
+                    cur.execute(' '.join(f'LISTEN {channel};' for channel in channels))
+
+                for subscriber in self.subscribers:
+                    subscriber.on_connect(conn)
+
+                with self._lock:
+                    self._counters['connected'] = True
+                    self._counters['connections'] += 1
+
+                while True:
+                    if select.select([conn], [], [], 60.0) == ([], [], []):
+                        continue
+
+                    conn.poll()
+                    notifies = list(conn.notifies)
+                    conn.notifies.clear()
+
+                    with self._lock:
+                        self._counters['notifications'] += len(notifies)
+
+                    for subscriber in self.subscribers:
+                        received = [notify for notify in notifies if notify.channel in subscriber.channels]
+                        if received:
+                            subscriber.on_notify(conn, received)
+
+            except (Exception, psycopg2.DatabaseError) as error:
+                logger.error(f'Change feed - error: {error}')
+
+                with self._lock:
+                    self._counters['connected'] = False
+                for subscriber in self.subscribers:
+                    subscriber.clear()
+
+            finally:
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except psycopg2.Error:
+                        pass
+
+            time.sleep(self.retry_interval)
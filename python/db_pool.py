@@ -0,0 +1,238 @@
+import collections
+import logging
+import threading
+import time
+
+import psycopg2
+import psycopg2.extensions
+
+logger = logging.getLogger('logger')
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+##########################################################
+## CONNECTION POOL
+##########################################################
+
+##
+## Thread-safe pool of PostgreSQL connections shared by every endpoint.
+##
+##  - connections are opened lazily by "connect" up to "max_size"
+##  - getconn() waits at most "timeout" seconds for a free connection
+##  - idle connections are pinged before being handed out again
+##  - putconn() rolls back any transaction left open by the handler
+##  - drain() retires every open connection, checked out connections are
+##    closed when they come back so in-flight requests are not interrupted
+##
+class ConnectionPool:
+    def __init__(self, connect, min_size=2, max_size=10, timeout=5.0, check_interval=30.0):
+        if min_size < 0 or max_size < 1 or min_size > max_size:
+            raise ValueError(f'Invalid pool size: min_size={min_size}, max_size={max_size}')
+
+        self._connect = connect
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.check_interval = check_interval
+
+        self._idle = collections.deque()  # (connection, last_used, generation) tuples
+        self._in_use = {}  # checked out connection -> generation
+        self._size = 0  # open connections, idle or checked out
+        self._generation = 0  # bumped by drain()
+        self._cond = threading.Condition()
+
+        self._counters = {
+            'checkouts': 0,
+            'timeouts': 0,
+            'connections_created': 0,
+            'connections_discarded': 0,
+            'failed_health_checks': 0,
+            'rollbacks_on_return': 0,
+            'drains': 0,
+            'wait_time': 0.0
+        }
+
+    #
+    # Open "min_size" connections up front so the first requests do not pay the handshake
+    #
+    def open(self):
+        conns = []
+        try:
+            for _ in range(self.min_size - self._size):
+                conns.append(self.getconn())
+        finally:
+            for conn in conns:
+                self.putconn(conn)
+
+    def close(self):
+        with self._cond:
+            while self._idle:
+                conn, _, _ = self._idle.popleft()
+                self._size -= 1
+                self._close_quietly(conn)
+            self._cond.notify_all()
+
+    #
+    # Retire the current connections, e.g. after the database credentials changed
+    #
+    def drain(self):
+        with self._cond:
+            self._generation += 1
+            self._counters['drains'] += 1
+
+            retired = [conn for conn, _, _ in self._idle]
+            self._idle.clear()
+
+        for conn in retired:
+            self._discard(conn)
+
+    def resize(self, min_size, max_size, timeout=None, check_interval=None):
+        if min_size < 0 or max_size < 1 or min_size > max_size:
+            raise ValueError(f'Invalid pool size: min_size={min_size}, max_size={max_size}')
+
+        with self._cond:
+            self.min_size = min_size
+            self.max_size = max_size
+            if timeout is not None:
+                self.timeout = timeout
+            if check_interval is not None:
+                self.check_interval = check_interval
+            self._cond.notify_all()
+
+    def getconn(self):
+        start = time.monotonic()
+        deadline = start + self.timeout
+
+        while True:
+            conn = None
+
+            with self._cond:
+                while True:
+                    if self._idle:
+                        conn, last_used, generation = self._idle.pop()
+                        break
+
+                    if self._size < self.max_size:
+                        self._size += 1
+                        generation = self._generation
+                        break
+
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._counters['timeouts'] += 1
+                        raise PoolTimeout(f'No database connection available after {self.timeout} seconds!')
+
+                    self._cond.wait(remaining)
+
+            # Reserved a free slot, open a new connection outside the lock
+            if conn is None:
+                try:
+                    conn = self._connect()
+                except Exception:
+                    self._release_slot()
+                    raise
+
+                with self._cond:
+                    self._counters['connections_created'] += 1
+                break
+
+            # Reused connection, verify it is still alive
+            if self._is_healthy(conn, last_used):
+                break
+
+            with self._cond:
+                self._counters['failed_health_checks'] += 1
+            self._discard(conn)
+
+        with self._cond:
+            self._in_use[conn] = generation
+            self._counters['checkouts'] += 1
+            self._counters['wait_time'] += time.monotonic() - start
+
+        return conn
+
+    def putconn(self, conn):
+        if conn is None:
+            return
+
+        with self._cond:
+            generation = self._in_use.pop(conn, None)
+            retired = generation != self._generation
+
+        # Connection opened before the last drain() or already broken
+        if retired or conn.closed:
+            self._discard(conn)
+            return
+
+        # Never hand a connection with an open transaction to the next request
+        try:
+            if conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+                with self._cond:
+                    self._counters['rollbacks_on_return'] += 1
+
+            if conn.autocommit:
+                conn.autocommit = False
+        except psycopg2.Error as error:
+            logger.warning(f'Discarding pooled connection - error: {error}')
+            self._discard(conn)
+            return
+
+        with self._cond:
+            if generation != self._generation or self._size > self.max_size:
+                retired = True
+            else:
+                self._idle.append((conn, time.monotonic(), generation))
+                self._cond.notify()
+
+        if retired:
+            self._discard(conn)
+
+    def stats(self):
+        with self._cond:
+            idle = len(self._idle)
+            return {
+                'min_size': self.min_size,
+                'max_size': self.max_size,
+                'size': self._size,
+                'idle': idle,
+                'in_use': self._size - idle,
+                **self._counters
+            }
+
+    def _is_healthy(self, conn, last_used):
+        if conn.closed:
+            return False
+
+        if time.monotonic() - last_used < self.check_interval:
+            return True
+
+        try:
+            with conn.cursor() as cur:
+                cur.execute('SELECT 1;')
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _discard(self, conn):
+        self._close_quietly(conn)
+
+        with self._cond:
+            self._counters['connections_discarded'] += 1
+        self._release_slot()
+
+    def _release_slot(self):
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    @staticmethod
+    def _close_quietly(conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
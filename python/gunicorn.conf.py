@@ -0,0 +1,37 @@
+##
+## gunicorn configuration for the production server
+##
+##  gunicorn -c gunicorn.conf.py wsgi:app
+##
+## The app is not preloaded: each worker imports it after the fork, so the .env
+## settings and the connection pool belong to that worker alone and a SIGHUP to the
+## master restarts the workers with the current .env file.
+##
+import multiprocessing
+import os
+
+chdir = os.path.dirname(os.path.abspath(__file__))
+
+bind = os.environ.get('BIND', '127.0.0.1:8080')
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+worker_class = 'gthread'
+threads = int(os.environ.get('THREADS', 4))  # keep POOL_MAX_SIZE >= threads
+timeout = 30
+graceful_timeout = 30
+preload_app = False
+
+accesslog = '-'
+errorlog = '-'
+
+
+def post_worker_init(worker):
+    # Open this worker's pooled connections before it accepts requests
+    from main import change_feed, db_pool, start_revocation_sync
+    db_pool.open()
+    start_revocation_sync()
+    change_feed.start()
+
+
+def worker_exit(server, worker):
+    from main import db_pool
+    db_pool.close()
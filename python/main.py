@@ -1,20 +1,41 @@
-from dotenv import dotenv_values
-from cryptography.fernet import Fernet
+from auth import RevocationList, TokenCache
+from booking_batch import (
+    APPOINTMENT_DURATION, SERIES_FREQUENCIES, Recurrence, book_appointments, book_series, find_batch_conflicts, parse_appointment
+)
+from calendar_index import BookingCalendar, describe_resource
+from changefeed import ChangeFeed
 from datetime import datetime
+from db_pool import ConnectionPool, PoolTimeout
+from pagination import InvalidPageToken, decode_page_token, encode_page_token, page_limit
+from passwords import HASH_PREFIX, HashingBusy, PasswordHasher, is_legacy_password
+from refdata import ReferenceData
+from settings import SettingsStore
+from staffing import NurseValidationError, assign_nurse_roles, validate_nurses
+from streaming import STREAM_FORMATS, open_stream, stream_body
+from transactions import lock_booking_resources, retry_stats, transaction_attempts
+import dataclasses
 import flask
+import functools
+import hashlib
 import logging
 import psycopg2
 import jwt
 import secrets
+import signal
+import threading
+import time
 
 app = flask.Flask(__name__)
 
-secret_key = secrets.token_hex(64)  # Generate a random secret key to encode/decode JWT tokens
+logger = logging.getLogger('logger')
+
+ephemeral_key = secrets.token_hex(64)  # Signing key used only when no JWT_KEY_<id> is configured
 
 StatusCodes = {
     'success': 200,
     'api_error': 400,
-    'internal_error': 500
+    'internal_error': 500,
+    'unavailable': 503
 } # Status codes for the API
 
 user_types = {
@@ -24,36 +45,186 @@ user_types = {
     'assistant': 4
 } # User types
 
+MAX_SLOT_SEARCH_DAYS = 31 # Longest date range accepted by the free slots search
+
+MAX_BATCH_APPOINTMENTS = 500 # Most appointments accepted by one batch booking
+
+MAX_SERIES_OCCURRENCES = 52 # Most occurrences of an appointment series
+
+MAX_DAILY_RANGE_DAYS = 366 # Longest date range of the daily summary series
+
+MAX_REPORT_MONTHS = 120 # Widest window of the surgery report, in months
+MAX_REPORT_TOP = 50 # Most doctors ranked per month by the surgery report
+
+DEFAULT_PAGE_SIZE = 50 # Rows per page of the paginated listings
+MAX_PAGE_SIZE = 200
+
+APPOINTMENT_STATUS = {
+    'marcada': 0,
+    'realizada': 1
+} # app_status values
+
 
 ##########################################################
 ## DATABASE ACCESS
 ##########################################################
 
-def db_connection():
-    #
-    # Decrypting the environment variables on .env file
-    #
-    
-    env_vars = dotenv_values(".env")
+#
+# Settings are read and decrypted once at startup, SIGHUP reloads them
+#
 
-    key = env_vars["KEY"].encode()
-    cipher_suite = Fernet(key)
+settings = SettingsStore(".env")
 
-    decrypted_user = cipher_suite.decrypt(eval(env_vars["USER"])).decode()
-    decrypted_password = cipher_suite.decrypt(eval(env_vars["PASSWORD"])).decode()
-    decrypted_host = cipher_suite.decrypt(eval(env_vars["HOST"])).decode()
-    decrypted_port = cipher_suite.decrypt(eval(env_vars["PORT"])).decode()
-    decrypted_database = cipher_suite.decrypt(eval(env_vars["DATABASE"])).decode()
+def db_connection():
+    db_settings = settings.current.database
 
     db = psycopg2.connect(
-        user=decrypted_user,
-        password=decrypted_password,
-        host=decrypted_host,
-        port=decrypted_port,
-        database=decrypted_database
+        user=db_settings.user,
+        password=db_settings.password,
+        host=db_settings.host,
+        port=db_settings.port,
+        database=db_settings.database
     )
     return db
 
+#
+# Connection pool shared by every endpoint
+#
+
+db_pool = ConnectionPool(
+    db_connection,
+    min_size=settings.current.pool_min_size,
+    max_size=settings.current.pool_max_size,
+    timeout=settings.current.pool_timeout,
+    check_interval=settings.current.pool_check_interval
+)
+
+##
+## Every endpoint takes its connection with db_pool.getconn(), when the pool stays exhausted
+## for POOL_TIMEOUT seconds the request is answered with the usual error response
+##
+@app.errorhandler(PoolTimeout)
+def pool_timeout(error):
+    logger.error(f'{flask.request.method} {flask.request.path} - error: {error}')
+
+    response = {'status': StatusCodes['unavailable'], 'errors': str(error), 'results': None}
+    return flask.jsonify(response), StatusCodes['unavailable']
+
+def apply_settings(old_settings, new_settings):
+    db_pool.resize(
+        new_settings.pool_min_size, new_settings.pool_max_size,
+        timeout=new_settings.pool_timeout, check_interval=new_settings.pool_check_interval
+    )
+
+    # Connections opened with the old credentials are closed as they are returned
+    if old_settings.database != new_settings.database:
+        db_pool.drain()
+
+    # Cached tokens may have been signed with a key that was just removed
+    token_cache.clear()
+    token_cache.max_size = new_settings.token_cache_size
+
+settings.on_reload(apply_settings)
+
+#
+# In-memory caches kept current by the LISTEN connection of the change feed:
+#  - roles, categories, specialisations, medicines, posologies and doctor capabilities
+#  - future bookings of every doctor, room and nurse (BOOKING_CALENDAR, read at startup)
+#
+
+reference_data = ReferenceData()
+booking_calendar = BookingCalendar()
+
+change_feed = ChangeFeed(
+    db_connection,
+    [reference_data, booking_calendar] if settings.current.booking_calendar else [reference_data]
+)
+
+def reload_settings(signum, frame):
+    # Reload outside the signal handler so it never runs under a lock held by the interrupted code
+    threading.Thread(target=settings.reload, daemon=True).start()
+
+##########################################################
+## AUTHENTICATION
+##########################################################
+
+password_hasher = PasswordHasher(
+    max_workers=settings.current.hash_workers,
+    max_queue=settings.current.hash_queue_size,
+    timeout=settings.current.hash_timeout
+)
+
+token_cache = TokenCache(settings.current.token_cache_size)  # Verified tokens -> claims
+revoked_tokens = RevocationList()  # "jti" of logged out tokens, synced from the database
+
+##
+## Declares the user types allowed to call an endpoint:
+##
+##  @requires_auth('assistant', errors='Only assistants can ...')
+##
+## The token is checked before the endpoint runs, so rejected requests never parse
+## the payload or touch the database. With no user types any logged in user is allowed.
+## The decoded token is available to the endpoint as flask.g.jwt_token.
+##
+def requires_auth(*allowed_types, errors=None):
+    allowed = {user_types[name] for name in allowed_types}
+
+    def decorator(endpoint):
+        @functools.wraps(endpoint)
+        def wrapper(*args, **kwargs):
+            jwt_token = flask.request.headers.get('Authorization')
+            if not jwt_token:
+                response = {'status': StatusCodes['api_error'], 'errors': 'Authorization header is required!'}
+                return flask.jsonify(response)
+
+            jwt_token = validate_token(jwt_token)
+            if not jwt_token:
+                response = {'status': StatusCodes['api_error'], 'errors': 'Invalid or Expirated token!'}
+                return flask.jsonify(response)
+
+            if allowed and jwt_token['user_type'] not in allowed:
+                response = {'status': StatusCodes['api_error'], 'errors': errors or 'You are not allowed to access this resource!'}
+                return flask.jsonify(response)
+
+            flask.g.jwt_token = jwt_token
+            return endpoint(*args, **kwargs)
+
+        return wrapper
+    return decorator
+
+##
+## Keeps the revoked token ids of this process in sync with the revoked_tokens table,
+## so a logout on one worker is honoured by every other worker within the sync interval
+##
+def sync_revoked_tokens():
+    conn = None
+    try:
+        conn = db_pool.getconn()
+        cur = conn.cursor()
+
+        statement = """
+            SELECT jti, EXTRACT(EPOCH FROM expires_at) FROM revoked_tokens WHERE expires_at > now();
+        """
+        cur.execute(statement)
+
+        revoked_tokens.merge((jti, float(exp)) for jti, exp in cur.fetchall())
+        revoked_tokens.last_sync = time.time()
+
+    except (Exception, psycopg2.DatabaseError) as error:
+        logger.error(f'Revoked tokens sync - error: {error}')
+
+    finally:
+        if conn is not None:
+            db_pool.putconn(conn)
+
+def start_revocation_sync():
+    def run():
+        while True:
+            sync_revoked_tokens()
+            time.sleep(settings.current.revocation_sync_interval)
+
+    threading.Thread(target=run, name='revocation-sync', daemon=True).start()
+
 ##########################################################
 ## ENDPOINTS
 ##########################################################
@@ -138,11 +309,18 @@ def add_doctor():
             response = {'status': StatusCodes['api_error'], 'errors': f'Invalid date format: {date}'}
             return flask.jsonify(response)
 
+    # Hash the password on the hashing executor before taking a database connection
+    try:
+        password_hash = password_hasher.hash(payload['password'])
+    except HashingBusy as error:
+        response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
+        return flask.jsonify(response)
+
     #
     # SQL query
     #
 
-    conn = db_connection()
+    conn = db_pool.getconn()
     cur = conn.cursor()
 
     conn.autocommit = False
@@ -150,14 +328,14 @@ def add_doctor():
     # Query to insert the doctor
     statement = """
         INSERT INTO employees (person_cc, person_name, person_address, person_phone, person_username, person_password, person_email, salary, start_date, final_date, ctype_id, person_type) 
-                VALUES (%s, %s, %s, %s, %s, encrypt(%s, 'my_secret_key'), %s, %s, %s, %s, %s, %s); 
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s); 
 
         INSERT INTO doctors (person_id, ml_issue_date, ml_expiration_date) 
                 SELECT person_id, %s, %s FROM employees WHERE person_cc = %s
         RETURNING person_id;
     """
     values = (
-        payload['cc'], payload['name'], payload['address'], payload['phone'], payload['username'], payload['password'], 
+        payload['cc'], payload['name'], payload['address'], payload['phone'], payload['username'], password_hash, 
         payload['email'], payload['contract']['salary'], payload['contract']['start_date'], payload['contract']['final_date'], 
         payload['contract']['ctype_id'], "2", payload['medical_license']['issue_date'], payload['medical_license']['expiration_date'],
         payload['cc']
@@ -174,28 +352,30 @@ def add_doctor():
         for spec in specialisations:
             spec_id, sub_spec_id = spec
 
-            # Query to verify if the specialisation exists
-            statement = """
-                SELECT spec_id FROM specialisations WHERE spec_id = %s;
-            """
-            values = (spec_id, )
-            cur.execute(statement, values)
-
-            result = cur.fetchone()
-            if result is None:
-                raise Exception(f'Specialisation {spec_id} does not exist!')
-            
-            # Query to verify if the sub-specialisation exists
-            if sub_spec_id is not None:
+            # Query to verify if the specialisation exists, unless it is cached
+            if reference_data.get('specialisations', spec_id) is None:
                 statement = """
-                    SELECT sub_spec_id FROM sub_specialisations WHERE sub_spec_id = %s;
+                    SELECT spec_id FROM specialisations WHERE spec_id = %s;
                 """
-                values = (sub_spec_id, )
+                values = (spec_id, )
                 cur.execute(statement, values)
 
                 result = cur.fetchone()
                 if result is None:
-                    raise Exception(f'Sub-specialisation {sub_spec_id} does not exist!')
+                    raise Exception(f'Specialisation {spec_id} does not exist!')
+            
+            # Query to verify if the sub-specialisation exists
+            if sub_spec_id is not None:
+                if reference_data.get('sub_specialisations', sub_spec_id) is None:
+                    statement = """
+                        SELECT sub_spec_id FROM sub_specialisations WHERE sub_spec_id = %s;
+                    """
+                    values = (sub_spec_id, )
+                    cur.execute(statement, values)
+
+                    result = cur.fetchone()
+                    if result is None:
+                        raise Exception(f'Sub-specialisation {sub_spec_id} does not exist!')
                 
                 # Query to insert the doctor sub-specialisation
                 statement = """
@@ -227,7 +407,7 @@ def add_doctor():
 
     finally:
         if conn is not None:
-            conn.close()
+            db_pool.putconn(conn)
 
     return flask.jsonify(response)
 
@@ -293,24 +473,31 @@ def add_nurse():
             response = {'status': StatusCodes['api_error'], 'errors': f'Invalid date format: {date}'}
             return flask.jsonify(response)
 
+    # Hash the password on the hashing executor before taking a database connection
+    try:
+        password_hash = password_hasher.hash(payload['password'])
+    except HashingBusy as error:
+        response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
+        return flask.jsonify(response)
+
     #
     # SQL query
     #
     
-    conn = db_connection()
+    conn = db_pool.getconn()
     cur = conn.cursor()
     
 
     # Query to insert the nurse
     insert_statement = """
         INSERT INTO employees (person_cc, person_name, person_address, person_phone, person_username, person_password, person_email, salary, start_date, final_date, ctype_id, person_type) 
-        VALUES (%s, %s, %s, %s, %s, encrypt(%s, 'my_secret_key'), %s, %s, %s, %s, %s ,%s);
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s ,%s);
 
         INSERT INTO nurses (person_id) 
         SELECT person_id FROM employees WHERE person_cc = %s RETURNING person_id;
     """
     values = (
-        payload['cc'], payload['name'], payload['address'], payload['phone'], payload['username'], payload['password'], payload['email'], 
+        payload['cc'], payload['name'], payload['address'], payload['phone'], payload['username'], password_hash, payload['email'], 
         payload['contract']['salary'], payload['contract']['start_date'], payload['contract']['final_date'], payload['contract']['ctype_id'],
         "3", payload['cc']
     )
@@ -358,7 +545,7 @@ def add_nurse():
 
     finally:
         if conn is not None:
-            conn.close()
+            db_pool.putconn(conn)
 
     return flask.jsonify(response)
 
@@ -417,23 +604,30 @@ def add_assistant():
             response = {'status': StatusCodes['api_error'], 'errors': f'Invalid date format: {date}'}
             return flask.jsonify(response)
 
+    # Hash the password on the hashing executor before taking a database connection
+    try:
+        password_hash = password_hasher.hash(payload['password'])
+    except HashingBusy as error:
+        response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
+        return flask.jsonify(response)
+
     #
     # SQL Query
     #
 
-    conn = db_connection()
+    conn = db_pool.getconn()
     cur = conn.cursor()
 
 
     # query to insert the assistant
     statement = """
         INSERT INTO employees (person_cc, person_name, person_address, person_phone, person_username, person_password, person_email, salary, start_date, final_date, ctype_id, person_type) 
-            VALUES (%s, %s, %s, %s, %s, encrypt(%s, 'my_secret_key'), %s, %s, %s, %s, %s, %s);
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s);
         INSERT INTO assistants (person_id) 
             SELECT person_id FROM employees WHERE person_cc = %s RETURNING person_id;
     """
     values = (
-        payload['cc'], payload['name'], payload['address'], payload['phone'], payload['username'], payload['password'], payload['email'], 
+        payload['cc'], payload['name'], payload['address'], payload['phone'], payload['username'], password_hash, payload['email'], 
         payload['contract']['salary'], payload['contract']['start_date'], payload['contract']['final_date'], payload['contract']['ctype_id'],
         "4", payload['cc']
     )
@@ -460,7 +654,7 @@ def add_assistant():
 
     finally:
         if conn is not None:
-            conn.close()
+            db_pool.putconn(conn)
 
     return flask.jsonify(response)
 
@@ -499,21 +693,27 @@ def add_patient():
             response = {'status': StatusCodes['api_error'], 'errors': f'{field} value not in payload'}
             return flask.jsonify(response)
 
+    # Hash the password on the hashing executor before taking a database connection
+    try:
+        password_hash = password_hasher.hash(payload['password'])
+    except HashingBusy as error:
+        response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
+        return flask.jsonify(response)
 
     #
     # SQL Query
     #
 
-    conn = db_connection()
+    conn = db_pool.getconn()
     cur = conn.cursor()
 
     # query to insert the patient
     statement = """
         INSERT INTO patients (person_cc, person_name, person_address, person_phone, person_username, person_password, person_email, person_type) 
-            VALUES (%s, %s, %s, %s, %s, encrypt(%s, 'my_secret_key'), %s, %s) RETURNING person_id;
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s) RETURNING person_id;
     """
     values = (
-        payload['cc'], payload['name'], payload['address'], payload['phone'], payload['username'], payload['password'], 
+        payload['cc'], payload['name'], payload['address'], payload['phone'], payload['username'], password_hash, 
         payload['email'], "1"
     )
 
@@ -539,7 +739,7 @@ def add_patient():
 
     finally:
         if conn is not None:
-            conn.close()
+            db_pool.putconn(conn)
 
     return flask.jsonify(response)
 
@@ -577,52 +777,153 @@ def login():
     # SQL query
     #
 
-    conn = db_connection()
+    conn = db_pool.getconn()
     cur = conn.cursor()
-    
 
-    statement =  """
-        SELECT person_type, person_id, decrypt(person_password, 'my_secret_key') AS decrypted_password
-        FROM employees
-        WHERE person_username = %s
-        UNION
-        SELECT person_type, person_id, decrypt(person_password, 'my_secret_key') AS decrypted_password
-        FROM patients
-        WHERE person_username = %s;
+    # Single index lookup on the credentials table, shared by employees and patients. A legacy
+    # password (stored with encrypt()) is decrypted in the same query.
+    statement = """
+        SELECT person_type, person_id, password_hash,
+               CASE WHEN password_hash NOT LIKE %s THEN decrypt(password_hash, 'my_secret_key') END
+        FROM credentials
+        WHERE username = %s;
     """
-    values = (payload['username'], payload['username'])
+    values = (HASH_PREFIX + '%', payload['username'])
 
     try:
         cur.execute(statement, values)
         result = cur.fetchone()
 
-        if result:
-            user_type, user_id, decrypted_password = result
+    except (Exception, psycopg2.DatabaseError) as error:
+        logger.error(f'PUT dproj/user - error: {error}')
+        response = {'status': StatusCodes['internal_error'], 'errors': str(error), 'results': None}
+        return flask.jsonify(response)
 
-            if decrypted_password != payload['password']:
-                raise Exception('Invalid password!')
-            
-            jwt_payload = { 'user_id': int(user_id), 'user_type': int(user_type)}
-            jwt_token = jwt.encode(jwt_payload, secret_key, algorithm='HS256')
+    finally:
+        # The connection is not held while the password is hashed
+        conn.rollback()
+        db_pool.putconn(conn)
 
-            logger.debug(f'PUT /dbproj/user - user {user_id} logged in')
-            
-            response = {'status': StatusCodes['success'], 'results': jwt_token}
+    #
+    # Verify the password on the hashing executor
+    #
 
-            conn.commit()
-        else:
+    try:
+        if result is None:
+            password_hasher.verify_unknown(payload['password'])
             raise Exception('Invalid username or password!')
-        
+
+        user_type, user_id, password_hash, legacy_password = result
+
+        if is_legacy_password(password_hash):
+            if legacy_password != payload['password']:
+                password_hasher.verify_unknown(payload['password'])
+                raise Exception('Invalid password!')
+
+            # Password stored with encrypt(), replace it with a hash
+            new_password_hash = password_hasher.hash(payload['password'])
+            migrate_legacy_password(user_type, user_id, new_password_hash)
+
+        elif not password_hasher.verify(payload['password'], password_hash):
+            raise Exception('Invalid password!')
+
+        jwt_payload = { 'user_id': int(user_id), 'user_type': int(user_type)}
+        jwt_token = issue_token(jwt_payload)
+
+        logger.debug(f'PUT /dbproj/user - user {user_id} logged in')
+
+        response = {'status': StatusCodes['success'], 'results': jwt_token}
+
     except (Exception, psycopg2.DatabaseError) as error:
         logger.error(f'PUT dproj/user - error: {error}')
         response = {'status': StatusCodes['internal_error'], 'errors': str(error), 'results': None}
 
+    return flask.jsonify(response)
+
+##
+## Store the hash of a legacy password, on a connection taken only for the UPDATE.
+## Only a password still stored with encrypt() is replaced.
+##
+def migrate_legacy_password(user_type, user_id, password_hash):
+    conn = db_pool.getconn()
+    cur = conn.cursor()
+
+    if user_type == user_types['patient']:
+        statement = """
+            UPDATE patients SET person_password = %s WHERE person_id = %s AND person_password NOT LIKE %s;
+        """
+    else:
+        statement = """
+            UPDATE employees SET person_password = %s WHERE person_id = %s AND person_password NOT LIKE %s;
+        """
+    values = (password_hash, user_id, HASH_PREFIX + '%')
+
+    try:
+        cur.execute(statement, values)
+        conn.commit()
+
+        logger.debug(f'PUT /dbproj/user - password of user {user_id} migrated to hash')
+
+    except (Exception, psycopg2.DatabaseError) as error:
+        # The login still succeeds, the password is migrated on a later login
+        conn.rollback()
+        logger.error(f'PUT dproj/user - password of user {user_id} not migrated - error: {error}')
+
+    finally:
+        db_pool.putconn(conn)
+
+##
+## User Logout
+##
+## Revokes the token sent in the Authorization header
+##
+##  DELETE http://localhost:8080/dbproj/user
+##
+##
+@app.route('/dbproj/user', methods = ['DELETE'])
+@requires_auth()
+def logout():
+    logger.info('DELETE /dbproj/user')
+
+    jwt_token = flask.g.jwt_token
+
+    #
+    # SQL query
+    #
+
+    conn = db_pool.getconn()
+    cur = conn.cursor()
+
+    statement = """
+        DELETE FROM revoked_tokens WHERE expires_at <= now();
+
+        INSERT INTO revoked_tokens (jti, expires_at) VALUES (%s, to_timestamp(%s))
+            ON CONFLICT (jti) DO NOTHING;
+    """
+    values = (jwt_token['jti'], jwt_token['exp'])
+
+    try:
+        cur.execute(statement, values)
+        conn.commit()
+
+        revoked_tokens.revoke(jwt_token['jti'], jwt_token['exp'])
+
+        logger.debug(f'DELETE /dbproj/user - user {jwt_token["user_id"]} logged out')
+
+        response = {'status': StatusCodes['success'], 'results': None}
+
+    except (Exception, psycopg2.DatabaseError) as error:
         # an error occurred, rollback
         conn.rollback()
 
+        logger.error(f'DELETE /dbproj/user - error: {error}')
+
+        error = str(error).split('\n')[0]
+        response = {'status': StatusCodes['internal_error'], 'errors': error, 'results': None}
+
     finally:
         if conn is not None:
-            conn.close()
+            db_pool.putconn(conn)
 
     return flask.jsonify(response)
 
@@ -645,30 +946,14 @@ def login():
 ##
 ##
 @app.route('/dbproj/appointment', methods = ['POST'])
+@requires_auth('patient', errors='Only patients can schedule appointments!')
 def schedule_appointment():
     logger.info('POST /dbproj/appointment')
     payload = flask.request.get_json()
 
     logger.debug(f'POST /dbproj/appointment - payload: {payload}')
 
-    #
-    # Validate Authorization header
-    #
-
-    jwt_token = flask.request.headers.get('Authorization')
-    if not jwt_token:
-        response = {'status': StatusCodes['api_error'], 'errors': 'Authorization header is required!'}
-        return flask.jsonify(response)
-    
-    jwt_token = validate_token(jwt_token)
-    if not jwt_token:
-        response = {'status': StatusCodes['api_error'], 'errors': 'Invalid or Expirated token!'}
-        return flask.jsonify(response)
-
-    # Verify if the user is a patient
-    if jwt_token['user_type'] != user_types['patient']:
-        response = {'status': StatusCodes['api_error'], 'errors': 'Only patients can schedule appointments!'}
-        return flask.jsonify(response)
+    jwt_token = flask.g.jwt_token
     
     #
     # Validate payload.
@@ -689,141 +974,106 @@ def schedule_appointment():
     if not validate_date_format(payload['date']):
         response = {'status': StatusCodes['api_error'], 'errors': f'Invalid date format: {payload["date"]}'}
         return flask.jsonify(response)
+
+    appointment_date = datetime.strptime(payload['date'], '%Y-%m-%d').date()
+
+    # Refuse a slot already taken in the booking calendar before using a database connection
+    resources = [(0, payload['doctor_id']), (1, payload['room'])]
+    resources += [(2, nurse[0]) for nurse in payload['nurses'] if isinstance(nurse, list) and nurse]
+
+    conflict = booking_calendar.find_conflict(resources, appointment_date, payload['hour'], payload['minutes'], 30)
+    if conflict is not None:
+        response = {'status': StatusCodes['api_error'], 'errors': f'{describe_resource(conflict)} is already booked at this time!'}
+        return flask.jsonify(response)
     
     #
     # SQL query 
     #
 
-    conn = db_connection()
+    conn = db_pool.getconn()
     cur = conn.cursor()
     
-    # Query to verify if the doctor exists and if the doctor type given corresponds to real doctor type
-    statement =  """
-        SELECT e.person_id, e.person_name, s.specialization
-        FROM employees AS e
-        LEFT JOIN specialisations_doctors AS sd ON e.person_id = sd.doctor_id
-        LEFT JOIN specialisations AS s ON s.spec_id = sd.spec_id
-        WHERE e.person_type = 2 AND e.person_id = %s AND ( (%s = 'GERAL' AND sd.spec_id IS NULL)
-                                                           OR s.specialization = %s);
-    """
-    values = (payload['doctor_id'], payload['type'], payload['type'])
-
     try:
-        cur.execute(statement, values)
-        
-        result = cur.fetchone()
-        if result is None:
-            raise Exception('Doctor does not exist or the type of appointment does not correspond to the doctor specialisation!')
-
-        # Query to verify if the doctor is available
-        statement =  """
-            SELECT is_doctor_available_for_appointment(%s, %s, %s, %s);
-        """
-        values = (payload['doctor_id'], payload['date'], payload['hour'], payload['minutes'])
-        cur.execute(statement, values)
-
-        result = cur.fetchone()[0]
-        if not result:
-            raise Exception('Doctor is already booked at this time!')
-        
-
-        # Query to verify if the room is available
-        statement =  """
-            SELECT is_room_available_for_appointment(%s, %s, %s, %s);
-        """
-        values = (payload['room'], payload['date'], payload['hour'], payload['minutes'])
-        cur.execute(statement, values)
+        # Retried when a concurrent transaction makes it fail, the locks are taken again on each attempt
+        for attempt in transaction_attempts(conn, settings.current.booking_retries, settings.current.booking_retry_delay):
+            with attempt:
+                # Lock the doctor, room and nurses on that day, the checks below cannot race another booking
+                lock_booking_resources(cur, resources, appointment_date, payload['hour'], payload['minutes'], 30)
+
+                # Verify if the doctor exists, takes this type of appointment and has a valid license on that date
+                doctor = reference_data.doctor(payload['doctor_id'], cur)
+                if doctor is None or not doctor.can_perform('appointment', payload['type']):
+                    raise Exception('Doctor does not exist or the type of appointment does not correspond to the doctor specialisation!')
+
+                if not doctor.is_licensed(appointment_date):
+                    raise Exception(f'Doctor {payload["doctor_id"]} does not have a valid medical license on {payload["date"]}!')
+
+                # Query to verify if the doctor is available
+                statement =  """
+                    SELECT is_doctor_available_for_appointment(%s, %s, %s, %s);
+                """
+                values = (payload['doctor_id'], payload['date'], payload['hour'], payload['minutes'])
+                cur.execute(statement, values)
 
-        result = cur.fetchone()[0]
-        if not result:
-            raise Exception('Room is already booked at this time!')
-    
+                result = cur.fetchone()[0]
+                if not result:
+                    raise Exception('Doctor is already booked at this time!')
 
-        # Query to insert the appointment
-        statement =  """
-            INSERT INTO appointments (doctor_id, patient_id, app_date, app_hour, app_minutes, app_type, app_room, app_status)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s) RETURNING appointment_id;
-        """
-        values = (
-            payload['doctor_id'], jwt_token['user_id'], payload['date'], payload['hour'], payload['minutes'], 
-            payload['type'], payload['room'], 0
-        )
-        cur.execute(statement, values)
 
-        appointment_id = cur.fetchone()[0]
+                # Query to verify if the room is available
+                statement =  """
+                    SELECT is_room_available_for_appointment(%s, %s, %s, %s);
+                """
+                values = (payload['room'], payload['date'], payload['hour'], payload['minutes'])
+                cur.execute(statement, values)
 
-        logger.debug(f'POST /dbproj/appointment - appointment {appointment_id} created')
+                result = cur.fetchone()[0]
+                if not result:
+                    raise Exception('Room is already booked at this time!')
 
-        # Inserir enfermeiros associados à consulta
-        for nurse in payload['nurses']:
-            nurse_id, role_name = nurse
+                # Verify every nurse at once, the errors of all of them are returned together
+                nurse_ids, role_ids, nurse_errors = validate_nurses(
+                    cur, payload['nurses'], 'CONSULTAS', 0, payload['date'], payload['hour'], payload['minutes'], 30
+                )
+                if nurse_errors:
+                    raise NurseValidationError(nurse_errors)
 
-            # Verify if nurse is a "CONSULTAS" nurse
-            statement =  """
-                SELECT nc.category
-                FROM nurse_categories AS nc
-                JOIN nurses_categories AS nsc ON nsc.category_id = nc.category_id
-                JOIN employees AS e ON e.person_id = nsc.nurse_id
-                WHERE e.person_id = %s AND nc.category = 'CONSULTAS';
-            """
-            values = (nurse_id, )
+                assign_nurse_roles(cur, nurse_ids, role_ids)
 
-            cur.execute(statement, values)
-            result = cur.fetchone()
+                # Query to insert the appointment
+                statement =  """
+                    INSERT INTO appointments (doctor_id, patient_id, app_date, app_hour, app_minutes, app_type, app_room, app_status)
+                        VALUES (%s, %s, %s, %s, %s, %s, %s, %s) RETURNING appointment_id;
+                """
+                values = (
+                    payload['doctor_id'], jwt_token['user_id'], payload['date'], payload['hour'], payload['minutes'], 
+                    payload['type'], payload['room'], 0
+                )
+                cur.execute(statement, values)
 
-            if result is None:
-                raise Exception('Nurse is not a valid nurse!')
-            
-            # Verificar se o role existe na tabela de roles
-            statement = """
-                SELECT role_id 
-                FROM roles 
-                WHERE role = %s
-                AND role_type = 0;
-            """
-            values = (role_name, )
-            cur.execute(statement, values)
+                appointment_id = cur.fetchone()[0]
 
-            role_id = cur.fetchone()
-            
-            if role_id is None:
-                raise Exception(f'Role {role_name} does not exist or is not valid for appointment!')
-            
+                logger.debug(f'POST /dbproj/appointment - appointment {appointment_id} created')
 
-            role_id = role_id[0]
+                # Associate the nurses with the appointment
+                statement = """
+                    INSERT INTO roles_appointments (role_id, app_id, doctor_id, patient_id, nurse_id)
+                    SELECT n.role_id, %s, %s, %s, n.nurse_id
+                    FROM unnest(%s::INTEGER[], %s::BIGINT[]) AS n(nurse_id, role_id);
+                """
+                values = (appointment_id, payload['doctor_id'], jwt_token['user_id'], nurse_ids, role_ids)
+                cur.execute(statement, values)
 
-            # Verify if the nurse is available
-            statement = """
-                SELECT is_nurse_available_for_appointment(%s, %s, %s, %s);
-            """
-            values = (nurse_id, payload['date'], payload['hour'], payload['minutes'])
-            cur.execute(statement, values)
+                response = {'status': StatusCodes['success'], 'results': appointment_id}
 
-            available = cur.fetchone()[0]
-            if not available:
-                raise Exception(f'Nurse {nurse_id} is not available at this time!')
-            
-            # Inserir na tabela nurses_roles se não existir
-            statement = """
-                INSERT INTO nurses_roles (nurse_id, role_id)
-                VALUES (%s, %s)
-                ON CONFLICT (nurse_id) DO NOTHING
-            """
-            values = (nurse_id, role_id)
-            cur.execute(statement, values)
+                conn.commit()
 
+    except NurseValidationError as error:
+        conn.rollback()
 
-            # Inserir na tabela roles_appointments
-            statement = """
-                INSERT INTO roles_appointments (role_id, app_id, doctor_id, patient_id)
-                VALUES (%s, %s, %s, %s)
-            """
-            values = (role_id, appointment_id, payload['doctor_id'], jwt_token['user_id'])
-            cur.execute(statement, values)
-        
-        response = {'status': StatusCodes['success'], 'results': appointment_id}
+        logger.error(f'POST dproj/appointment - error: {error.errors}')
 
-        conn.commit()
+        response = {'status': StatusCodes['api_error'], 'errors': error.errors, 'results': None}
 
     except (Exception, psycopg2.DatabaseError) as error:
         # an error occurred, rollback
@@ -836,54 +1086,320 @@ def schedule_appointment():
 
     finally:
         if conn is not None:
-            conn.close()
+            db_pool.putconn(conn)
 
     return flask.jsonify(response)
 
 ##
-## See Appointments
+## Schedule an Appointment Series
 ##
-## GET http://localhost:8080/dbproj/appointments/<patient_id>
+## Example of payload:
+##  POST http://localhost:8080/dbproj/appointment/series
+##  {
+##      "doctor_id": 10,
+##      "date": "2024-06-01", -> first occurrence
+##      "hour": "10",
+##      "minutes": "30",
+##      "type": "GERAL",
+##      "room": 5,
+##      "nurses": [[12, "TRIAGEM"]],
+##      "repeat": {"frequency": "weekly", "interval": 1, "count": 8}, -> frequency weekly or monthly
+##      "on_conflict": "fail" -> or "skip" to book the series without the dates already taken
+##  }
 ##
 ##
-@app.route('/dbproj/appointments/<patient_id>', methods = ['GET'])
-def see_appointments(patient_id=None):
-    if patient_id is None:
-        response = {'status': StatusCodes['api_error'], 'errors': 'patient_id is required!'}
-        return flask.jsonify(response)
-        
-    logger.info(f'GET /dbproj/appointments/{patient_id}')
+@app.route('/dbproj/appointment/series', methods = ['POST'])
+@requires_auth('patient', errors='Only patients can schedule appointments!')
+def schedule_appointment_series():
+    logger.info('POST /dbproj/appointment/series')
+    payload = flask.request.get_json()
+
+    logger.debug(f'POST /dbproj/appointment/series - payload: {payload}')
+
+    jwt_token = flask.g.jwt_token
 
     #
-    # Validate Authorization header
+    # Validate payload
     #
 
-    jwt_token = flask.request.headers.get('Authorization')
-    if not jwt_token:
-        response = {'status': StatusCodes['api_error'], 'errors': 'Authorization header is required!'}
+    if 'repeat' not in payload or not isinstance(payload['repeat'], dict):
+        response = {'status': StatusCodes['api_error'], 'errors': 'repeat value not in payload'}
         return flask.jsonify(response)
-    
-    jwt_token = validate_token(jwt_token)
-    if not jwt_token:
-        response = {'status': StatusCodes['api_error'], 'errors': 'Invalid or Expirated token!'}
+
+    try:
+        recurrence = Recurrence(
+            str(payload['repeat'].get('frequency')), int(payload['repeat'].get('interval', 1)), int(payload['repeat'].get('count'))
+        )
+    except (TypeError, ValueError):
+        response = {'status': StatusCodes['api_error'], 'errors': 'repeat interval and count must be integers'}
         return flask.jsonify(response)
-    
-    # Verify if the user is an assistant or the target patient
-    if not (jwt_token['user_type'] == user_types['assistant'] or jwt_token['user_type'] == user_types['patient']):
-        response = {'status': StatusCodes['api_error'], 'errors': 'Only patients or assistants can see appointments!'}
+
+    if recurrence.frequency not in SERIES_FREQUENCIES:
+        response = {'status': StatusCodes['api_error'], 'errors': f'Invalid frequency {recurrence.frequency}, must be weekly or monthly'}
         return flask.jsonify(response)
-    
-    if jwt_token['user_id'] != int(patient_id) and jwt_token['user_type'] != user_types['assistant']:
-        response = {'status': StatusCodes['api_error'], 'errors': 'You can only see your own appointments!'}
+
+    if recurrence.interval < 1 or not 1 <= recurrence.count <= MAX_SERIES_OCCURRENCES:
+        response = {'status': StatusCodes['api_error'], 'errors': f'repeat interval must be positive and count between 1 and {MAX_SERIES_OCCURRENCES}'}
         return flask.jsonify(response)
 
-    #
-    # SQL query
-    #
-        
-    conn = db_connection()
-    cur = conn.cursor()
+    on_conflict = payload.get('on_conflict', 'fail')
+    if on_conflict not in ('fail', 'skip'):
+        response = {'status': StatusCodes['api_error'], 'errors': f'Invalid on_conflict {on_conflict}, must be fail or skip'}
+        return flask.jsonify(response)
+
+    first, error = parse_appointment(0, {**payload, 'patient_id': jwt_token['user_id']})
+    if error is not None:
+        response = {'status': StatusCodes['api_error'], 'errors': error}
+        return flask.jsonify(response)
+
+    dates = recurrence.dates(first.date)
+    appointments = [dataclasses.replace(first, index=index, date=date) for index, date in enumerate(dates)]
+
+    # Occurrences already taken in the booking calendar
+    errors = calendar_conflicts(appointments)
+    appointments = [appointment for appointment in appointments if appointment.index not in errors]
+
+    #
+    # SQL query
+    #
+
+    series_id = None
+    appointment_ids = {}
+    if appointments and (on_conflict == 'skip' or not errors):
+        conn = db_pool.getconn()
+        cur = conn.cursor()
+
+        try:
+            # Every occurrence is checked with the same queries and the series is inserted in one transaction
+            for attempt in transaction_attempts(conn, settings.current.booking_retries, settings.current.booking_retry_delay):
+                with attempt:
+                    series_id, appointment_ids, booking_errors = book_series(
+                        cur, appointments, reference_data, recurrence, first.date, on_conflict == 'skip'
+                    )
+
+                    if appointment_ids:
+                        conn.commit()
+                    else:
+                        conn.rollback()
+                        series_id = None
+
+            errors.update(booking_errors)
+
+            logger.debug(f'POST /dbproj/appointment/series - series {series_id} with {len(appointment_ids)} appointments created')
+
+        except (Exception, psycopg2.DatabaseError) as error:
+            # an error occurred, rollback
+            conn.rollback()
+
+            logger.error(f'POST /dbproj/appointment/series - error: {error}')
+
+            error = str(error).split('\n')[0]
+            response = {'status': StatusCodes['internal_error'], 'errors': error, 'results': None}
+            return flask.jsonify(response)
+
+        finally:
+            if conn is not None:
+                db_pool.putconn(conn)
+
+    occurrences = []
+    for index, date in enumerate(dates):
+        if index in errors:
+            occurrences.append({'date': date.isoformat(), 'errors': errors[index]})
+        else:
+            occurrences.append({'date': date.isoformat(), 'appointment_id': appointment_ids.get(index)})
+
+    skipped = [date.isoformat() for index, date in enumerate(dates) if index in errors]
+    results = {'series_id': series_id, 'occurrences': len(appointment_ids), 'skipped': skipped, 'appointments': occurrences}
+
+    if series_id is None:
+        response = {'status': StatusCodes['api_error'], 'errors': f'{len(errors)} occurrences cannot be booked, the series was not created', 'results': results}
+    else:
+        response = {'status': StatusCodes['success'], 'results': results}
+
+    return flask.jsonify(response)
+
+##
+## Schedule a Batch of Appointments
+##
+## Example of payload:
+##  POST http://localhost:8080/dbproj/appointments/batch
+##  {
+##      "mode": "all_or_nothing", -> or "best_effort" to book the valid appointments anyway
+##      "appointments": [
+##          {
+##              "patient_id": 3,
+##              "doctor_id": 10,
+##              "date": "2024-06-01",
+##              "hour": "10",
+##              "minutes": "30",
+##              "type": "GERAL",
+##              "room": 5,
+##              "nurses": [[12, "TRIAGEM"]]
+##          },
+##          ...
+##      ]
+##  }
+##
+## Returns one result per appointment, in the order of the payload: {"index", "appointment_id"} or {"index", "errors"}
+##
+##
+@app.route('/dbproj/appointments/batch', methods = ['POST'])
+@requires_auth('assistant', errors='Only assistants can schedule appointments in batch!')
+def schedule_appointments_batch():
+    logger.info('POST /dbproj/appointments/batch')
+    payload = flask.request.get_json()
+
+    logger.debug(f'POST /dbproj/appointments/batch - payload: {payload}')
+
+    #
+    # Validate payload
+    #
+
+    if 'appointments' not in payload or not isinstance(payload['appointments'], list) or payload['appointments'] == []:
+        response = {'status': StatusCodes['api_error'], 'errors': 'appointments values is empty'}
+        return flask.jsonify(response)
+
+    if len(payload['appointments']) > MAX_BATCH_APPOINTMENTS:
+        response = {'status': StatusCodes['api_error'], 'errors': f'At most {MAX_BATCH_APPOINTMENTS} appointments per batch'}
+        return flask.jsonify(response)
+
+    mode = payload.get('mode', 'all_or_nothing')
+    if mode not in ('all_or_nothing', 'best_effort'):
+        response = {'status': StatusCodes['api_error'], 'errors': f'Invalid mode {mode}, must be all_or_nothing or best_effort'}
+        return flask.jsonify(response)
+
+    errors = {}
+    appointments = []
+    for index, item in enumerate(payload['appointments']):
+        appointment, error = parse_appointment(index, item)
+        if error is not None:
+            errors[index] = error
+        else:
+            appointments.append(appointment)
+
+    # Overlaps inside the batch and slots already taken in the booking calendar
+    errors.update(find_batch_conflicts(appointments))
+    errors.update(calendar_conflicts([appointment for appointment in appointments if appointment.index not in errors]))
+
+    appointments = [appointment for appointment in appointments if appointment.index not in errors]
+
+    #
+    # SQL query
+    #
+
+    appointment_ids = {}
+    if appointments and (mode == 'best_effort' or not errors):
+        conn = db_pool.getconn()
+        cur = conn.cursor()
+
+        try:
+            for attempt in transaction_attempts(conn, settings.current.booking_retries, settings.current.booking_retry_delay):
+                with attempt:
+                    appointment_ids, booking_errors = book_appointments(cur, appointments, reference_data, mode == 'best_effort')
+
+                    if appointment_ids:
+                        conn.commit()
+                    else:
+                        conn.rollback()
+
+            errors.update(booking_errors)
+
+            logger.debug(f'POST /dbproj/appointments/batch - {len(appointment_ids)} appointments created')
+
+        except (Exception, psycopg2.DatabaseError) as error:
+            # an error occurred, rollback
+            conn.rollback()
+
+            logger.error(f'POST /dbproj/appointments/batch - error: {error}')
+
+            error = str(error).split('\n')[0]
+            response = {'status': StatusCodes['internal_error'], 'errors': error, 'results': None}
+            return flask.jsonify(response)
 
+        finally:
+            if conn is not None:
+                db_pool.putconn(conn)
+
+    results = []
+    for index in range(len(payload['appointments'])):
+        if index in errors:
+            results.append({'index': index, 'errors': errors[index]})
+        else:
+            results.append({'index': index, 'appointment_id': appointment_ids.get(index)})
+
+    if errors and mode == 'all_or_nothing':
+        response = {'status': StatusCodes['api_error'], 'errors': f'{len(errors)} appointments refused, none was booked', 'results': results}
+    else:
+        response = {'status': StatusCodes['success'], 'results': results}
+
+    return flask.jsonify(response)
+
+##
+## See Appointments
+##
+## Appointments of a patient ordered by date and time, one page at a time.
+## Optional filters: start and end (dates, inclusive), status (marcada or realizada) and type.
+## The response has the next_page_token to pass as page_token, null on the last page.
+##
+## GET http://localhost:8080/dbproj/appointments/<patient_id>?start=2024-01-01&status=marcada&limit=50&page_token=...
+##
+## With stream=json or stream=ndjson every appointment is streamed instead, without pages.
+##
+##
+@app.route('/dbproj/appointments/<patient_id>', methods = ['GET'])
+@requires_auth('assistant', 'patient', errors='Only patients or assistants can see appointments!')
+def see_appointments(patient_id=None):
+    if patient_id is None:
+        response = {'status': StatusCodes['api_error'], 'errors': 'patient_id is required!'}
+        return flask.jsonify(response)
+        
+    logger.info(f'GET /dbproj/appointments/{patient_id}')
+
+    jwt_token = flask.g.jwt_token
+
+    if not patient_id.isdigit():
+        response = {'status': StatusCodes['api_error'], 'errors': 'patient_id must be a number'}
+        return flask.jsonify(response)
+    
+    if jwt_token['user_id'] != int(patient_id) and jwt_token['user_type'] != user_types['assistant']:
+        response = {'status': StatusCodes['api_error'], 'errors': 'You can only see your own appointments!'}
+        return flask.jsonify(response)
+
+    args = flask.request.args
+
+    #
+    # Validate arguments.
+    #
+
+    # A page token only continues the query with the same patient and filters
+    filters = {'patient_id': int(patient_id), **{field: args.get(field) for field in ['start', 'end', 'status', 'type']}}
+
+    try:
+        limit = page_limit(args.get('limit'), DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE)
+
+        # Sort key of the last appointment of the previous page: date, hour, minutes, appointment_id
+        after = decode_page_token(args['page_token'], 4, filters) if 'page_token' in args else None
+        if after is not None and not (isinstance(after[0], str) and validate_date_format(after[0]) and all(isinstance(value, int) for value in after[1:])):
+            raise InvalidPageToken(f'Invalid page_token: {args["page_token"]}')
+    except (ValueError, InvalidPageToken) as error:
+        response = {'status': StatusCodes['api_error'], 'errors': str(error)}
+        return flask.jsonify(response)
+
+    for field in ['start', 'end']:
+        if field in args and not validate_date_format(args[field]):
+            response = {'status': StatusCodes['api_error'], 'errors': f'Invalid date format: {args[field]}'}
+            return flask.jsonify(response)
+
+    status = args.get('status')
+    if status is not None and status not in APPOINTMENT_STATUS:
+        response = {'status': StatusCodes['api_error'], 'errors': f'Invalid status {status}, must be marcada or realizada'}
+        return flask.jsonify(response)
+
+    #
+    # SQL query
+    #
+
+    # Range scan of appointments_patient_date_idx from the page token, the filters are optional
     statement = """
         SELECT appointment_id, doctor_id, employees.person_name, app_date, app_hour, app_minutes, app_type, app_room, 
                 CASE 
@@ -893,44 +1409,180 @@ def see_appointments(patient_id=None):
                 END AS app_status 
         FROM appointments
         JOIN employees ON appointments.doctor_id = employees.person_id
-        WHERE patient_id = %s;
+        WHERE patient_id = %s
+          AND (%s::DATE IS NULL OR (app_date, app_hour, app_minutes, appointment_id) > (%s::DATE, %s::INTEGER, %s::INTEGER, %s::BIGINT))
+          AND (%s::DATE IS NULL OR app_date >= %s::DATE)
+          AND (%s::DATE IS NULL OR app_date <= %s::DATE)
+          AND (%s::INTEGER IS NULL OR app_status = %s::INTEGER)
+          AND (%s::VARCHAR IS NULL OR app_type = %s::VARCHAR)
+        ORDER BY app_date, app_hour, app_minutes, appointment_id
+        LIMIT %s;
     """
-    values = (patient_id, )
+    after = after or [None] * 4
+    values = (
+        patient_id, after[0], *after,
+        args.get('start'), args.get('start'), args.get('end'), args.get('end'),
+        APPOINTMENT_STATUS.get(status), APPOINTMENT_STATUS.get(status), args.get('type'), args.get('type'),
+        limit + 1
+    )
+
+    # Nothing changed since the client's copy, the appointments are not read again
+    etag = patient_etag(patient_id)
+    response = not_modified(etag)
+    if response is not None:
+        return response
+
+    def appointment_to_json(row):
+        return {
+            'appointment_id': row[0], 
+            'doctor_id': row[1], 
+            'doctor_name': row[2], 
+            'date': row[3], 
+            'hour': row[4],
+            'minutes': row[5],
+            'type': row[6],
+            'room': row[7],
+            'status': row[8]
+        }
+
+    # Export of every appointment from the page token on, without limit
+    if 'stream' in args:
+        empty_error = 'No appointments found!' if 'page_token' not in args else None
+        return stream_query(f'GET /dbproj/appointments/{patient_id}', statement, values[:-1] + (None, ), appointment_to_json, empty_error=empty_error, etag=etag)
+
+    conn = db_pool.getconn()
+    cur = conn.cursor()
 
     try:
         cur.execute(statement, values)
         rows = cur.fetchall()
 
-        logger.debug(f'GET /appointments/{patient_id} - parse')
+        logger.debug(f'GET /appointments/{patient_id} - {len(rows)} rows')
         
-        results = []
-        for row in rows:
-            logger.debug(row)
-
-            content = {
-                'appointment_id': row[0], 
-                'doctor_id': row[1], 
-                'doctor_name': row[2], 
-                'date': row[3], 
-                'hour': row[4],
-                'minutes': row[5],
-                'type': row[6],
-                'room': row[7],
-                'status': row[8]
-            }
-            results.append(content)
+        results = [appointment_to_json(row) for row in rows[:limit]]
         
-        if results == []:
+        if results == [] and 'page_token' not in args:
             raise Exception('No appointments found!')
+
+        # One row more than the page was read, there is a next page only when it exists
+        next_page_token = None
+        if len(rows) > limit:
+            last = rows[limit - 1]
+            next_page_token = encode_page_token([last[3].isoformat(), last[4], last[5], last[0]], filters)
         
-        response = {'status': StatusCodes['success'], 'results': results}
+        response = {'status': StatusCodes['success'], 'results': results, 'next_page_token': next_page_token}
     except (Exception, psycopg2.DatabaseError) as error:
-        logger.error(f'GET /departments - error: {error}')
+        logger.error(f'GET /dbproj/appointments/{patient_id} - error: {error}')
         response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
+        etag = None
+
+    finally:
+        if conn is not None:
+            db_pool.putconn(conn)
+
+    return tag_response(flask.jsonify(response), etag)
+
+##
+## See Free Slots
+##
+## Every 30 minute slot between 8:00 and 20:30 (the hours accepted by validate_appointment)
+## where the doctor, and the room when given, has no appointment or surgery booked.
+## The slots are returned in the format expected by POST /dbproj/appointment.
+##
+## GET http://localhost:8080/dbproj/doctor/<doctor_id>/slots?start=2024-10-20&end=2024-10-25&room=3
+##
+##
+@app.route('/dbproj/doctor/<doctor_id>/slots', methods = ['GET'])
+@requires_auth('assistant', 'patient', errors='Only patients or assistants can see free slots!')
+def see_free_slots(doctor_id):
+    logger.info(f'GET /dbproj/doctor/{doctor_id}/slots')
+
+    args = flask.request.args
+
+    #
+    # Validate arguments.
+    #
+
+    for field in ['start', 'end']:
+        if field not in args:
+            response = {'status': StatusCodes['api_error'], 'errors': f'{field} value not in arguments'}
+            return flask.jsonify(response)
+
+        if not validate_date_format(args[field]):
+            response = {'status': StatusCodes['api_error'], 'errors': f'Invalid date format: {args[field]}'}
+            return flask.jsonify(response)
+
+    start = datetime.strptime(args['start'], '%Y-%m-%d').date()
+    end = datetime.strptime(args['end'], '%Y-%m-%d').date()
+
+    if start > end:
+        response = {'status': StatusCodes['api_error'], 'errors': 'start must not be after end'}
+        return flask.jsonify(response)
+
+    if (end - start).days >= MAX_SLOT_SEARCH_DAYS:
+        response = {'status': StatusCodes['api_error'], 'errors': f'Date range cannot be longer than {MAX_SLOT_SEARCH_DAYS} days'}
+        return flask.jsonify(response)
+
+    room = args.get('room')
+    if room is not None and (not room.isdigit() or not 0 <= int(room) <= 30):
+        response = {'status': StatusCodes['api_error'], 'errors': 'room must be between 0 and 30'}
+        return flask.jsonify(response)
+
+    if not doctor_id.isdigit():
+        response = {'status': StatusCodes['api_error'], 'errors': 'doctor_id must be a number'}
+        return flask.jsonify(response)
+
+    #
+    # SQL query
+    #
+
+    conn = db_pool.getconn()
+    cur = conn.cursor()
+
+    # Candidate slots of every day, minus the ones overlapping a booking of the doctor or the room
+    statement = """
+        SELECT slot_start::date, EXTRACT(HOUR FROM slot_start)::INTEGER, EXTRACT(MINUTE FROM slot_start)::INTEGER
+        FROM generate_series(GREATEST(%s::date, CURRENT_DATE)::timestamp, %s::date::timestamp, interval '1 day') AS d(day)
+        CROSS JOIN LATERAL generate_series(d.day + interval '8 hours', d.day + interval '20 hours 30 minutes', interval '30 minutes') AS s(slot_start)
+        WHERE NOT EXISTS (
+            SELECT 1
+            FROM bookings AS b
+            WHERE b.resource_type = 0
+              AND b.resource_id = %s
+              AND b.period && tsrange(s.slot_start, s.slot_start + interval '30 minutes')
+        )
+        AND (%s::BIGINT IS NULL OR NOT EXISTS (
+            SELECT 1
+            FROM bookings AS b
+            WHERE b.resource_type = 1
+              AND b.resource_id = %s
+              AND b.period && tsrange(s.slot_start, s.slot_start + interval '30 minutes')
+        ))
+        ORDER BY slot_start;
+    """
+    values = (start, end, doctor_id, room, room)
+
+    try:
+        cur.execute('SELECT 1 FROM doctors WHERE person_id = %s;', (doctor_id, ))
+        if cur.fetchone() is None:
+            raise Exception(f'Doctor {doctor_id} does not exist!')
+
+        cur.execute(statement, values)
+        rows = cur.fetchall()
+
+        results = [{'date': row[0].isoformat(), 'hour': row[1], 'minutes': row[2]} for row in rows]
+
+        response = {'status': StatusCodes['success'], 'results': results}
+
+    except (Exception, psycopg2.DatabaseError) as error:
+        logger.error(f'GET /dbproj/doctor/{doctor_id}/slots - error: {error}')
+
+        error = str(error).split('\n')[0]
+        response = {'status': StatusCodes['internal_error'], 'errors': error, 'results': None}
 
     finally:
         if conn is not None:
-            conn.close()
+            db_pool.putconn(conn)
 
     return flask.jsonify(response)
 
@@ -960,6 +1612,7 @@ def see_appointments(patient_id=None):
 ##
 @app.route('/dbproj/surgery', methods = ['POST'])
 @app.route('/dbproj/surgery/<hospitalization_id>', methods = ['POST'])
+@requires_auth('assistant', errors='Only assistants can schedule appointments!')
 def shedule_surgery(hospitalization_id=None):
     if hospitalization_id is not None:
         logger.info(f'POST /dbproj/surgery/{hospitalization_id}')
@@ -973,24 +1626,7 @@ def shedule_surgery(hospitalization_id=None):
     else:
         logger.debug(f'POST /dbproj/surgery - payload: {payload}')
     
-    #
-    # Validate Authorization header
-    #
-
-    jwt_token = flask.request.headers.get('Authorization')
-    if not jwt_token:
-        response = {'status': StatusCodes['api_error'], 'errors': 'Authorization header is required!'}
-        return flask.jsonify(response)
-
-    jwt_token = validate_token(jwt_token)
-    if not jwt_token:
-        response = {'status': StatusCodes['api_error'], 'errors': 'Invalid or Expirated token!'}
-        return flask.jsonify(response)
-
-    # Verify if the user is a assistant
-    if jwt_token['user_type'] != user_types['assistant']:
-        response = {'status': StatusCodes['api_error'], 'errors': 'Only assistants can schedule appointments!'}
-        return flask.jsonify(response)
+    jwt_token = flask.g.jwt_token
     
     #
     # Validate payload
@@ -1032,206 +1668,166 @@ def shedule_surgery(hospitalization_id=None):
     if not validate_date_format(payload['date']):
         response = {'status': StatusCodes['api_error'], 'errors': f'Invalid date format: {payload["date"]}'}
         return flask.jsonify(response)
+
+    surgery_date = datetime.strptime(payload['date'], '%Y-%m-%d').date()
+
+    # Refuse a slot already taken in the booking calendar before using a database connection
+    resources = [(0, payload['doctor_id']), (1, payload['room'])]
+    resources += [(2, nurse[0]) for nurse in nurses if isinstance(nurse, list) and nurse]
+
+    conflict = booking_calendar.find_conflict(resources, surgery_date, payload['hour'], payload['minutes'], 120)
+    if conflict is not None:
+        response = {'status': StatusCodes['api_error'], 'errors': f'{describe_resource(conflict)} is already booked at this time!'}
+        return flask.jsonify(response)
     
     #
     # SQL query
     #
 
-    conn = db_connection()
+    conn = db_pool.getconn()
     cur = conn.cursor()
 
 
-    # Query to verify if the doctor exists and if the doctor type given corresponds to real doctor type
-    statement =  """
-        SELECT d.ml_id, e.person_name, s.specialization, ss.sub_spec
-        FROM doctors AS d
-        JOIN employees AS e ON d.person_id = e.person_id
-        JOIN specialisations_doctors AS sd ON d.ml_id = sd.doctor_id
-        JOIN specialisations AS s ON sd.spec_id = s.spec_id
-        LEFT JOIN sub_specialisations_doctors AS ssd ON d.ml_id = ssd.doctor_id
-        LEFT JOIN sub_specialisations AS ss ON ssd.sub_spec_id = ss.sub_spec_id
-        WHERE e.person_id = %s AND s.specialization = 'CIRURGIA' AND ss.sub_spec = %s;
-    """
-    values = (payload['doctor_id'], payload['type'])
-    
     try:
-        cur.execute(statement, values)
+        # Retried when a concurrent transaction makes it fail, the locks are taken again on each attempt
+        for attempt in transaction_attempts(conn, settings.current.booking_retries, settings.current.booking_retry_delay):
+            with attempt:
+                # Lock the doctor, room and nurses on that day, the checks below cannot race another booking
+                lock_booking_resources(cur, resources, surgery_date, payload['hour'], payload['minutes'], 120)
 
-        result = cur.fetchone()
-        if result is None:
-            raise Exception('Doctor does not exist or the type of surgery does not correspond to the doctor specialisation!')
-        
+                # Hospitalization of the surgery, created again if an attempt is retried
+                hosp_id = hospitalization_id
 
-        # Verify if the doctor is available
-        statement = """
-            SELECT is_doctor_available_for_surgery(%s, %s, %s, %s);
-        """
-        values = (payload['doctor_id'], payload['date'], payload['hour'], payload['minutes'])
-        
-        cur.execute(statement, values)
-        
-        doctor_available = cur.fetchone()[0]
-        if not doctor_available:
-            raise Exception('Doctor is not available at this time!')
-        
-        logger.debug(f'POST /dbproj/surgery - doctor is available')
-        
-        # Doctor is available, verify if the room is available
-        statement = """
-            SELECT is_room_available_for_surgery(%s, %s, %s, %s);
-        """
-        values = (payload['room'], payload['date'], payload['hour'], payload['minutes'])
+                # Verify if the doctor exists, performs this type of surgery and has a valid license on that date
+                doctor = reference_data.doctor(payload['doctor_id'], cur)
+                if doctor is None or not doctor.can_perform('surgery', payload['type']):
+                    raise Exception('Doctor does not exist or the type of surgery does not correspond to the doctor specialisation!')
 
-        cur.execute(statement, values)
-        
-        room_available = cur.fetchone()[0]
-        if not room_available:
-            raise Exception('Room is not available at this time!')
-        
-        logger.debug(f'POST /dbproj/surgery - room is available')
-        
+                if not doctor.is_licensed(surgery_date):
+                    raise Exception(f'Doctor {payload["doctor_id"]} does not have a valid medical license on {payload["date"]}!')
 
-        # Hospitalization_id is not provided, create a hospitalization
-        if hospitalization_id is None:
-            logger.debug(f'POST /dbproj/surgery - creating hospitalization..')
-            # Verify if nurse is a "HOSPITALIZACOES" nurse
-            statement =  """
-                SELECT nc.category
-                FROM nurse_categories AS nc
-                JOIN nurses_categories AS nsc ON nsc.category_id = nc.category_id
-                JOIN employees AS e ON e.person_id = nsc.nurse_id
-                WHERE e.person_id = %s AND nc.category = 'HOSPITALIZACOES';
-            """
-            values = (nurse_responsible_id, )
-            cur.execute(statement, values)
 
-            result = cur.fetchone()
-            if result is None:
-                raise Exception(f'Responsible nurse {nurse_responsible_id} is not a valid nurse!')
-            
-            logger.debug(f'POST /dbproj/surgery - responsible nurse is valid')
-            
-            # Query to generate the hospitalization room
-            statement = """
-                SELECT get_first_available_room(%s);
-            """
-            values = (payload['date'], )
-            cur.execute(statement, values)
-
-            room = cur.fetchone()[0]
-            if room is None:
-                raise Exception('No rooms available for hospitalization!')
-            
-            logger.debug(f'POST /dbproj/surgery - room {room} available')
-            
-            # Query to insert the hospitalization
-            statement = """
-                INSERT INTO hospitalizations (start_date, final_date, room, assistant_id, nurse_id) 
-                    VALUES (%s, %s, %s, %s, %s) RETURNING hosp_id;
-            """
-            values = (payload['date'], payload['final_date'], room, jwt_token['user_id'], nurse_responsible_id)
-            cur.execute(statement, values)
-
-            hospitalization_id = cur.fetchone()[0]
-            if hospitalization_id is None:
-                raise Exception('Error creating hospitalization!')
-
-            logger.debug(f'POST /dbproj/surgery - hospitalization created')
-
-        # Associate the surgery with the hospitalization
-        statement = """
-            INSERT INTO surgeries (doctor_id, patient_id, surgery_date, surgery_hour, surgery_minutes, surgery_type, surgery_room, 
-                                   surgery_status, hosp_id)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s) RETURNING surgery_id;
-        """
-        values = (
-            payload['doctor_id'], payload['patient_id'], payload['date'], payload['hour'], payload['minutes'], 
-            payload['type'], payload['room'], 0, hospitalization_id
-        )
-        cur.execute(statement, values)
-
-        surgery_id = cur.fetchone()[0]
-
-        logger.debug(f'POST /dbproj/surgery - surgery {surgery_id} created')
-        
-        # Inserir enfermeiros associados à cirurgia
-        # Verify if the nurses are available
-        for nurse in nurses:
-            nurse_id, role_name = nurse
+                # Verify if the doctor is available
+                statement = """
+                    SELECT is_doctor_available_for_surgery(%s, %s, %s, %s);
+                """
+                values = (payload['doctor_id'], payload['date'], payload['hour'], payload['minutes'])
 
-            # Verify if nurse is a "CIRURGIAS" nurse
-            statement = """
-                SELECT nc.category
-                FROM nurse_categories AS nc
-                JOIN nurses_categories AS nsc ON nsc.category_id = nc.category_id
-                JOIN employees AS e ON e.person_id = nsc.nurse_id
-                WHERE e.person_id = %s AND nc.category = 'CIRURGIAS';
-            """
-            values = (nurse_id, )
+                cur.execute(statement, values)
 
-            cur.execute(statement, values)
+                doctor_available = cur.fetchone()[0]
+                if not doctor_available:
+                    raise Exception('Doctor is not available at this time!')
 
-            result = cur.fetchone()
-            if result is None:
-                raise Exception(f'Nurse {nurse_id} is not a valid nurse!')
-            
+                logger.debug(f'POST /dbproj/surgery - doctor is available')
 
-            # Verificar se o role existe na tabela de roles
-            statement = """
-                SELECT role_id 
-                FROM roles 
-                WHERE role = %s
-                AND role_type = 1;
-            """
-            values = (role_name, )
-            cur.execute(statement, values)
+                # Doctor is available, verify if the room is available
+                statement = """
+                    SELECT is_room_available_for_surgery(%s, %s, %s, %s);
+                """
+                values = (payload['room'], payload['date'], payload['hour'], payload['minutes'])
 
-            role_id = cur.fetchone()
-            
-            if role_id is None:
-                raise Exception(f'Role {role_name} does not exist!')
+                cur.execute(statement, values)
 
-            role_id = role_id[0]
+                room_available = cur.fetchone()[0]
+                if not room_available:
+                    raise Exception('Room is not available at this time!')
+
+                logger.debug(f'POST /dbproj/surgery - room is available')
+
+                # Verify every nurse at once, the errors of all of them are returned together
+                nurse_ids, role_ids, nurse_errors = validate_nurses(
+                    cur, nurses, 'CIRURGIAS', 1, payload['date'], payload['hour'], payload['minutes'], 120
+                )
+                if nurse_errors:
+                    raise NurseValidationError(nurse_errors)
+
+                assign_nurse_roles(cur, nurse_ids, role_ids)
+
+                # Hospitalization_id is not provided, create a hospitalization
+                if hosp_id is None:
+                    logger.debug(f'POST /dbproj/surgery - creating hospitalization..')
+                    # Verify if nurse is a "HOSPITALIZACOES" nurse
+                    statement =  """
+                        SELECT nc.category
+                        FROM nurse_categories AS nc
+                        JOIN nurses_categories AS nsc ON nsc.category_id = nc.category_id
+                        JOIN employees AS e ON e.person_id = nsc.nurse_id
+                        WHERE e.person_id = %s AND nc.category = 'HOSPITALIZACOES';
+                    """
+                    values = (nurse_responsible_id, )
+                    cur.execute(statement, values)
+
+                    result = cur.fetchone()
+                    if result is None:
+                        raise Exception(f'Responsible nurse {nurse_responsible_id} is not a valid nurse!')
+
+                    logger.debug(f'POST /dbproj/surgery - responsible nurse is valid')
+
+                    # Query to allocate and lock a hospitalization room free during the whole stay
+                    statement = """
+                        SELECT allocate_hospitalization_room(%s, %s, %s);
+                    """
+                    values = (payload['date'], payload['final_date'], settings.current.room_policy)
+                    cur.execute(statement, values)
+
+                    room = cur.fetchone()[0]
+                    if room is None:
+                        raise Exception('No rooms available for hospitalization!')
+
+                    logger.debug(f'POST /dbproj/surgery - room {room} available')
+
+                    # Query to insert the hospitalization
+                    statement = """
+                        INSERT INTO hospitalizations (start_date, final_date, room, assistant_id, nurse_id) 
+                            VALUES (%s, %s, %s, %s, %s) RETURNING hosp_id;
+                    """
+                    values = (payload['date'], payload['final_date'], room, jwt_token['user_id'], nurse_responsible_id)
+                    cur.execute(statement, values)
+
+                    hosp_id = cur.fetchone()[0]
+                    if hosp_id is None:
+                        raise Exception('Error creating hospitalization!')
+
+                    logger.debug(f'POST /dbproj/surgery - hospitalization created')
+
+                # Associate the surgery with the hospitalization
+                statement = """
+                    INSERT INTO surgeries (doctor_id, patient_id, surgery_date, surgery_hour, surgery_minutes, surgery_type, surgery_room, 
+                                           surgery_status, hosp_id)
+                        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s) RETURNING surgery_id;
+                """
+                values = (
+                    payload['doctor_id'], payload['patient_id'], payload['date'], payload['hour'], payload['minutes'], 
+                    payload['type'], payload['room'], 0, hosp_id
+                )
+                cur.execute(statement, values)
 
-            logger.debug(f'POST /dbproj/surgery - role_id: {role_id}')
+                surgery_id = cur.fetchone()[0]
 
-            # Verify if the nurse is available
-            statement = """
-                SELECT is_nurse_available_for_appointment(%s, %s, %s, %s);
-            """
-            values = (nurse_id, payload['date'], payload['hour'], payload['minutes'])
-            cur.execute(statement, values)
+                logger.debug(f'POST /dbproj/surgery - surgery {surgery_id} created')
 
-            available = cur.fetchone()[0]
-            if not available:
-                raise Exception(f'Nurse {nurse_id} is not available at this time!')
+                # Associate the nurses with the surgery
+                statement = """
+                    INSERT INTO roles_surgeries (role_id, surgery_id, doctor_id, nurse_id)
+                    SELECT n.role_id, %s, %s, n.nurse_id
+                    FROM unnest(%s::INTEGER[], %s::BIGINT[]) AS n(nurse_id, role_id);
+                """
+                values = (surgery_id, payload['doctor_id'], nurse_ids, role_ids)
+                cur.execute(statement, values)
 
-            # Inserir na tabela nurses_roles se não existir
-            statement = """
-                INSERT INTO nurses_roles (nurse_id, role_id)
-                VALUES (%s, %s)
-                ON CONFLICT (nurse_id) DO NOTHING
-            """
-            values = (nurse_id, role_id)
-            cur.execute(statement, values)
+                logger.debug(f'POST /dbproj/surgery - nurses inserted')
+                conn.commit()
 
-            logger.debug(f'POST /dbproj/surgery - nurse inserted')
+                response = {'status': StatusCodes['success'], 'results': surgery_id}
 
-            # Inserir na tabela roles_surgeries
-            statement = """
-                INSERT INTO roles_surgeries (role_id, surgery_id, doctor_id)
-                VALUES (%s, %s, %s)
-            """
-            values = (role_id, surgery_id, payload['doctor_id'])
-            cur.execute(statement, values)
+    except NurseValidationError as error:
+        conn.rollback()
 
-            logger.debug(f'POST /dbproj/surgery - role inserted')
+        logger.error(f'POST /dbproj/surgery - error: {error.errors}')
 
-        logger.debug(f'POST /dbproj/surgery - nurses inserted')
-        conn.commit()
+        response = {'status': StatusCodes['api_error'], 'errors': error.errors, 'results': None}
 
-        response = {'status': StatusCodes['success'], 'results': surgery_id} 
-    
     except (Exception, psycopg2.DatabaseError) as error:
         # an error occurred, rollback
         conn.rollback()
@@ -1243,74 +1839,91 @@ def shedule_surgery(hospitalization_id=None):
 
     finally:
         if conn is not None:
-            conn.close()
+            db_pool.putconn(conn)
     
     return  flask.jsonify(response)
 
 ##
 ## Get Prescriptions
 ##
+## One result per prescription with all its posologies, active_only=true leaves out the expired ones.
+##
+## GET http://localhost:8080/dbproj/prescriptions/<person_id>?active_only=true, add stream=json or stream=ndjson to stream the results
+##
 ##
 @app.route('/dbproj/prescriptions/<person_id>', methods=['GET'])
+@requires_auth()
 def get_prescriptions(person_id):
     logger.info(f'GET /dbproj/prescriptions/{person_id}')
 
     logger.debug(f'person_id: {person_id}')
 
-    #
-    # Validate Authorization header
-    #
-
-    jwt_token = flask.request.headers.get('Authorization')
-    if not jwt_token:
-        response = {'status': StatusCodes['api_error'], 'errors': 'Authorization header is required!'}
-        return flask.jsonify(response)
-
-    jwt_token = validate_token(jwt_token)
-    if not jwt_token:
-        response = {'status': StatusCodes['api_error'], 'errors': 'Invalid or Expirated token!'}
-        return flask.jsonify(response)
+    jwt_token = flask.g.jwt_token
 
     # Verify if the user is the targeted patient or a employee
     if jwt_token['user_type'] == user_types['patient'] and jwt_token['user_id'] != int(person_id):
         response = {'status': StatusCodes['api_error'], 'errors': 'You can only see your own prescriptions!'}
         return flask.jsonify(response)
     
+    active_only = flask.request.args.get('active_only', 'false').lower()
+    if active_only not in ('true', 'false', '1', '0'):
+        response = {'status': StatusCodes['api_error'], 'errors': 'active_only must be true or false'}
+        return flask.jsonify(response)
+
     #
     # SQL query
     #
 
-    conn = db_connection()
-    cur = conn.cursor()
-
-    # Query to get prescriptions
+    # Query to get prescriptions of the patient's appointments and surgeries, one row per prescription
+    # with its posologies aggregated, optionally only the ones still valid today
     statement = """
-        SELECT * FROM (
-            (SELECT p.presc_id, p.presc_validity_date, pos.dosage, pos.frequency, m.medication
-            FROM prescriptions AS p
-            JOIN posologies_prescriptions AS pp ON p.presc_id = pp.presc_id
-            JOIN posologies AS pos ON pp.posology_id = pos.posology_id
-            JOIN posologies_medicines AS pm ON pos.posology_id = pm.posology_id
-            JOIN medicines AS m ON pm.medication_id = m.medication_id
-            JOIN appointments_prescriptions AS ap ON ap.presc_id = p.presc_id
-            WHERE ap.patient_id = %s)
+        WITH patient_prescriptions AS (
+            SELECT ap.presc_id
+            FROM appointments_prescriptions AS ap
+            WHERE ap.patient_id = %s
 
             UNION
 
-            (SELECT p.presc_id, p.presc_validity_date, pos.dosage, pos.frequency, m.medication
-            FROM prescriptions AS p
-            JOIN posologies_prescriptions AS pp ON p.presc_id = pp.presc_id
-            JOIN posologies AS pos ON pp.posology_id = pos.posology_id
-            JOIN posologies_medicines AS pm ON pos.posology_id = pm.posology_id
-            JOIN medicines AS m ON pm.medication_id = m.medication_id
-            JOIN hospitalizations_prescriptions AS hp ON p.presc_id = hp.presc_id
-            JOIN hospitalizations AS h ON hp.hosp_id = h.hosp_id
-            JOIN surgeries AS s ON s.hosp_id = h.hosp_id
-            WHERE s.patient_id = %s)
+            SELECT hp.presc_id
+            FROM surgeries AS s
+            JOIN hospitalizations_prescriptions AS hp ON hp.hosp_id = s.hosp_id
+            WHERE s.patient_id = %s
         )
-        ORDER BY presc_id ASC;
+        SELECT p.presc_id, p.presc_validity_date,
+               json_agg(
+                   json_build_object('dosage', pos.dosage, 'frequency', pos.frequency, 'medication', m.medication)
+                   ORDER BY pos.posology_id, m.medication
+               )
+        FROM patient_prescriptions AS ppr
+        JOIN prescriptions AS p ON p.presc_id = ppr.presc_id
+        JOIN posologies_prescriptions AS pp ON pp.presc_id = p.presc_id
+        JOIN posologies AS pos ON pos.posology_id = pp.posology_id
+        JOIN posologies_medicines AS pm ON pm.posology_id = pos.posology_id
+        JOIN medicines AS m ON m.medication_id = pm.medication_id
+        WHERE NOT %s OR p.presc_validity_date >= CURRENT_DATE
+        GROUP BY p.presc_id
+        ORDER BY p.presc_id ASC;
     """
-    values = (person_id, person_id)
+    values = (person_id, person_id, active_only in ('true', '1'))
+
+    # Nothing changed since the client's copy, the prescriptions are not read again
+    etag = patient_etag(person_id) if person_id.isdigit() else None
+    response = not_modified(etag)
+    if response is not None:
+        return response
+
+    def prescription_to_json(prescription):
+        return {
+            'prescription_id': prescription[0],
+            'validity_date': prescription[1],
+            'posology': prescription[2]
+        }
+
+    if 'stream' in flask.request.args:
+        return stream_query(f'GET /dbproj/prescriptions/{person_id}', statement, values, prescription_to_json, empty_error='No prescriptions found!', etag=etag)
+
+    conn = db_pool.getconn()
+    cur = conn.cursor()
 
     try:
         cur.execute(statement, values)
@@ -1319,14 +1932,7 @@ def get_prescriptions(person_id):
         if prescriptions == []:
             raise Exception('No prescriptions found!')
         
-        results = []
-        for prescription in prescriptions:
-            content = {
-                'prescription_id': prescription[0],
-                'validity_date': prescription[1],
-                'posology': [{ 'dosage': prescription[2], 'frequency': prescription[3], 'medication': prescription[4]}]
-            }
-            results.append(content)
+        results = [prescription_to_json(prescription) for prescription in prescriptions]
     
         response = {'status': StatusCodes['success'], 'results': results}
     except (Exception, psycopg2.DatabaseError) as error:
@@ -1337,18 +1943,20 @@ def get_prescriptions(person_id):
 
         error = str(error).split('\n')[0]
         response = {'status': StatusCodes['internal_error'], 'errors': str(error), 'results': None}
+        etag = None
 
     finally:
         if conn is not None:
-            conn.close()
+            db_pool.putconn(conn)
 
-    return flask.jsonify(response)
+    return tag_response(flask.jsonify(response), etag)
 
 
 ##
 ## ADD prescriptions
 ##
 @app.route('/dbproj/prescription/', methods=['POST'])
+@requires_auth('doctor', errors='Only doctors can add prescriptions!')
 def add_prescription():
     logger.info(f'POST /dbproj/prescription/')
     payload = flask.request.get_json()
@@ -1356,25 +1964,6 @@ def add_prescription():
 
     logger.debug(f'POST /dbproj/prescription/ - payload: {payload}')
     
-    #
-    # Validate Authorization header
-    #
-
-    jwt_token = flask.request.headers.get('Authorization')
-    if not jwt_token:
-        response = {'status': StatusCodes['api_error'], 'errors': 'Authorization header is required!'}
-        return flask.jsonify(response)
-
-    jwt_token = validate_token(jwt_token)
-    if not jwt_token:
-        response = {'status': StatusCodes['api_error'], 'errors': 'Invalid or Expirated token!'}
-        return flask.jsonify(response)
-
-    # Verify if the user is the targeted patient or a employee
-    if jwt_token['user_type'] != user_types['doctor']:
-        response = {'status': StatusCodes['api_error'], 'errors': 'Only doctors can add prescriptions!'}
-        return flask.jsonify(response)
-    
     #
     # Validate payload
     #
@@ -1408,7 +1997,7 @@ def add_prescription():
     # SQL query
     #
 
-    conn = db_connection()
+    conn = db_pool.getconn()
     cur = conn.cursor()
 
     # Query to verify if the event exists
@@ -1444,35 +2033,40 @@ def add_prescription():
 
         # Validate the medicines
         for medicine in medicines:
-            statement = """
-                SELECT medication_id FROM medicines WHERE medication = %s;
-            """
-            values = (medicine['medicine'], )
-            cur.execute(statement, values)
-
-            medication_id = cur.fetchone()
+            medication_id = reference_data.get('medicines', medicine['medicine'])
             if medication_id is None:
-                raise Exception(f'Medicine {medicine["medicine"]} does not exist!')
-            
-            # Query to verify if posology exists
-            statement = """
-                SELECT posology_id FROM posologies WHERE dosage = %s AND frequency = %s;
-            """
-            values = (medicine['posology_dose'], medicine['posology_frequency'])
-            cur.execute(statement, values)
+                statement = """
+                    SELECT medication_id FROM medicines WHERE medication = %s;
+                """
+                values = (medicine['medicine'], )
+                cur.execute(statement, values)
 
-            result = cur.fetchone()
-            if result is None:
-                # Posology does not exist, insert it
+                medication_id = cur.fetchone()
+                if medication_id is None:
+                    raise Exception(f'Medicine {medicine["medicine"]} does not exist!')
+                medication_id = medication_id[0]
+            
+            # Query to verify if posology exists, unless it is cached
+            posology_id = reference_data.get('posologies', (medicine['posology_dose'], medicine['posology_frequency']))
+            if posology_id is None:
                 statement = """
-                    INSERT INTO posologies (dosage, frequency) VALUES (%s, %s) RETURNING posology_id;
+                    SELECT posology_id FROM posologies WHERE dosage = %s AND frequency = %s;
                 """
                 values = (medicine['posology_dose'], medicine['posology_frequency'])
                 cur.execute(statement, values)
 
-                posology_id = cur.fetchone()[0]
-            else:
-                posology_id = result[0]
+                result = cur.fetchone()
+                if result is None:
+                    # Posology does not exist, insert it
+                    statement = """
+                        INSERT INTO posologies (dosage, frequency) VALUES (%s, %s) RETURNING posology_id;
+                    """
+                    values = (medicine['posology_dose'], medicine['posology_frequency'])
+                    cur.execute(statement, values)
+
+                    posology_id = cur.fetchone()[0]
+                else:
+                    posology_id = result[0]
             
             # Insert current posology and medication in posologies_medicines table if does not exist
             statement = """
@@ -1555,7 +2149,7 @@ def add_prescription():
 
     finally:
         if conn is not None:
-            conn.close()
+            db_pool.putconn(conn)
 
     return flask.jsonify(response)
 
@@ -1563,6 +2157,7 @@ def add_prescription():
 ## Execute Payment
 ##
 @app.route('/dbproj/bills/<bill_id>', methods=['POST'])
+@requires_auth('patient', errors='Only patients can pay their bills!')
 def execute_payment(bill_id):
     logger.info(f'POST dbproj/bills/{bill_id}')
 
@@ -1570,81 +2165,35 @@ def execute_payment(bill_id):
 
     logger.debug(f'POST dbproj/bills/{bill_id} - payload: {payload}')
 
+    jwt_token = flask.g.jwt_token
+
     #
-    # Validate Authorization header
+    # Validate payload
     #
 
-    jwt_token = flask.request.headers.get('Authorization')
-    if not jwt_token:
-        response = {'status': StatusCodes['api_error'], 'errors': 'Authorization header is required!'}
-        return flask.jsonify(response)
-
-    jwt_token = validate_token(jwt_token)
-    if not jwt_token:
-        response = {'status': StatusCodes['api_error'], 'errors': 'Invalid or Expirated token!'}
+    if 'amount' not in payload:
+        response = {'status': StatusCodes['api_error'], 'errors': 'amount is required!'}
         return flask.jsonify(response)
-
-    # Verify if the user is a patient 
-    if jwt_token['user_type'] != user_types['patient']:
-        response = {'status': StatusCodes['api_error'], 'errors': 'Only patients can pay their bills!'}
+    
+    if 'payment_method' not in payload:
+        response = {'status': StatusCodes['api_error'], 'errors': 'payment method is required!'}
         return flask.jsonify(response)
 
     #
-    # Query to get the patient_id of the bill and verify if token user is the same
-    # 
+    # SQL query
+    #
 
-    conn = db_connection()
+    conn = db_pool.getconn()
     cur = conn.cursor()
 
+    # Perform the payment and update bill status if necessary. The bill row is locked while
+    # update_bills verifies it belongs to the user, adds the payment and updates its running total
     statement = """
-        SELECT p.person_id
-        FROM patients AS p
-        JOIN appointments AS a ON p.person_id = a.patient_id
-        JOIN bills AS b ON b.bill_id = a.bill_id
-        WHERE b.bilL_id = %s
-        UNION
-        SELECT p.person_id
-        FROM patients AS p
-        JOIN surgeries AS s ON s.patient_id = p.person_id
-        JOIN hospitalizations AS h ON s.hosp_id = h.hosp_id
-        JOIN bills AS b ON b.bill_id = h.bill_id
-        WHERE b.bilL_id = %s;
+        CALL update_bills(%s, %s, %s, %s, %s);
     """
-    values = (bill_id, bill_id)
+    values = (payload['amount'], payload['payment_method'], bill_id, jwt_token['user_id'], None)
 
     try:
-        cur.execute(statement, values)
-        result = cur.fetchone()
-
-        if result[0] is None:
-            raise Exception('Bill {bill_id} does not exist!')
-        
-        if result[0] != jwt_token['user_id']:
-            logger.debug(f'Bill {bill_id} does not belong to user {jwt_token["user_id"]}')
-            raise Exception('You can only pay your own bills!')
-
-        #
-        # Validate payload
-        #
-
-        if 'amount' not in payload:
-            response = {'status': StatusCodes['api_error'], 'errors': 'amount is required!'}
-            return flask.jsonify(response)
-        
-        if 'payment_method' not in payload:
-            response = {'status': StatusCodes['api_error'], 'errors': 'payment method is required!'}
-            return flask.jsonify(response)
-    
-        #
-        # SQL query
-        #
-    
-        # Perform the payment and update bill status if necessary
-        statement = """
-            CALL update_bills(%s, %s, %s, %s);
-        """
-        values = (payload['amount'], payload['payment_method'], bill_id, None)
-
         cur.execute(statement, values)
         remaining_amount = cur.fetchone()[0]
     
@@ -1664,7 +2213,7 @@ def execute_payment(bill_id):
 
     finally:
         if conn is not None:
-            conn.close()
+            db_pool.putconn(conn)
 
     return flask.jsonify(response)
 
@@ -1673,121 +2222,57 @@ def execute_payment(bill_id):
 ##
 ##
 @app.route('/dbproj/top3', methods=['GET'])
+@requires_auth('assistant', errors='Only assistants can get top3 patients')
 def get_top_clients():
     logger.info('GET /dbproj/top3')
-    
-    #
-    # Validate Authorization header
-    #
-
-    jwt_token = flask.request.headers.get('Authorization')
-    if not jwt_token:
-        response = {'status': StatusCodes['api_error'], 'errors': 'Authorization header is required!'}
-        return flask.jsonify(response)
-
-    jwt_token = validate_token(jwt_token)
-    if not jwt_token:
-        response = {'status': StatusCodes['api_error'], 'errors': 'Invalid or Expirated token!'}
-        return flask.jsonify(response)
-
-    # Verify if the user is a assistant
-    if jwt_token['user_type'] != user_types['assistant']:
-        response = {'status': StatusCodes['api_error'], 'errors': 'Only assistants can get top3 patients'}
-        return flask.jsonify(response)
 
     #
     # SQL query
     #    
 
-    conn = db_connection()
+    conn = db_pool.getconn()
     cur = conn.cursor()
 
-    # Query to get the top 3 clients
+    # Query to get the top 3 clients of the current month and the services they paid for.
+    # revenue_monthly and revenue_monthly_services are kept current by the payments trigger, the top 3
+    # is the first 3 entries of the month in revenue_monthly_month_idx and only their services are
+    # joined with doctors and surgeries. A hospitalization is listed with its first surgery of the patient.
     statement = """
+        WITH top_patients AS (
+            SELECT rm.patient_id, rm.total_paid
+            FROM revenue_monthly rm
+            WHERE rm.month = date_trunc('month', CURRENT_DATE)::DATE AND rm.total_paid > 0
+            ORDER BY rm.total_paid DESC, rm.patient_id
+            LIMIT 3
+        )
         SELECT
+            tp.patient_id,
             p.person_name AS patient_name,
-            COALESCE(total_appointments.total_paid, 0) + COALESCE(total_hospitalizations.total_paid, 0) AS total_paid,
-            service_details.service_type,
-            service_details.service_id,
-            service_details.service_date,
-            service_details.doctor_id,
-            service_details.doctor_name,
-            service_details.app_type, -- Buscando app_type diretamente de appointments
-            service_details.surgery_id, -- ID da cirurgia
-            service_details.surgery_type, -- Tipo de cirurgia
-            service_details.payment_for_service
-        FROM patients p
-        LEFT JOIN (
-            SELECT p.person_id, SUM(py.payment) AS total_paid
-            FROM patients p
-            JOIN appointments a ON p.person_id = a.patient_id
-            JOIN bills b ON a.bill_id = b.bill_id
-            JOIN payments py ON b.bill_id = py.bill_id
-            WHERE EXTRACT(YEAR FROM py.payment_date) = EXTRACT(YEAR FROM CURRENT_DATE)
-                AND EXTRACT(MONTH FROM py.payment_date) = EXTRACT(MONTH FROM CURRENT_DATE)
-            GROUP BY p.person_id
-        ) total_appointments ON p.person_id = total_appointments.person_id
-        LEFT JOIN (
-            SELECT p.person_id, SUM(py.payment) AS total_paid
-            FROM patients p
-            JOIN surgeries s ON p.person_id = s.patient_id
-            JOIN hospitalizations h ON s.hosp_id = h.hosp_id
-            JOIN bills b ON h.bill_id = b.bill_id
-            JOIN payments py ON b.bill_id = py.bill_id
-            WHERE EXTRACT(YEAR FROM py.payment_date) = EXTRACT(YEAR FROM CURRENT_DATE)
-                AND EXTRACT(MONTH FROM py.payment_date) = EXTRACT(MONTH FROM CURRENT_DATE)
-            GROUP BY p.person_id
-        ) total_hospitalizations ON p.person_id = total_hospitalizations.person_id
-        JOIN (
-            SELECT 
-                'appointment' AS service_type,
-                a.appointment_id AS service_id,
-                a.app_date AS service_date,
-                d.person_id AS doctor_id,
-                e.person_name AS doctor_name,
-                py.payment AS payment_for_service,
-                p.person_id AS patient_id,
-                'Consulta' AS appointment_type, -- Definindo a coluna appointment_type
-                a.app_type AS app_type, -- Buscando app_type diretamente de appointments
-                NULL AS surgery_id, -- Para consultas, o surgery_id é NULL
-                NULL AS surgery_type, -- Para consultas, o surgery_type é NULL
-                a.appointment_id -- Adicionando o appointment_id
-            FROM patients p
-            JOIN appointments a ON p.person_id = a.patient_id
-            JOIN bills b ON a.bill_id = b.bill_id
-            JOIN payments py ON b.bill_id = py.bill_id
-            JOIN doctors d ON a.doctor_id = d.person_id
-            JOIN employees e ON d.person_id = e.person_id
-            WHERE EXTRACT(YEAR FROM py.payment_date) = EXTRACT(YEAR FROM CURRENT_DATE)
-                AND EXTRACT(MONTH FROM py.payment_date) = EXTRACT(MONTH FROM CURRENT_DATE)
-                AND a.app_type IN ('GERAL', 'CARDIOLOGIA', 'DERMATOLOGIA', 'OFTALMOLOGIA', 'PEDIATRIA', 'PSIQUIATRIA', 'REUMATOLOGIA', 'ORTOPEDIA', 'ANESTESIA')
-            
-            UNION ALL
-
-            SELECT 
-                'hospitalization' AS service_type,
-                h.hosp_id AS service_id,
-                h.start_date AS service_date,
-                d.person_id AS doctor_id,
-                e.person_name AS doctor_name,
-                py.payment AS payment_for_service,
-                p.person_id AS patient_id,
-                NULL AS appointment_type, -- Para hospitalizações, o appointment_type é NULL
-                NULL AS app_type, -- Para hospitalizações, o app_type é NULL
-                s.surgery_id, -- ID da cirurgia
-                s.surgery_type, -- Tipo de cirurgia
-                NULL AS appointment_id -- O appointment_id é NULL para hospitalizações
-            FROM patients p
-            JOIN surgeries s ON p.person_id = s.patient_id
-            JOIN hospitalizations h ON s.hosp_id = h.hosp_id
-            JOIN bills b ON h.bill_id = b.bill_id
-            JOIN payments py ON b.bill_id = py.bill_id
-            JOIN doctors d ON s.doctor_id = d.person_id
-            JOIN employees e ON d.person_id = e.person_id
-            WHERE EXTRACT(YEAR FROM py.payment_date) = EXTRACT(YEAR FROM CURRENT_DATE)
-                AND EXTRACT(MONTH FROM py.payment_date) = EXTRACT(MONTH FROM CURRENT_DATE)
-        ) service_details ON p.person_id = service_details.patient_id
-        ORDER BY total_paid DESC;
+            tp.total_paid,
+            sv.service_type,
+            sv.service_id,
+            COALESCE(a.app_date, h.start_date) AS service_date,
+            e.person_id AS doctor_id,
+            e.person_name AS doctor_name,
+            a.app_type,
+            first_surgery.surgery_id,
+            first_surgery.surgery_type,
+            sv.paid AS payment_for_service
+        FROM top_patients tp
+        JOIN patients p ON p.person_id = tp.patient_id
+        JOIN revenue_monthly_services sv ON sv.patient_id = tp.patient_id
+            AND sv.month = date_trunc('month', CURRENT_DATE)::DATE AND sv.paid > 0
+        LEFT JOIN appointments a ON sv.service_type = 'appointment' AND a.appointment_id = sv.service_id
+        LEFT JOIN hospitalizations h ON sv.service_type = 'hospitalization' AND h.hosp_id = sv.service_id
+        LEFT JOIN LATERAL (
+            SELECT s.surgery_id, s.surgery_type, s.doctor_id
+            FROM surgeries s
+            WHERE s.hosp_id = h.hosp_id AND s.patient_id = tp.patient_id
+            ORDER BY s.surgery_id
+            LIMIT 1
+        ) first_surgery ON TRUE
+        JOIN employees e ON e.person_id = COALESCE(a.doctor_id, first_surgery.doctor_id)
+        ORDER BY tp.total_paid DESC, tp.patient_id, service_date, sv.service_type, sv.service_id;
     """
 
     try:
@@ -1797,67 +2282,34 @@ def get_top_clients():
         if result == []:
             raise Exception('No patients found!')
 
+        # Rows come ordered by patient, each service once with its payments of the month
         patients_data = []
-        patients_grouped = {}
-        
-        for row in result:
-            p_name, total_amount, type, *procedure_data = row
-
-            # Get details of the procedure
-            if type == 'appointment':
-                procedure_id = procedure_data[0]
-                procedure_key = tuple(procedure_data[1:])  # Exclude the cost field
-            elif type == 'hospitalization':
-                procedure_id = procedure_data[0]
-                procedure_key = tuple(procedure_data[1:])  # Exclude the cost field
-
-            procedure_cost = procedure_data[-1]
-
-            if p_name not in patients_grouped:
-                patients_grouped[p_name] = {
+        for patient_id, p_name, total_amount, type, procedure_id, date, doctor_id, doctor_name, app_type, surgery_id, surgery_type, procedure_cost in result:
+            if patients_data == [] or patients_data[-1]['patient_id'] != patient_id:
+                patients_data.append({
+                    'patient_id': patient_id,
                     'patient_name': p_name,
                     'total_amount': total_amount,
                     'procedures': []
-                }
-
-            # Verify if the procedure already exists
-            existing_procedure_index = None
-            for index, existing_procedure in enumerate(patients_grouped[p_name]['procedures']):
-                if existing_procedure['id'] == procedure_id:
-                    existing_procedure_index = index
-                    break
-
-            # Procedure already exists, update the cost
-            if existing_procedure_index is not None:
-                patients_grouped[p_name]['procedures'][existing_procedure_index]['cost'] += procedure_cost
+                })
+
+            procedure = {
+                'id': procedure_id,
+                'type': type,
+                'date': date_to_str(date),
+                'doctor_id': doctor_id,
+                'doctor_name': doctor_name
+            }
+            if type == 'appointment':
+                procedure['appointment_type'] = app_type
             else:
-                # If the procedure does not exist, add it
-                if type == 'appointment':
-                    patients_grouped[p_name]['procedures'].append({
-                        'id': procedure_id,
-                        'type': type,
-                        'date': date_to_str(procedure_key[0]),
-                        'doctor_id': procedure_key[1],
-                        'doctor_name': procedure_key[2],
-                        'appointment_type': procedure_key[3],
-                        'cost': procedure_cost
-                    })
-                elif type == 'hospitalization':
-                    patients_grouped[p_name]['procedures'].append({
-                        'id': procedure_id,
-                        'type': type,
-                        'date': date_to_str(procedure_key[0]),
-                        'doctor_id': procedure_key[1],
-                        'doctor_name': procedure_key[2],
-                        'surgery_id': procedure_key[4],
-                        'surgery_type': procedure_key[5],
-                        'cost': procedure_cost
-                    })
-
-        for patient_data in patients_grouped.values():
-            patients_data.append(patient_data)
-        
-        response = {'status': StatusCodes['success'], 'results': patients_data[:3]}
+                procedure['surgery_id'] = surgery_id
+                procedure['surgery_type'] = surgery_type
+            procedure['cost'] = procedure_cost
+
+            patients_data[-1]['procedures'].append(procedure)
+
+        response = {'status': StatusCodes['success'], 'results': patients_data}
 
     except (Exception, psycopg2.DatabaseError) as error:
         # an error occurred, rollback
@@ -1870,7 +2322,7 @@ def get_top_clients():
 
     finally:
         if conn is not None:
-            conn.close()
+            db_pool.putconn(conn)
 
     return flask.jsonify(response)
 
@@ -1879,27 +2331,9 @@ def get_top_clients():
 ##
 ##
 @app.route('/dbproj/daily/<date>', methods=['GET'])
+@requires_auth('assistant', errors='Only assistants can get daily summary')
 def get_daily_summary(date):
     logger.info(f'GET /dbproj/daily/{date}')
-
-    #
-    # Validate Authorization header
-    #
-
-    jwt_token = flask.request.headers.get('Authorization')
-    if not jwt_token:
-        response = {'status': StatusCodes['api_error'], 'errors': 'Authorization header is required!'}
-        return flask.jsonify(response)
-
-    jwt_token = validate_token(jwt_token)
-    if not jwt_token:
-        response = {'status': StatusCodes['api_error'], 'errors': 'Invalid or Expirated token!'}
-        return flask.jsonify(response)
-
-    # Verify if the user is a assistant
-    if jwt_token['user_type'] != user_types['assistant']:
-        response = {'status': StatusCodes['api_error'], 'errors': 'Only assistants can get daily summary'}
-        return flask.jsonify(response)
     
     if not date:
         response = {'status': StatusCodes['api_error'], 'errors': 'Date is required!'}
@@ -1917,18 +2351,18 @@ def get_daily_summary(date):
     # SQL query
     #
 
-    conn = db_connection()
+    conn = db_pool.getconn()
     cur = conn.cursor()
 
     date_str = f"{year}-{month:02d}-{day:02d}" 
 
+    # daily_stats is kept current by triggers, a day without events has no row
     statement = """
-        SELECT 
-            (SELECT COUNT(*) FROM surgeries WHERE surgery_date = %s),
-            (SELECT COALESCE(SUM(payment), 0) FROM payments WHERE payment_date = %s),
-            (SELECT COUNT(*) FROM prescriptions WHERE presc_date = %s);
+        SELECT COALESCE(SUM(surgeries), 0), COALESCE(SUM(amount_spent), 0), COALESCE(SUM(prescriptions), 0)
+        FROM daily_stats
+        WHERE stat_date = %s;
     """
-    values = (date_str, date_str, date_str)
+    values = (date_str, )
 
     try:
         cur.execute(statement, values)
@@ -1957,85 +2391,174 @@ def get_daily_summary(date):
 
     finally:
         if conn is not None:
-            conn.close()
+            db_pool.putconn(conn)
 
     return flask.jsonify(response)
 
 ##
-## See Monthly Report
+##  Get Daily Summary of a date range
 ##
-@app.route('/dbproj/report', methods=['GET'])
-def get_monthly_surgery_report():
-    logger.info('GET /dbproj/report')
-    
+## One result per day from "from" to "to" inclusive, days without events have zeros.
+##
+## GET http://localhost:8080/dbproj/daily?from=2024-05-01&to=2024-05-31
+##
+@app.route('/dbproj/daily', methods=['GET'])
+@requires_auth('assistant', errors='Only assistants can get daily summary')
+def get_daily_summary_range():
+    logger.info('GET /dbproj/daily')
+
+    args = flask.request.args
+
     #
-    # Validate Authorization header
+    # Validate arguments.
     #
 
-    jwt_token = flask.request.headers.get('Authorization')
-    if not jwt_token:
-        response = {'status': StatusCodes['api_error'], 'errors': 'Authorization header is required!'}
-        return flask.jsonify(response)
+    for field in ['from', 'to']:
+        if field not in args:
+            response = {'status': StatusCodes['api_error'], 'errors': f'{field} value not in arguments'}
+            return flask.jsonify(response)
+
+        if not validate_date_format(args[field]):
+            response = {'status': StatusCodes['api_error'], 'errors': f'Invalid date format: {args[field]}'}
+            return flask.jsonify(response)
+
+    start = datetime.strptime(args['from'], '%Y-%m-%d').date()
+    end = datetime.strptime(args['to'], '%Y-%m-%d').date()
 
-    jwt_token = validate_token(jwt_token)
-    if not jwt_token:
-        response = {'status': StatusCodes['api_error'], 'errors': 'Invalid or Expirated token!'}
+    if start > end:
+        response = {'status': StatusCodes['api_error'], 'errors': 'from must not be after to'}
         return flask.jsonify(response)
 
-    # Verify if the user is a assistant
-    if jwt_token['user_type'] != user_types['assistant']:
-        response = {'status': StatusCodes['api_error'], 'errors': 'Only assistants can schedule appointments!'}
+    if (end - start).days >= MAX_DAILY_RANGE_DAYS:
+        response = {'status': StatusCodes['api_error'], 'errors': f'Date range cannot be longer than {MAX_DAILY_RANGE_DAYS} days'}
         return flask.jsonify(response)
 
     #
     # SQL query
-    #    
-    conn = db_connection()
+    #
+
+    conn = db_pool.getconn()
     cur = conn.cursor()
 
-    # Query to get the number of surgeries per doctor in the last 12 months
+    # One range scan of the daily_stats primary key, joined to the calendar to fill the days without events
     statement = """
-        SELECT dms.surgery_month, dms.doctor_name, dms.num_surgeries
-        FROM (
-            SELECT to_char(s.surgery_date, 'YYYY-MM') AS surgery_month, e.person_name AS doctor_name, COUNT(s.surgery_id) AS num_surgeries
-            FROM surgeries AS s
-            JOIN employees AS e ON s.doctor_id = e.person_id
-            WHERE s.surgery_date >= date_trunc('month', CURRENT_DATE) - INTERVAL '12 months'
-                AND s.surgery_date < date_trunc('month', CURRENT_DATE) + INTERVAL '1 month'
-            GROUP BY to_char(s.surgery_date, 'YYYY-MM'), e.person_name
-        ) dms
-        JOIN (
-            SELECT surgery_month, MAX(num_surgeries) AS max_surgeries
-            FROM (
-                SELECT to_char(s.surgery_date, 'YYYY-MM') AS surgery_month, e.person_name AS doctor_name, COUNT(s.surgery_id) AS num_surgeries
-                FROM surgeries AS s
-                JOIN employees AS e ON s.doctor_id = e.person_id
-                WHERE s.surgery_date >= date_trunc('month', CURRENT_DATE) - INTERVAL '12 months'
-                    AND s.surgery_date < date_trunc('month', CURRENT_DATE) + INTERVAL '1 month'
-                GROUP BY to_char(s.surgery_date, 'YYYY-MM'), e.person_name
-            ) inner_query
-            GROUP BY surgery_month
-        ) max_surgeries ON dms.surgery_month = max_surgeries.surgery_month AND dms.num_surgeries = max_surgeries.max_surgeries
-        ORDER BY dms.surgery_month;
+        SELECT days.day::DATE, COALESCE(ds.surgeries, 0), COALESCE(ds.amount_spent, 0), COALESCE(ds.prescriptions, 0)
+        FROM generate_series(%s::DATE, %s::DATE, INTERVAL '1 day') AS days(day)
+        LEFT JOIN (
+            SELECT stat_date, surgeries, amount_spent, prescriptions
+            FROM daily_stats
+            WHERE stat_date BETWEEN %s AND %s
+        ) AS ds ON ds.stat_date = days.day::DATE
+        ORDER BY days.day;
     """
+    values = (start, end, start, end)
 
     try:
-        cur.execute(statement)
+        cur.execute(statement, values)
         rows = cur.fetchall()
 
-        logger.debug('GET /dbproj/report - parse')
+        results = [
+            {
+                'date': row[0].isoformat(),
+                'amount_spent': row[2],
+                'surgeries': row[1],
+                'prescriptions': row[3]
+            } for row in rows
+        ]
 
-        results = []
-        for row in rows:
-            logger.debug(row)
+        response = {'status': StatusCodes['success'], 'results': results}
 
-            content = {
-                'month': row[0],
-                'doctor_name': row[1],
-                'num_surgeries': row[2]
-            }
+    except (Exception, psycopg2.DatabaseError) as error:
+        # an error occurred, rollback
+        conn.rollback()
+
+        logger.error(f'GET dbproj/daily - error: {error}')
+
+        error = str(error).split('\n')[0]
+        response = {'status': StatusCodes['internal_error'], 'errors': error, 'results': None}
+
+    finally:
+        if conn is not None:
+            db_pool.putconn(conn)
+
+    return flask.jsonify(response)
+
+##
+## See Monthly Report
+##
+## Doctors with the most surgeries in each month of the window, from the current month back "months" months.
+##
+## GET http://localhost:8080/dbproj/report?months=12&top=3, add stream=json or stream=ndjson to stream the report
+##
+@app.route('/dbproj/report', methods=['GET'])
+@requires_auth('assistant', errors='Only assistants can schedule appointments!')
+def get_monthly_surgery_report():
+    logger.info('GET /dbproj/report')
+
+    #
+    # SQL query
+    #    
+
+    args = flask.request.args
+
+    #
+    # Validate arguments.
+    #
+
+    # months: how many months before the current one are reported, top: doctors ranked per month
+    limits = {}
+    for field, default, maximum in [('months', 12, MAX_REPORT_MONTHS), ('top', 1, MAX_REPORT_TOP)]:
+        value = args.get(field, str(default))
+        if not value.isdigit() or not 1 <= int(value) <= maximum:
+            response = {'status': StatusCodes['api_error'], 'errors': f'{field} must be between 1 and {maximum}'}
+            return flask.jsonify(response)
+        limits[field] = int(value)
+
+    #
+    # SQL query
+    #
+
+    # Query to get the doctors with the most surgeries of each month in the window, read from surgery_counts_monthly
+    # (kept current by the surgeries trigger) with one range scan of surgery_counts_monthly_month_idx.
+    # Doctors tied for a place share it, so a month can have more than "top" doctors.
+    statement = """
+        SELECT to_char(ranked.month, 'YYYY-MM'), ranked.doctor_id, e.person_name, ranked.num_surgeries, ranked.surgery_rank
+        FROM (
+            SELECT sc.month, sc.doctor_id, sc.num_surgeries,
+                   RANK() OVER (PARTITION BY sc.month ORDER BY sc.num_surgeries DESC) AS surgery_rank
+            FROM surgery_counts_monthly AS sc
+            WHERE sc.month >= (date_trunc('month', CURRENT_DATE) - make_interval(months => %s))::DATE
+                AND sc.month <= date_trunc('month', CURRENT_DATE)::DATE
+                AND sc.num_surgeries > 0
+        ) AS ranked
+        JOIN employees AS e ON e.person_id = ranked.doctor_id
+        WHERE ranked.surgery_rank <= %s
+        ORDER BY ranked.month, ranked.surgery_rank, ranked.doctor_id;
+    """
+    values = (limits['months'], limits['top'])
+
+    def report_to_json(row):
+        return {
+            'month': row[0],
+            'doctor_id': row[1],
+            'doctor_name': row[2],
+            'num_surgeries': row[3],
+            'rank': row[4]
+        }
+
+    if 'stream' in flask.request.args:
+        return stream_query('GET /dbproj/report', statement, values, report_to_json, key='report', empty_error='No surgeries found!')
+
+    conn = db_pool.getconn()
+    cur = conn.cursor()
+
+    try:
+        cur.execute(statement, values)
+        rows = cur.fetchall()
+
+        logger.debug('GET /dbproj/report - parse')
 
-            results.append(content)
+        results = [report_to_json(row) for row in rows]
         
         if results == []:
             raise Exception('No surgeries found!')
@@ -2048,16 +2571,89 @@ def get_monthly_surgery_report():
 
     finally:
         if conn is not None:
-            conn.close()
+            db_pool.putconn(conn)
 
     return flask.jsonify(response)
 
+##
+## Server Statistics
+##
+## GET http://localhost:8080/dbproj/stats
+##
+##
+@app.route('/dbproj/stats', methods=['GET'])
+@requires_auth('assistant', errors='Only assistants can see server statistics!')
+def get_server_stats():
+    logger.info('GET /dbproj/stats')
+
+    results = {
+        'pool': db_pool.stats(),
+        'token_cache': token_cache.stats(),
+        'password_hashing': password_hasher.stats(),
+        'reference_data': reference_data.stats(),
+        'booking_calendar': booking_calendar.stats(),
+        'change_feed': change_feed.stats(),
+        'transaction_retries': retry_stats(),
+        'revoked_tokens': len(revoked_tokens)
+    }
+
+    response = {'status': StatusCodes['success'], 'results': results}
+
+    return flask.jsonify(response)
+
+##
+## Issue Token
+##
+## Tokens are signed with the active key of the shared keyset and carry its id in the
+## "kid" header, so any worker on any node can verify them.
+##
+## Every token expires after TOKEN_LIFETIME seconds and has a unique "jti" so it can be revoked.
+##
+def issue_token(jwt_payload):
+    key_id, key = signing_key()
+
+    now = int(time.time())
+    jwt_payload = {
+        **jwt_payload,
+        'iat': now,
+        'exp': now + settings.current.token_lifetime,
+        'jti': secrets.token_urlsafe(12)
+    }
+    return jwt.encode(jwt_payload, key, algorithm='HS256', headers={'kid': key_id})
+
+def signing_key():
+    current = settings.current
+    if not current.jwt_keys:
+        return 'ephemeral', ephemeral_key
+    return current.jwt_active_key_id, current.jwt_key(current.jwt_active_key_id)
+
+def verification_key(key_id):
+    current = settings.current
+    if not current.jwt_keys:
+        return ephemeral_key if key_id == 'ephemeral' else None
+    return current.jwt_key(key_id)
+
 ##
 ## Validate Token
 ##
+## Verified tokens are cached until they expire, so the signature is only checked
+## on the first request made with each token.
+##
 def validate_token(jwt_token):
+    decoded_token = token_cache.get(jwt_token)
+    if decoded_token is not None:
+        return None if decoded_token['jti'] in revoked_tokens else decoded_token
+
     try:
-        decoded_token = jwt.decode(jwt_token, secret_key, algorithms=['HS256'])
+        key = verification_key(jwt.get_unverified_header(jwt_token).get('kid'))
+        if key is None:
+            return None
+
+        decoded_token = jwt.decode(jwt_token, key, algorithms=['HS256'], options={'require': ['exp', 'iat', 'jti']})
+        if decoded_token['jti'] in revoked_tokens:
+            return None
+
+        token_cache.put(jwt_token, decoded_token)
         return decoded_token
     except jwt.ExpiredSignatureError:
         return None
@@ -2065,12 +2661,109 @@ def validate_token(jwt_token):
         return None
     
 
+##
+## Streamed response of a read endpoint for ?stream=json or ?stream=ndjson, see streaming.py.
+## The pooled connection is held until the whole body is sent or the response is closed. An error of the query, or
+## "empty_error" when it has no rows, is returned as a normal response. "etag" is only
+## sent with a stream that started.
+##
+def stream_query(endpoint, statement, values, to_json, key='results', empty_error=None, etag=None):
+    stream_format = flask.request.args['stream']
+    if stream_format not in STREAM_FORMATS:
+        response = {'status': StatusCodes['api_error'], 'errors': f'Invalid stream {stream_format}, must be json or ndjson'}
+        return flask.jsonify(response)
+
+    logger.debug(f'{endpoint} - streaming {stream_format}')
+
+    conn = db_pool.getconn()
+
+    try:
+        stream, first_rows = open_stream(conn, statement, values, settings.current.stream_itersize, db_pool.putconn)
+        if first_rows == [] and empty_error is not None:
+            raise Exception(empty_error)
+
+    except (Exception, psycopg2.DatabaseError) as error:
+        conn.rollback()
+        db_pool.putconn(conn)
+
+        logger.error(f'{endpoint} - error: {error}')
+
+        error = str(error).split('\n')[0]
+        response = {'status': StatusCodes['internal_error'], 'errors': error, 'results': None}
+        return flask.jsonify(response)
+
+    try:
+        body = stream_body(stream, first_rows, to_json, app.json.dumps, stream_format, key, StatusCodes)
+        response = flask.Response(body, mimetype=STREAM_FORMATS[stream_format])
+
+        # Closing the response releases the connection even if the body was never iterated
+        response.call_on_close(stream.close)
+        return tag_response(response, etag)
+    except BaseException:
+        stream.close()
+        raise
+
+##
+## ETag of a read endpoint over the data of one patient.
+##
+## patient_versions holds a counter per patient, bumped by triggers whenever one of their
+## appointments, surgeries or prescriptions changes (db_functions.sql). The ETag is the
+## version plus a hash of the request path and arguments and of the current date, which
+## "active_only" depends on. Returns None when the version cannot be read, the request
+## is then answered without an ETag.
+##
+def patient_etag(patient_id):
+    conn = db_pool.getconn()
+    cur = conn.cursor()
+
+    statement = """
+        SELECT COALESCE((SELECT version FROM patient_versions WHERE patient_id = %s), 0), CURRENT_DATE;
+    """
+    values = (patient_id, )
+
+    try:
+        cur.execute(statement, values)
+        version, today = cur.fetchone()
+        conn.rollback()
+    except (Exception, psycopg2.DatabaseError) as error:
+        conn.rollback()
+        logger.error(f'patient_etag({patient_id}) - error: {error}')
+        return None
+
+    finally:
+        db_pool.putconn(conn)
+
+    digest = hashlib.sha1(f'{flask.request.full_path}|{today}'.encode()).hexdigest()[:16]
+    return f'{patient_id}-{version}-{digest}'
+
+##
+## 304 Not Modified when the client already has the response tagged "etag", None otherwise
+##
+def not_modified(etag):
+    if etag is None or not flask.request.if_none_match.contains(etag):
+        return None
+
+    response = flask.Response(status=304)
+    return tag_response(response, etag)
+
+##
+## Clients may keep the response but must revalidate it with If-None-Match before using it
+##
+def tag_response(response, etag):
+    if etag is not None:
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
 ##
 ## Validate Date Format
 ##
 def validate_date_format(date_string):
-    year, month, day = date_string.split('-')
-    year, month, day = int(year), int(month), int(day)
+    try:
+        year, month, day = date_string.split('-')
+        year, month, day = int(year), int(month), int(day)
+    except ValueError:
+        return False
 
     # Check if the date is valid
     if not (1 <= month <= 12 and 1 <= day <= 31):
@@ -2083,25 +2776,54 @@ def validate_date_format(date_string):
     except ValueError:
         return False
     
+##
+## Appointments (BatchAppointment) whose slot is already taken in the booking calendar: {index: error}
+##
+def calendar_conflicts(appointments):
+    conflicts = {}
+    for appointment in appointments:
+        conflict = booking_calendar.find_conflict(
+            appointment.resources, appointment.date, appointment.hour, appointment.minutes, APPOINTMENT_DURATION
+        )
+        if conflict is not None:
+            conflicts[appointment.index] = f'{describe_resource(conflict)} is already booked at this time!'
+
+    return conflicts
+
 def date_to_str(d):
     if isinstance(d, datetime):
         return d.isoformat()
     return d
     
     
-if __name__ == '__main__':
-    # set up logging
+def setup_logging(level=logging.DEBUG):
     logging.basicConfig(filename='log_file.log')
-    logger = logging.getLogger('logger')
-    logger.setLevel(logging.DEBUG)
+    logger.setLevel(level)
     ch = logging.StreamHandler()
-    ch.setLevel(logging.DEBUG)
+    ch.setLevel(level)
 
     # create formatter
-    formatter = logging.Formatter('%(asctime)s [%(levelname)s]:  %(message)s', '%H:%M:%S')
+    formatter = logging.Formatter('%(asctime)s [%(process)d] [%(levelname)s]:  %(message)s', '%H:%M:%S')
     ch.setFormatter(formatter)
     logger.addHandler(ch)
 
+
+if __name__ == '__main__':
+    # set up logging
+    setup_logging()
+
+    if not settings.current.jwt_keys:
+        logger.warning('No JWT_KEY_<id> configured, tokens are signed with a per-process key')
+
+    # Reload the .env settings on SIGHUP without restarting the server
+    if hasattr(signal, 'SIGHUP'):
+        signal.signal(signal.SIGHUP, reload_settings)
+
+    # Open the minimum number of pooled connections before serving requests
+    db_pool.open()
+    start_revocation_sync()
+    change_feed.start()
+
     host = '127.0.0.1'
     port = 8080
     app.run(host=host, debug=True, threaded=True, port=port)
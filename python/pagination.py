@@ -0,0 +1,51 @@
+import base64
+import hashlib
+import json
+
+
+class InvalidPageToken(Exception):
+    pass
+
+
+##########################################################
+## KEYSET PAGINATION
+##########################################################
+
+##
+## Page tokens hold the sort key of the last row of a page, the next page starts after it:
+##     WHERE (sort columns) > (key) ORDER BY sort columns LIMIT n
+## so every page costs one index range scan, however deep it is.
+## The token is opaque to clients, only values JSON can hold are accepted in a key.
+## It also holds a digest of the filters of the query ("filters", a dict of the arguments
+## that select the rows): a token used with other filters would skip or repeat rows, so
+## decode_page_token rejects it.
+##
+def filters_digest(filters):
+    return hashlib.sha256(json.dumps(filters, sort_keys=True, separators=(',', ':')).encode()).hexdigest()[:16]
+
+def encode_page_token(key, filters=None):
+    token = {'key': key, 'filters': filters_digest(filters)}
+    return base64.urlsafe_b64encode(json.dumps(token, separators=(',', ':')).encode()).decode().rstrip('=')
+
+def decode_page_token(token, length, filters=None):
+    try:
+        decoded = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+    except ValueError:
+        raise InvalidPageToken(f'Invalid page_token: {token}')
+
+    if not isinstance(decoded, dict) or not isinstance(decoded.get('key'), list) or len(decoded['key']) != length:
+        raise InvalidPageToken(f'Invalid page_token: {token}')
+
+    if decoded.get('filters') != filters_digest(filters):
+        raise InvalidPageToken('page_token does not match the filters of the query')
+    return decoded['key']
+
+#
+# Page size from the "limit" argument
+#
+def page_limit(value, default, maximum):
+    if value is None:
+        return default
+    if not value.isdigit() or not 1 <= int(value) <= maximum:
+        raise ValueError(f'limit must be between 1 and {maximum}')
+    return int(value)
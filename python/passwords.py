@@ -0,0 +1,158 @@
+import base64
+import concurrent.futures
+import hashlib
+import hmac
+import secrets
+import threading
+import time
+
+##########################################################
+## PASSWORD HASHING
+##########################################################
+
+#
+# scrypt parameters of new hashes, stored in every hash so they can be raised later
+#
+SCRYPT_N = 2 ** 14
+SCRYPT_R = 8
+SCRYPT_P = 1
+SALT_SIZE = 16
+HASH_SIZE = 32
+
+HASH_PREFIX = 'scrypt$'
+
+##
+## Hash a password with a random salt: scrypt$<n>$<r>$<p>$<salt>$<hash>
+##
+def hash_password(password):
+    salt = secrets.token_bytes(SALT_SIZE)
+    digest = _scrypt(password, salt, SCRYPT_N, SCRYPT_R, SCRYPT_P)
+
+    return '$'.join([
+        'scrypt', str(SCRYPT_N), str(SCRYPT_R), str(SCRYPT_P),
+        base64.b64encode(salt).decode(), base64.b64encode(digest).decode()
+    ])
+
+def verify_password(password, stored_hash):
+    try:
+        _, n, r, p, salt, digest = stored_hash.split('$')
+        salt, digest = base64.b64decode(salt), base64.b64decode(digest)
+        n, r, p = int(n), int(r), int(p)
+    except ValueError:
+        return False
+
+    return hmac.compare_digest(_scrypt(password, salt, n, r, p, len(digest)), digest)
+
+##
+## Passwords stored before hashing was introduced were encrypted in the database
+## with encrypt(password, key) and have to be checked with decrypt() instead
+##
+def is_legacy_password(stored_hash):
+    return not stored_hash.startswith(HASH_PREFIX)
+
+def _scrypt(password, salt, n, r, p, size=HASH_SIZE):
+    return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p, maxmem=128 * n * r * p * 2, dklen=size)
+
+
+class HashingBusy(Exception):
+    pass
+
+
+##########################################################
+## HASHING EXECUTOR
+##########################################################
+
+##
+## Runs password hashing and verification on a fixed number of threads.
+##
+## At most "max_workers + max_queue" calls are accepted at once, further calls fail
+## right away with HashingBusy instead of piling up behind a registration burst or a
+## credential stuffing spike. scrypt releases the GIL, so the request threads keep
+## serving the cheap endpoints while the hashes are computed.
+##
+class PasswordHasher:
+    def __init__(self, max_workers=2, max_queue=32, timeout=10.0):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.timeout = timeout
+
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='password-hasher')
+        self._slots = threading.BoundedSemaphore(max_workers + max_queue)
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._dummy_hash = None
+        self._counters = {
+            'hash_calls': 0,
+            'verify_calls': 0,
+            'rejected': 0,
+            'timeouts': 0,
+            'queue_time': 0.0,
+            'run_time': 0.0,
+            'max_run_time': 0.0
+        }
+
+    def hash(self, password):
+        return self._run('hash_calls', hash_password, password)
+
+    def verify(self, password, stored_hash):
+        return self._run('verify_calls', verify_password, password, stored_hash)
+
+    ##
+    ## Same work as verify() for a username that does not exist, so the response time
+    ## does not tell which accounts exist. Always False.
+    ##
+    def verify_unknown(self, password):
+        if self._dummy_hash is None:
+            self._dummy_hash = self.hash(secrets.token_hex(16))
+
+        self.verify(password, self._dummy_hash)
+        return False
+
+    def stats(self):
+        with self._lock:
+            calls = self._counters['hash_calls'] + self._counters['verify_calls']
+            return {
+                'max_workers': self.max_workers,
+                'max_queue': self.max_queue,
+                'pending': self._pending,
+                'avg_run_time': self._counters['run_time'] / calls if calls else 0.0,
+                **self._counters
+            }
+
+    def _run(self, counter, function, *args):
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self._counters['rejected'] += 1
+            raise HashingBusy('Server is busy, try again later!')
+
+        with self._lock:
+            self._pending += 1
+
+        submitted = time.perf_counter()
+
+        def timed():
+            started = time.perf_counter()
+            try:
+                return function(*args)
+            finally:
+                finished = time.perf_counter()
+                with self._lock:
+                    self._counters[counter] += 1
+                    self._counters['queue_time'] += started - submitted
+                    self._counters['run_time'] += finished - started
+                    self._counters['max_run_time'] = max(self._counters['max_run_time'], finished - started)
+
+        def release(_):
+            with self._lock:
+                self._pending -= 1
+            self._slots.release()
+
+        future = self._executor.submit(timed)
+        future.add_done_callback(release)
+
+        try:
+            return future.result(timeout=self.timeout)
+        except concurrent.futures.TimeoutError:
+            with self._lock:
+                self._counters['timeouts'] += 1
+            raise HashingBusy('Server is busy, try again later!')
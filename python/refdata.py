@@ -0,0 +1,190 @@
+from dataclasses import dataclass
+import datetime
+import threading
+
+
+##########################################################
+## REFERENCE DATA CACHE
+##########################################################
+
+#
+# Cached tables: table -> (key columns, value column)
+#
+REFERENCE_TABLES = {
+    'roles': (('role', 'role_type'), 'role_id'),
+    'nurse_categories': (('category',), 'category_id'),
+    'specialisations': (('spec_id',), 'specialization'),
+    'sub_specialisations': (('sub_spec_id',), 'sub_spec'),
+    'medicines': (('medication',), 'medication_id'),
+    'posologies': (('dosage', 'frequency'), 'posology_id')
+}
+
+NOTIFY_CHANNEL = 'reference_data'  # pg_notify() channel of the notify_reference_data trigger
+DOCTORS_CHANNEL = 'doctor_capabilities'  # pg_notify() channel of the notify_doctor_capabilities trigger, payload is the doctor id
+
+##
+## In-memory copy of the small lookup tables used by the write endpoints and of the
+## capabilities of every doctor.
+##
+## Subscribed to the change feed on NOTIFY_CHANNEL and DOCTORS_CHANNEL, a table or a
+## doctor is reloaded whenever a transaction that changed it commits, in this process
+## and in every other worker.
+## get() only answers from memory: None means "not cached", never "does not exist",
+## so callers fall back to the database and a row created a moment ago is never missed.
+## While the change feed is disconnected the cache is empty and every lookup is a miss.
+##
+class ReferenceData:
+    channels = (NOTIFY_CHANNEL, DOCTORS_CHANNEL)
+
+    def __init__(self):
+        self._tables = {}  # table -> {key: value}, key is a tuple for multi-column keys
+        self._doctors = {}  # doctor_id -> DoctorCapabilities
+        self._lock = threading.Lock()
+        self._counters = {'hits': 0, 'misses': 0, 'reloads': 0, 'notifications': 0}
+
+    def get(self, table, key):
+        with self._lock:
+            value = self._tables.get(table, {}).get(key)
+            self._counters['hits' if value is not None else 'misses'] += 1
+            return value
+
+    #
+    # Capabilities of a doctor, read with "cur" without being cached when the doctor is not in memory
+    #
+    def doctor(self, doctor_id, cur=None):
+        try:
+            doctor_id = int(doctor_id)
+        except (TypeError, ValueError):
+            return None
+
+        return self.doctors([doctor_id], cur).get(doctor_id)
+
+    #
+    # Capabilities of many doctors: {doctor_id: DoctorCapabilities}, the doctors not in memory are read in one query
+    #
+    def doctors(self, doctor_ids, cur=None):
+        with self._lock:
+            found = {doctor_id: self._doctors[doctor_id] for doctor_id in doctor_ids if doctor_id in self._doctors}
+            self._counters['hits'] += len(found)
+            self._counters['misses'] += len(set(doctor_ids)) - len(found)
+
+        missing = [doctor_id for doctor_id in set(doctor_ids) if doctor_id not in found]
+        if missing and cur is not None:
+            found.update(load_doctor_capabilities(cur, missing))
+        return found
+
+    def clear(self):
+        with self._lock:
+            self._tables.clear()
+            self._doctors.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'tables': {table: len(rows) for table, rows in self._tables.items()},
+                'doctors': len(self._doctors),
+                **self._counters
+            }
+
+    def reload(self, conn, tables=REFERENCE_TABLES):
+        for table in tables:
+            key_columns, value_column = REFERENCE_TABLES[table]
+
+            with conn.cursor() as cur:
+                cur.execute(f'SELECT {", ".join(key_columns)}, {value_column} FROM {table};')
+                rows = cur.fetchall()
+
+            if len(key_columns) == 1:
+                entries = {row[0]: row[1] for row in rows}
+            else:
+                entries = {tuple(row[:-1]): row[-1] for row in rows}
+
+            with self._lock:
+                self._tables[table] = entries
+                self._counters['reloads'] += 1
+
+    def reload_doctors(self, conn, doctor_ids=None):
+        with conn.cursor() as cur:
+            doctors = load_doctor_capabilities(cur, doctor_ids)
+
+        with self._lock:
+            if doctor_ids is None:
+                self._doctors = doctors
+            else:
+                for doctor_id in doctor_ids:
+                    self._doctors.pop(doctor_id, None)
+                self._doctors.update(doctors)
+            self._counters['reloads'] += 1
+
+    def on_connect(self, conn):
+        self.reload(conn)
+        self.reload_doctors(conn)
+
+    def on_notify(self, conn, notifies):
+        tables, doctors = set(), set()
+        for notify in notifies:
+            if notify.channel == DOCTORS_CHANNEL:
+                doctors.add(int(notify.payload))
+            elif notify.payload in REFERENCE_TABLES:
+                tables.add(notify.payload)
+
+        with self._lock:
+            self._counters['notifications'] += len(notifies)
+
+        self.reload(conn, tables)
+        if doctors:
+            self.reload_doctors(conn, list(doctors))
+
+##########################################################
+## DOCTOR CAPABILITIES
+##########################################################
+
+@dataclass(frozen=True)
+class DoctorCapabilities:
+    specialisations: frozenset
+    sub_specialisations: frozenset
+    license_start: datetime.date
+    license_end: datetime.date
+
+    def is_licensed(self, date):
+        return self.license_start <= date <= self.license_end
+
+    #
+    # Appointments of type GERAL are taken by doctors without specialisation, the other types by doctors
+    # with that specialisation. Surgeries need the CIRURGIA specialisation and the type as sub-specialisation.
+    #
+    def can_perform(self, event, event_type):
+        if event == 'surgery':
+            return 'CIRURGIA' in self.specialisations and event_type in self.sub_specialisations
+        if event_type == 'GERAL':
+            return not self.specialisations
+        return event_type in self.specialisations
+
+##
+## Read the capabilities of the given doctors, or of every doctor: {doctor_id: DoctorCapabilities}
+##
+def load_doctor_capabilities(cur, doctor_ids=None):
+    statement = """
+        SELECT d.person_id, d.ml_issue_date, d.ml_expiration_date,
+               ARRAY(
+                   SELECT s.specialization
+                   FROM specialisations_doctors AS sd
+                   JOIN specialisations AS s ON s.spec_id = sd.spec_id
+                   WHERE sd.doctor_id = d.person_id
+               ),
+               ARRAY(
+                   SELECT ss.sub_spec
+                   FROM sub_specialisations_doctors AS ssd
+                   JOIN sub_specialisations AS ss ON ss.sub_spec_id = ssd.sub_spec_id
+                   WHERE ssd.doctor_id = d.person_id
+               )
+        FROM doctors AS d
+        WHERE %s::INTEGER[] IS NULL OR d.person_id = ANY(%s::INTEGER[]);
+    """
+    values = (doctor_ids, doctor_ids)
+    cur.execute(statement, values)
+
+    return {
+        doctor_id: DoctorCapabilities(frozenset(specialisations), frozenset(sub_specialisations), issue_date, expiration_date)
+        for doctor_id, issue_date, expiration_date, specialisations, sub_specialisations in cur.fetchall()
+    }
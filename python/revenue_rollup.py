@@ -0,0 +1,94 @@
+##
+## Maintenance of the monthly revenue rollup (revenue_monthly, revenue_monthly_services):
+##
+##  python revenue_rollup.py rebuild [--from 2024-05-01]
+##  python revenue_rollup.py check
+##
+## The payments trigger keeps the rollup current, rebuild fills it from the payments table
+## (after installing it on a database that already has payments, or to repair it) and
+## check compares it with a full recomputation, exiting with status 1 when they differ.
+##
+from settings import SettingsError, load_settings
+import argparse
+import psycopg2
+import sys
+
+
+def connect(path='.env'):
+    db_settings = load_settings(path).database
+
+    return psycopg2.connect(
+        user=db_settings.user,
+        password=db_settings.password,
+        host=db_settings.host,
+        port=db_settings.port,
+        database=db_settings.database
+    )
+
+##
+## Rebuild the months since "from_month" (every month when None), new payments wait until it commits
+##
+def rebuild(conn, from_month=None):
+    with conn.cursor() as cur:
+        cur.execute('SELECT rebuild_revenue_rollup(%s::DATE);', (from_month, ))
+        rows = cur.fetchone()[0]
+    conn.commit()
+
+    return rows
+
+##
+## Rows of the rollup that differ from the payments:
+## (patient_id, month, service_type, service_id, rollup_paid, expected_paid)
+##
+def check(conn):
+    with conn.cursor() as cur:
+        cur.execute('SELECT * FROM check_revenue_rollup();')
+        mismatches = cur.fetchall()
+    conn.rollback()
+
+    return mismatches
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Monthly revenue rollup maintenance')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    rebuild_parser = commands.add_parser('rebuild', help='recompute the rollup from the payments')
+    rebuild_parser.add_argument('--from', dest='from_month', metavar='YYYY-MM-DD', help='first month to rebuild, every month by default')
+    commands.add_parser('check', help='compare the rollup with the payments')
+
+    parser.add_argument('--env', default='.env', help='settings file with the database credentials')
+    args = parser.parse_args(argv)
+
+    try:
+        conn = connect(args.env)
+    except (SettingsError, psycopg2.Error) as error:
+        print(f'Cannot connect to the database: {error}', file=sys.stderr)
+        return 2
+
+    try:
+        if args.command == 'rebuild':
+            rows = rebuild(conn, args.from_month)
+            print(f'Revenue rollup rebuilt, {rows} service rows')
+            return 0
+
+        mismatches = check(conn)
+        for patient_id, month, service_type, service_id, rollup_paid, expected_paid in mismatches:
+            if service_type is None:
+                print(f'patient {patient_id} {month:%Y-%m} total: rollup {rollup_paid}, sum of its services {expected_paid}')
+            else:
+                print(f'patient {patient_id} {month:%Y-%m} {service_type} {service_id}: rollup {rollup_paid}, payments {expected_paid}')
+
+        print(f'{len(mismatches)} mismatches')
+        return 1 if mismatches else 0
+
+    except psycopg2.Error as error:
+        print(f'{args.command} failed: {str(error).splitlines()[0]}', file=sys.stderr)
+        return 2
+
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
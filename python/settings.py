@@ -0,0 +1,193 @@
+from cryptography.fernet import Fernet, InvalidToken
+from dataclasses import dataclass
+from dotenv import dotenv_values
+import logging
+import threading
+
+logger = logging.getLogger('logger')
+
+
+class SettingsError(Exception):
+    pass
+
+
+##########################################################
+## SETTINGS
+##########################################################
+
+@dataclass(frozen=True)
+class DatabaseSettings:
+    user: str
+    password: str
+    host: str
+    port: int
+    database: str
+
+
+@dataclass(frozen=True)
+class Settings:
+    database: DatabaseSettings
+    pool_min_size: int
+    pool_max_size: int
+    pool_timeout: float
+    pool_check_interval: float
+    jwt_keys: tuple  # (key_id, secret) pairs, from the JWT_KEY_<key_id> values
+    jwt_active_key_id: str
+    token_lifetime: int
+    token_cache_size: int
+    revocation_sync_interval: float
+    hash_workers: int
+    hash_queue_size: int
+    hash_timeout: float
+    room_policy: str
+    booking_calendar: bool
+    booking_retries: int
+    booking_retry_delay: float
+    stream_itersize: int
+
+    def jwt_key(self, key_id):
+        for kid, secret in self.jwt_keys:
+            if kid == key_id:
+                return secret
+        return None
+
+
+##
+## Read the .env file and decrypt the database credentials.
+##
+## Encrypted values are stored as the repr of the Fernet token (b'gAAAA...'),
+## the wrapper is stripped instead of being evaluated.
+##
+def load_settings(path='.env'):
+    env_vars = dotenv_values(path)
+
+    if 'KEY' not in env_vars or not env_vars['KEY']:
+        raise SettingsError(f'KEY value not in {path}')
+
+    try:
+        cipher_suite = Fernet(env_vars['KEY'].encode())
+    except ValueError as error:
+        raise SettingsError(f'Invalid KEY in {path}: {error}')
+
+    def decrypt(name):
+        value = env_vars.get(name)
+        if not value:
+            raise SettingsError(f'{name} value not in {path}')
+
+        token = value.strip()
+        if token[:2] in ("b'", 'b"') and token[-1:] == token[1]:
+            token = token[2:-1]
+
+        try:
+            return cipher_suite.decrypt(token.encode()).decode()
+        except InvalidToken:
+            raise SettingsError(f'{name} value in {path} could not be decrypted with KEY')
+
+    def number(name, cast, default, minimum):
+        value = env_vars.get(name)
+        if value is None or value == '':
+            return default
+
+        try:
+            value = cast(value)
+        except ValueError:
+            raise SettingsError(f'{name} must be a number, got {env_vars[name]!r}')
+
+        if value < minimum:
+            raise SettingsError(f'{name} must be at least {minimum}, got {value}')
+        return value
+
+    port = decrypt('PORT')
+    if not port.isdigit() or not 1 <= int(port) <= 65535:
+        raise SettingsError(f'PORT must be between 1 and 65535, got {port!r}')
+
+    database = DatabaseSettings(
+        user=decrypt('USER'),
+        password=decrypt('PASSWORD'),
+        host=decrypt('HOST'),
+        port=int(port),
+        database=decrypt('DATABASE')
+    )
+
+    # JWT signing keys shared by every worker, rotated by adding a new JWT_KEY_<id> and
+    # pointing JWT_ACTIVE_KEY at it while the old key still verifies issued tokens
+    jwt_keys = []
+    for name in sorted(env_vars):
+        if name.startswith('JWT_KEY_') and len(name) > len('JWT_KEY_'):
+            secret = decrypt(name)
+            if len(secret) < 32:
+                raise SettingsError(f'{name} must be at least 32 characters long')
+            jwt_keys.append((name[len('JWT_KEY_'):], secret))
+
+    jwt_active_key_id = env_vars.get('JWT_ACTIVE_KEY') or ''
+    if jwt_keys and jwt_active_key_id not in [kid for kid, _ in jwt_keys]:
+        raise SettingsError(f'JWT_ACTIVE_KEY must name one of the JWT_KEY_<id> values, got {jwt_active_key_id!r}')
+
+    room_policy = env_vars.get('ROOM_POLICY') or 'best_fit'
+    if room_policy not in ('best_fit', 'spread'):
+        raise SettingsError(f'ROOM_POLICY must be best_fit or spread, got {room_policy!r}')
+
+    settings = Settings(
+        database=database,
+        pool_min_size=number('POOL_MIN_SIZE', int, 2, 0),
+        pool_max_size=number('POOL_MAX_SIZE', int, 10, 1),
+        pool_timeout=number('POOL_TIMEOUT', float, 5.0, 0),
+        pool_check_interval=number('POOL_CHECK_INTERVAL', float, 30.0, 0),
+        jwt_keys=tuple(jwt_keys),
+        jwt_active_key_id=jwt_active_key_id,
+        token_lifetime=number('TOKEN_LIFETIME', int, 3600, 1),
+        token_cache_size=number('TOKEN_CACHE_SIZE', int, 10000, 0),
+        revocation_sync_interval=number('REVOCATION_SYNC_INTERVAL', float, 5.0, 0.1),
+        hash_workers=number('HASH_WORKERS', int, 2, 1),
+        hash_queue_size=number('HASH_QUEUE_SIZE', int, 32, 0),
+        hash_timeout=number('HASH_TIMEOUT', float, 10.0, 0.1),
+        room_policy=room_policy,
+        booking_calendar=number('BOOKING_CALENDAR', int, 1, 0) != 0,
+        booking_retries=number('BOOKING_RETRIES', int, 3, 1),
+        booking_retry_delay=number('BOOKING_RETRY_DELAY', float, 0.05, 0),
+        stream_itersize=number('STREAM_ITERSIZE', int, 1000, 1)
+    )
+
+    if settings.pool_min_size > settings.pool_max_size:
+        raise SettingsError('POOL_MIN_SIZE cannot be greater than POOL_MAX_SIZE')
+
+    return settings
+
+
+##
+## Holds the active Settings and swaps them on reload.
+##
+## Callbacks registered with on_reload(callback) are called as
+## callback(old_settings, new_settings) after a successful reload.
+## A reload that fails validation keeps the previous settings.
+##
+class SettingsStore:
+    def __init__(self, path='.env'):
+        self.path = path
+        self._settings = load_settings(path)
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    @property
+    def current(self):
+        return self._settings
+
+    def on_reload(self, callback):
+        self._callbacks.append(callback)
+
+    def reload(self):
+        with self._lock:
+            try:
+                new_settings = load_settings(self.path)
+            except SettingsError as error:
+                logger.error(f'Settings reload failed, keeping current settings - error: {error}')
+                return False
+
+            old_settings = self._settings
+            self._settings = new_settings
+
+            for callback in self._callbacks:
+                callback(old_settings, new_settings)
+
+        logger.info(f'Settings reloaded from {self.path}')
+        return True
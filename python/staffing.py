@@ -0,0 +1,90 @@
+##########################################################
+## NURSE STAFFING
+##########################################################
+
+class NurseValidationError(Exception):
+    def __init__(self, errors):
+        super().__init__(f'{len(errors)} invalid nurse(s)')
+        self.errors = errors  # [{'nurse_id': ..., 'error': ...}], one entry per invalid nurse
+
+
+##
+## Validate the [nurse_id, role] pairs of an appointment or surgery in one query.
+##
+## Every nurse must belong to "category", its role must exist with "role_type"
+## (0: appointment, 1: surgery) and the nurse must be free during the event.
+## Returns (nurse_ids, role_ids, errors), the errors of every nurse are collected
+## instead of stopping at the first one.
+##
+def validate_nurses(cur, nurses, category, role_type, date, hour, minutes, duration):
+    return validate_nurse_teams(cur, [(date, hour, minutes, nurses)], category, role_type, duration)[0]
+
+##
+## Same as validate_nurses for the teams of many events, still in one query.
+## "teams" is a list of (date, hour, minutes, nurses), one (nurse_ids, role_ids, errors) is returned per team.
+##
+def validate_nurse_teams(cur, teams, category, role_type, duration):
+    results = [([], [], []) for _ in teams]
+    rows = []  # (team, nurse_id, role_name, date, hour, minutes)
+
+    for team, (date, hour, minutes, nurses) in enumerate(teams):
+        nurse_ids, _, errors = results[team]
+
+        for nurse in nurses:
+            if not isinstance(nurse, (list, tuple)) or len(nurse) != 2 or not str(nurse[0]).isdigit():
+                errors.append({'nurse_id': None, 'error': f'Invalid nurse {nurse}, expected [nurse_id, role]'})
+                continue
+
+            nurse_id, role_name = int(nurse[0]), str(nurse[1])
+            if nurse_id in nurse_ids:
+                errors.append({'nurse_id': nurse_id, 'error': f'Nurse {nurse_id} is listed more than once!'})
+                continue
+
+            nurse_ids.append(nurse_id)
+            rows.append((team, nurse_id, role_name, date, hour, minutes))
+
+    if not rows:
+        return results
+
+    statement = """
+        SELECT n.team, n.nurse_id, n.role_name, r.role_id,
+               EXISTS (
+                   SELECT 1
+                   FROM nurses_categories AS nsc
+                   JOIN nurse_categories AS nc ON nc.category_id = nsc.category_id
+                   WHERE nsc.nurse_id = n.nurse_id AND nc.category = %s
+               ),
+               is_resource_available(2, n.nurse_id, booking_period(n.event_date, n.event_hour, n.event_minutes, %s))
+        FROM unnest(%s::INTEGER[], %s::INTEGER[], %s::VARCHAR[], %s::DATE[], %s::INTEGER[], %s::INTEGER[])
+             WITH ORDINALITY AS n(team, nurse_id, role_name, event_date, event_hour, event_minutes, position)
+        LEFT JOIN roles AS r ON r.role = n.role_name AND r.role_type = %s
+        ORDER BY n.position;
+    """
+    values = (category, duration, *(list(column) for column in zip(*rows)), role_type)
+    cur.execute(statement, values)
+
+    for team, nurse_id, role_name, role_id, in_category, available in cur.fetchall():
+        _, role_ids, errors = results[team]
+
+        if not in_category:
+            errors.append({'nurse_id': nurse_id, 'error': f'Nurse {nurse_id} is not a valid {category} nurse!'})
+        elif role_id is None:
+            errors.append({'nurse_id': nurse_id, 'error': f'Role {role_name} does not exist or is not valid for this event!'})
+        elif not available:
+            errors.append({'nurse_id': nurse_id, 'error': f'Nurse {nurse_id} is not available at this time!'})
+
+        role_ids.append(role_id)
+
+    return results
+
+##
+## Store the role of each nurse, nurses that already have a role keep it
+##
+def assign_nurse_roles(cur, nurse_ids, role_ids):
+    statement = """
+        INSERT INTO nurses_roles (nurse_id, role_id)
+        SELECT * FROM unnest(%s::INTEGER[], %s::BIGINT[])
+        ON CONFLICT (nurse_id) DO NOTHING;
+    """
+    values = (nurse_ids, role_ids)
+    cur.execute(statement, values)
@@ -0,0 +1,102 @@
+import itertools
+import logging
+import threading
+
+import psycopg2
+
+logger = logging.getLogger('logger')
+
+STREAM_FORMATS = {
+    'json': 'application/json',
+    'ndjson': 'application/x-ndjson'
+} # ?stream=<format> -> content type
+
+
+##########################################################
+## STREAMING RESPONSES
+##########################################################
+
+##
+## A named cursor and the pooled connection it runs on.
+##
+## close() closes the cursor, ends the transaction and hands the connection to "release",
+## once: it is called when the body ends and again by the response when it is closed, so
+## the connection also goes back when the body is never iterated (client gone before the
+## first byte, error while building the response).
+##
+class Stream:
+    def __init__(self, conn, cur, release):
+        self.conn = conn
+        self.cur = cur
+        self._release = release
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+
+        try:
+            self.cur.close()
+            self.conn.rollback()
+        except psycopg2.Error:
+            pass
+
+        self._release(self.conn)
+
+##
+## Run "statement" with a named (server-side) cursor and read its first batch.
+##
+## The rows stay in the database and are fetched "itersize" at a time, so a large
+## result never has to fit in memory. Errors of the query and an empty result are
+## known before the response starts. Returns (Stream, first_rows).
+##
+def open_stream(conn, statement, values, itersize, release):
+    cur = conn.cursor(name='stream')
+    cur.itersize = itersize
+    cur.execute(statement, values)
+    return Stream(conn, cur, release), cur.fetchmany(itersize)
+
+##
+## Generator of the response body of a stream opened by open_stream.
+##
+## - json: {"status": 200, "<key>": [...]} written one batch of rows at a time
+## - ndjson: one line per row
+##
+## "to_json" turns a row into the object of one result and "dumps" encodes it, the
+## stream is closed when the body ends or the client goes away.
+## An error after the first byte cannot change the HTTP status, it is written at the
+## end of the body instead: the error and "truncated": true in json, a last line with
+## the internal error status and the error in ndjson.
+##
+def stream_body(stream, first_rows, to_json, dumps, stream_format, key, status_codes):
+    cur = stream.cur
+    try:
+        if stream_format == 'json':
+            yield f'{{"status": {status_codes["success"]}, "{key}": ['
+
+        batches = itertools.chain([first_rows], iter(lambda: cur.fetchmany(cur.itersize), []))
+        separator = ''
+        for rows in batches:
+            if stream_format == 'ndjson':
+                yield ''.join(dumps(to_json(row)) + '\n' for row in rows)
+            else:
+                yield separator + ', '.join(dumps(to_json(row)) for row in rows)
+                separator = ', '
+
+        if stream_format == 'json':
+            yield ']}'
+
+    except (Exception, psycopg2.DatabaseError) as error:
+        logger.error(f'Stream - error: {error}')
+
+        error = dumps(str(error).split('\n')[0])
+        if stream_format == 'json':
+            yield f'], "errors": {error}, "truncated": true}}'
+        else:
+            yield f'{{"status": {status_codes["internal_error"]}, "errors": {error}}}\n'
+
+    finally:
+        stream.close()
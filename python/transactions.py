@@ -0,0 +1,123 @@
+import logging
+import random
+import threading
+import time
+
+import psycopg2.errors
+
+logger = logging.getLogger('logger')
+
+# Failures caused by concurrent transactions, the same transaction may succeed when run again
+RETRYABLE_ERRORS = (
+    psycopg2.errors.SerializationFailure,
+    psycopg2.errors.DeadlockDetected,
+    psycopg2.errors.LockNotAvailable
+)
+
+_lock = threading.Lock()
+_counters = {'retries': 0, 'exhausted': 0}
+
+
+##########################################################
+## BOOKING LOCKS
+##########################################################
+
+##
+## Lock the (resource_type, resource_id) pairs of an event on every day it spans, until commit.
+##
+## Called first in a booking transaction, the availability checks that follow cannot be
+## invalidated by a concurrent booking of the same doctor, room or nurse on the same day.
+## Bookings of other resources or other days never wait for each other.
+## Pairs that are not integers are skipped, they are reported by the validation that follows.
+##
+def lock_booking_resources(cur, resources, date, hour, minutes, duration):
+    pairs = []
+    for resource_type, resource_id in resources:
+        try:
+            pairs.append((int(resource_type), int(resource_id)))
+        except (TypeError, ValueError):
+            continue
+
+    statement = """
+        SELECT lock_booking_resources(%s::INTEGER[], %s::BIGINT[], booking_period(%s::DATE, %s::INTEGER, %s::INTEGER, %s));
+    """
+    values = ([pair[0] for pair in pairs], [pair[1] for pair in pairs], date, hour, minutes, duration)
+    cur.execute(statement, values)
+
+##
+## Lock many (resource_type, resource_id, date) triples at once, e.g. the resources of a batch of bookings
+##
+def lock_booking_days(cur, keys):
+    keys = list(keys)
+    if not keys:
+        return
+
+    statement = """
+        SELECT lock_booking_days(%s::INTEGER[], %s::BIGINT[], %s::DATE[]);
+    """
+    values = tuple(list(column) for column in zip(*keys))
+    cur.execute(statement, values)
+
+
+##########################################################
+## TRANSACTION RETRY
+##########################################################
+
+class TransactionAttempt:
+    def __init__(self, conn, number, attempts, base_delay):
+        self.conn = conn
+        self.number = number
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.succeeded = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, error, traceback):
+        if error is None:
+            self.succeeded = True
+            return False
+
+        if not isinstance(error, RETRYABLE_ERRORS):
+            return False
+
+        if self.number == self.attempts:
+            with _lock:
+                _counters['exhausted'] += 1
+            return False
+
+        self.conn.rollback()
+
+        # Full jitter: transactions that failed together do not retry together
+        delay = random.uniform(0, self.base_delay * 2 ** (self.number - 1))
+        logger.warning(f'Transaction attempt {self.number}/{self.attempts} failed, retrying in {delay:.3f}s - error: {error.pgcode}')
+
+        with _lock:
+            _counters['retries'] += 1
+
+        time.sleep(delay)
+        return True
+
+##
+## Run a transaction again when it fails because of a concurrent one:
+##
+##     for attempt in transaction_attempts(conn, 3, 0.05):
+##         with attempt:
+##             ...
+##             conn.commit()
+##
+## A serialization failure or a deadlock rolls back and retries with exponential backoff,
+## the last failure and any other error are raised as usual.
+##
+def transaction_attempts(conn, attempts, base_delay):
+    for number in range(1, attempts + 1):
+        attempt = TransactionAttempt(conn, number, attempts, base_delay)
+        yield attempt
+
+        if attempt.succeeded:
+            return
+
+def retry_stats():
+    with _lock:
+        return dict(_counters)
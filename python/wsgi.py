@@ -0,0 +1,15 @@
+##
+## Production entry point, loaded by every gunicorn worker:
+##
+##  gunicorn -c gunicorn.conf.py wsgi:app
+##
+from main import app, setup_logging, settings, logger
+import logging
+
+setup_logging(logging.INFO)
+
+if not settings.current.jwt_keys:
+    # Tokens signed with a per-process key would be rejected by every other worker
+    raise RuntimeError('JWT_KEY_<id> and JWT_ACTIVE_KEY must be set in .env to run with multiple workers')
+
+logger.info('Worker ready')
@@ -41,6 +41,15 @@ DROP TABLE IF EXISTS sub_specialisations_doctors;
 DROP TABLE IF EXISTS posologies;
 DROP TABLE IF EXISTS posologies_medicines;
 DROP TABLE IF EXISTS posologies_prescriptions;
+DROP TABLE IF EXISTS revoked_tokens;
+DROP TABLE IF EXISTS credentials;
+DROP TABLE IF EXISTS bookings;
+DROP TABLE IF EXISTS appointment_series;
+DROP TABLE IF EXISTS patient_versions;
+DROP TABLE IF EXISTS revenue_monthly;
+DROP TABLE IF EXISTS revenue_monthly_services;
+DROP TABLE IF EXISTS daily_stats;
+DROP TABLE IF EXISTS surgery_counts_monthly;
 
 /*********************************************************
 *	TABLE: employees									 *
@@ -119,9 +128,15 @@ CREATE TABLE appointments (
 	app_room			BIGINT NOT NULL,
 	app_hour			INTEGER NOT NULL,
 	app_minutes			INTEGER NOT NULL,
+	app_duration		INTEGER NOT NULL DEFAULT 30,
+	app_period			TSRANGE GENERATED ALWAYS AS (
+							tsrange(app_date + make_time(app_hour, app_minutes, 0),
+									app_date + make_time(app_hour, app_minutes, 0) + make_interval(mins => app_duration))
+						) STORED,
 	patient_id			INTEGER,
 	doctor_id 			INTEGER,
 	bill_id				BIGINT NOT NULL,
+	series_id			BIGINT,
 	PRIMARY KEY(appointment_id,patient_id,doctor_id)
 );
 /*********************************************************
@@ -135,6 +150,11 @@ CREATE TABLE surgeries (
 	surgery_room			BIGINT NOT NULL,
 	surgery_hour			INTEGER NOT NULL,
 	surgery_minutes			INTEGER NOT NULL,
+	surgery_duration		INTEGER NOT NULL DEFAULT 120,
+	surgery_period			TSRANGE GENERATED ALWAYS AS (
+								tsrange(surgery_date + make_time(surgery_hour, surgery_minutes, 0),
+										surgery_date + make_time(surgery_hour, surgery_minutes, 0) + make_interval(mins => surgery_duration))
+							) STORED,
 	doctor_id 				INTEGER,
 	patient_id				INTEGER NOT NULL,
 	hosp_id				 	BIGINT NOT NULL,
@@ -148,6 +168,7 @@ CREATE TABLE hospitalizations (
 	start_date			DATE NOT NULL,
 	final_date			DATE NOT NULL,
 	room				BIGINT NOT NULL,
+	stay				DATERANGE GENERATED ALWAYS AS (daterange(start_date, final_date, '[]')) STORED,
 	bill_id				BIGINT NOT NULL,
 	assistant_id		INTEGER NOT NULL,
 	nurse_id	 		INTEGER NOT NULL,
@@ -169,6 +190,8 @@ CREATE TABLE bills (
 	bill_id	 			BIGSERIAL,
 	total_payment	 	FLOAT(8) NOT NULL,
 	bill_status		 	BOOL NOT NULL DEFAULT FALSE,
+	patient_id			INTEGER,
+	amount_paid			FLOAT(8) NOT NULL DEFAULT 0,
 	PRIMARY KEY(bill_id)
 );
 /*********************************************************
@@ -253,20 +276,22 @@ CREATE TABLE probabilities (
 *	TABLE: roles_appointments							 *
 *********************************************************/
 CREATE TABLE roles_appointments (
-	role_id			BIGINT,
+	role_id			BIGINT NOT NULL,
 	app_id			BIGINT,
 	patient_id		INTEGER,
 	doctor_id 		INTEGER,
-	PRIMARY KEY(role_id,app_id,patient_id,doctor_id)
+	nurse_id		INTEGER,
+	PRIMARY KEY(nurse_id,app_id,patient_id,doctor_id)
 );
 /*********************************************************
 *	TABLE: roles_surgeries							 	 *
 *********************************************************/
 CREATE TABLE roles_surgeries (
-	role_id			BIGINT,
+	role_id			BIGINT NOT NULL,
 	surgery_id		BIGINT,
 	doctor_id 		INTEGER,
-	PRIMARY KEY(role_id,surgery_id,doctor_id)		
+	nurse_id		INTEGER,
+	PRIMARY KEY(nurse_id,surgery_id,doctor_id)
 );
 /*********************************************************
 *	TABLE: nurses_roles									 *
@@ -351,6 +376,114 @@ CREATE TABLE posologies_prescriptions (
 	presc_id 		BIGINT,
 	PRIMARY KEY(posology_id,presc_id)
 );
+/*********************************************************
+*	TABLE: revoked_tokens				 		 		 *
+*********************************************************/
+CREATE TABLE revoked_tokens (
+	jti				VARCHAR(32),
+	expires_at		TIMESTAMP WITH TIME ZONE NOT NULL,
+	PRIMARY KEY(jti)
+);
+/*********************************************************
+*	TABLE: credentials							 		 *
+*	Login lookup for employees and patients, kept in 	 *
+*	sync by triggers on both tables (db_functions.sql)	 *
+*********************************************************/
+CREATE TABLE credentials (
+	username		VARCHAR(15),
+	person_id		INTEGER NOT NULL,
+	person_type		INTEGER NOT NULL,
+	password_hash	VARCHAR(512) NOT NULL,
+	PRIMARY KEY(username)
+);
+/*********************************************************
+*	TABLE: bookings								 		 *
+*	Time taken by each doctor, room and nurse, filled	 *
+*	by triggers on appointments, surgeries and their	 *
+*	nurse roles (db_functions.sql)						 *
+*********************************************************/
+CREATE TABLE bookings (
+	booking_id			BIGSERIAL,
+	resource_type		INTEGER NOT NULL,	-- 0: doctor, 1: room, 2: nurse
+	resource_id			BIGINT NOT NULL,
+	period				TSRANGE NOT NULL,
+	appointment_id		BIGINT,
+	surgery_id			BIGINT,
+	PRIMARY KEY(booking_id)
+);
+/*********************************************************
+*	TABLE: appointment_series							 *
+*	Recurring appointments booked together, each		 *
+*	occurrence is a row of appointments				 	 *
+*********************************************************/
+CREATE TABLE appointment_series (
+	series_id			BIGSERIAL,
+	patient_id			INTEGER NOT NULL,
+	doctor_id			INTEGER NOT NULL,
+	frequency			VARCHAR(10) NOT NULL,	-- weekly or monthly
+	repeat_interval		INTEGER NOT NULL,		-- weeks or months between occurrences
+	occurrences			INTEGER NOT NULL,
+	first_date			DATE NOT NULL,
+	PRIMARY KEY(series_id)
+);
+/*********************************************************
+*	TABLE: patient_versions								 *
+*	Change counter of the appointments, surgeries and	 *
+*	prescriptions of each patient, bumped by triggers	 *
+*	(db_functions.sql) and sent as ETag by the API		 *
+*********************************************************/
+CREATE TABLE patient_versions (
+	patient_id			INTEGER,
+	version				BIGINT NOT NULL DEFAULT 0,
+	PRIMARY KEY(patient_id)
+);
+/*********************************************************
+*	TABLE: revenue_monthly								 *
+*	Payments of each patient per month, kept by the		 *
+*	payments trigger (db_functions.sql)					 *
+*********************************************************/
+CREATE TABLE revenue_monthly (
+	patient_id			INTEGER,
+	month				DATE,
+	total_paid			FLOAT(8) NOT NULL DEFAULT 0,
+	PRIMARY KEY(patient_id, month)
+);
+/*********************************************************
+*	TABLE: revenue_monthly_services						 *
+*	Payments of each appointment or hospitalization		 *
+*	per patient and month								 *
+*********************************************************/
+CREATE TABLE revenue_monthly_services (
+	patient_id			INTEGER,
+	month				DATE,
+	service_type		VARCHAR(20),
+	service_id			BIGINT,
+	paid				FLOAT(8) NOT NULL DEFAULT 0,
+	PRIMARY KEY(patient_id, month, service_type, service_id)
+);
+/*********************************************************
+*	TABLE: daily_stats									 *
+*	Surgeries, payments and prescriptions of each day,	 *
+*	kept by triggers (db_functions.sql)					 *
+*********************************************************/
+CREATE TABLE daily_stats (
+	stat_date			DATE,
+	surgeries			INTEGER NOT NULL DEFAULT 0,
+	amount_spent		FLOAT(8) NOT NULL DEFAULT 0,
+	prescriptions		INTEGER NOT NULL DEFAULT 0,
+	PRIMARY KEY(stat_date)
+);
+/*********************************************************
+*	TABLE: surgery_counts_monthly						 *
+*	Surgeries of each doctor per month, kept by the		 *
+*	surgeries trigger (db_functions.sql)				 *
+*********************************************************/
+CREATE TABLE surgery_counts_monthly (
+	doctor_id			INTEGER,
+	month				DATE,
+	num_surgeries		INTEGER NOT NULL DEFAULT 0,
+	PRIMARY KEY(doctor_id, month)
+);
 
 ALTER TABLE employees ADD UNIQUE (person_cc, person_phone, person_username, person_password, person_email);
 ALTER TABLE employees ADD CONSTRAINT employees_fk1 FOREIGN KEY (ctype_id) REFERENCES contract_types(ctype_id);
@@ -385,14 +518,17 @@ ALTER TABLE hospitalizations ADD CONSTRAINT hospitalizations_fk1 FOREIGN KEY (bi
 ALTER TABLE hospitalizations ADD CONSTRAINT hospitalizations_fk2 FOREIGN KEY (assistant_id) REFERENCES assistants(person_id);
 ALTER TABLE hospitalizations ADD CONSTRAINT hospitalizations_fk3 FOREIGN KEY (nurse_id) REFERENCES nurses(person_id);
 ALTER TABLE payments ADD CONSTRAINT payments_fk1 FOREIGN KEY (bill_id) REFERENCES bills(bill_id);
+ALTER TABLE bills ADD CONSTRAINT bills_fk1 FOREIGN KEY (patient_id) REFERENCES patients(person_id);
 ALTER TABLE payments ADD CONSTRAINT constraint_0 CHECK (method_payment >= 0 AND method_payment <=2);
 ALTER TABLE sub_specialisations ADD CONSTRAINT sub_specialisations_fk1 FOREIGN KEY (spec_id) REFERENCES specialisations(spec_id);
 ALTER TABLE sub_specialisations_doctors ADD CONSTRAINT doctors_specialisations_fk1 FOREIGN KEY (doctor_id) REFERENCES doctors(person_id);
 ALTER TABLE sub_specialisations_doctors ADD CONSTRAINT sub_specialisations_doctors_fk2 FOREIGN KEY (sub_spec_id) REFERENCES sub_specialisations(sub_spec_id);
 ALTER TABLE roles_appointments ADD CONSTRAINT roles_appointments_fk1 FOREIGN KEY (role_id) REFERENCES roles(role_id);
 ALTER TABLE roles_appointments ADD CONSTRAINT roles_appointments_fk2 FOREIGN KEY (app_id, patient_id, doctor_id) REFERENCES appointments(appointment_id, patient_id, doctor_id);
+ALTER TABLE roles_appointments ADD CONSTRAINT roles_appointments_fk3 FOREIGN KEY (nurse_id) REFERENCES nurses(person_id);
 ALTER TABLE roles_surgeries ADD CONSTRAINT roles_surgeries_fk1 FOREIGN KEY (role_id) REFERENCES roles(role_id);
 ALTER TABLE roles_surgeries ADD CONSTRAINT roles_surgeries_fk2 FOREIGN KEY (surgery_id, doctor_id) REFERENCES surgeries(surgery_id, doctor_id);
+ALTER TABLE roles_surgeries ADD CONSTRAINT roles_surgeries_fk3 FOREIGN KEY (nurse_id) REFERENCES nurses(person_id);
 ALTER TABLE nurses_roles ADD CONSTRAINT nurses_roles_fk1 FOREIGN KEY (nurse_id) REFERENCES nurses(person_id);
 ALTER TABLE nurses_roles ADD CONSTRAINT nurses_roles_fk2 FOREIGN KEY (role_id) REFERENCES roles(role_id);
 ALTER TABLE hospitalizations_prescriptions ADD CONSTRAINT hospitalizations_prescriptions_fk1 FOREIGN KEY (hosp_id) REFERENCES hospitalizations(hosp_id);
@@ -420,4 +556,41 @@ ALTER TABLE appointments ADD CONSTRAINT check_type CHECK (
 );
 ALTER TABLE surgeries ADD CONSTRAINT check_type CHECK (
 	surgery_type IN ('CARDIOLOGIA', 'DERMATOLOGIA', 'OFTALMOLOGIA', 'REUMATOLOGIA', 'ORTOPEDIA')
-);
\ No newline at end of file
+);
+ALTER TABLE appointments ADD CONSTRAINT check_duration CHECK (app_duration > 0);
+ALTER TABLE surgeries ADD CONSTRAINT check_duration CHECK (surgery_duration > 0);
+ALTER TABLE bookings ADD CONSTRAINT check_resource_type CHECK (resource_type >= 0 AND resource_type <= 2);
+ALTER TABLE bookings ADD CONSTRAINT check_booking_event CHECK ((appointment_id IS NULL) <> (surgery_id IS NULL));
+-- A doctor, room, nurse or hospitalization room can never be booked twice for overlapping periods (needs btree_gist)
+CREATE EXTENSION IF NOT EXISTS btree_gist;
+ALTER TABLE bookings ADD CONSTRAINT bookings_no_overlap EXCLUDE USING gist (resource_type WITH =, resource_id WITH =, period WITH &&);
+ALTER TABLE hospitalizations ADD CONSTRAINT hospitalizations_no_overlap EXCLUDE USING gist (room WITH =, stay WITH &&);
+CREATE INDEX bookings_appointment_idx ON bookings (appointment_id) WHERE appointment_id IS NOT NULL;
+CREATE INDEX bookings_surgery_idx ON bookings (surgery_id) WHERE surgery_id IS NOT NULL;
+ALTER TABLE appointment_series ADD CONSTRAINT appointment_series_fk1 FOREIGN KEY (patient_id) REFERENCES patients(person_id);
+ALTER TABLE appointment_series ADD CONSTRAINT appointment_series_fk2 FOREIGN KEY (doctor_id) REFERENCES doctors(person_id);
+ALTER TABLE appointment_series ADD CONSTRAINT check_frequency CHECK (frequency IN ('weekly', 'monthly') AND repeat_interval > 0 AND occurrences > 0);
+ALTER TABLE appointments ADD CONSTRAINT appointments_fk5 FOREIGN KEY (series_id) REFERENCES appointment_series(series_id);
+CREATE INDEX appointments_series_idx ON appointments (series_id) WHERE series_id IS NOT NULL;
+ALTER TABLE patient_versions ADD CONSTRAINT patient_versions_fk1 FOREIGN KEY (patient_id) REFERENCES patients(person_id);
+-- Appointments of a patient in date order, read one page at a time by GET /dbproj/appointments
+CREATE INDEX appointments_patient_date_idx ON appointments (patient_id, app_date, app_hour, app_minutes, appointment_id);
+-- Prescriptions of a patient, from its appointments and surgeries, with their posologies (GET /dbproj/prescriptions)
+CREATE INDEX appointments_prescriptions_patient_idx ON appointments_prescriptions (patient_id);
+CREATE INDEX surgeries_patient_hosp_idx ON surgeries (patient_id, hosp_id);
+CREATE INDEX hospitalizations_prescriptions_hosp_idx ON hospitalizations_prescriptions (hosp_id);
+CREATE INDEX posologies_prescriptions_presc_idx ON posologies_prescriptions (presc_id, posology_id);
+-- Payments of a month with the bills they paid, and the services of those bills (GET /dbproj/top3)
+CREATE INDEX payments_date_idx ON payments (payment_date) INCLUDE (bill_id, payment);
+CREATE INDEX appointments_bill_idx ON appointments (bill_id);
+CREATE INDEX surgeries_hosp_idx ON surgeries (hosp_id);
+ALTER TABLE revenue_monthly ADD CONSTRAINT revenue_monthly_fk1 FOREIGN KEY (patient_id) REFERENCES patients(person_id);
+ALTER TABLE revenue_monthly ADD CONSTRAINT check_month CHECK (month = date_trunc('month', month)::DATE);
+ALTER TABLE revenue_monthly_services ADD CONSTRAINT revenue_monthly_services_fk1 FOREIGN KEY (patient_id, month) REFERENCES revenue_monthly(patient_id, month) ON DELETE CASCADE;
+ALTER TABLE revenue_monthly_services ADD CONSTRAINT check_service_type CHECK (service_type IN ('appointment', 'hospitalization'));
+-- Patients of a month by revenue, the top 3 is the first 3 entries (GET /dbproj/top3)
+CREATE INDEX revenue_monthly_month_idx ON revenue_monthly (month, total_paid DESC, patient_id);
+ALTER TABLE surgery_counts_monthly ADD CONSTRAINT surgery_counts_monthly_fk1 FOREIGN KEY (doctor_id) REFERENCES doctors(person_id);
+ALTER TABLE surgery_counts_monthly ADD CONSTRAINT check_month CHECK (month = date_trunc('month', month)::DATE);
+-- Doctors of each month by number of surgeries (GET /dbproj/report)
+CREATE INDEX surgery_counts_monthly_month_idx ON surgery_counts_monthly (month, num_surgeries DESC, doctor_id);
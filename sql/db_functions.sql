@@ -13,6 +13,69 @@
 
 CREATE EXTENSION IF NOT EXISTS pgcrypto; -- Extension to use cryptographic functions
 
+/* Period taken by an event starting at "b_date b_hour:b_minutes" and lasting "b_duration" minutes */
+CREATE OR REPLACE FUNCTION booking_period(
+    b_date DATE,
+    b_hour INTEGER,
+    b_minutes INTEGER,
+    b_duration INTEGER
+)
+RETURNS TSRANGE AS $$
+    SELECT tsrange(b_date + make_time(b_hour, b_minutes, 0),
+                   b_date + make_time(b_hour, b_minutes, 0) + make_interval(mins => b_duration));
+$$ LANGUAGE sql IMMUTABLE;
+
+/* Checks if a resource (0: doctor, 1: room, 2: nurse) has no booking overlapping "b_period" */
+CREATE OR REPLACE FUNCTION is_resource_available(
+    r_type INTEGER,
+    r_id BIGINT,
+    b_period TSRANGE
+)
+RETURNS BOOLEAN AS $$
+    -- Single probe of the bookings_no_overlap index
+    SELECT NOT EXISTS (
+        SELECT 1
+        FROM bookings AS b
+        WHERE b.resource_type = r_type
+          AND b.resource_id = r_id
+          AND b.period && b_period
+    );
+$$ LANGUAGE sql STABLE;
+
+/* Locks the (resource type, resource id, day) triples (0: doctor, 1: room, 2: nurse) until commit.
+ * The locks are always taken in the same order, so two bookings sharing resources wait
+ * for each other instead of deadlocking */
+CREATE OR REPLACE FUNCTION lock_booking_days(
+    r_types INTEGER[],
+    r_ids BIGINT[],
+    r_days DATE[]
+)
+RETURNS VOID AS $$
+DECLARE
+    lock_key INTEGER;
+BEGIN
+    FOR lock_key IN
+        SELECT DISTINCT hashtext(format('%s:%s:%s', r.resource_type, r.resource_id, r.day))
+        FROM unnest(r_types, r_ids, r_days) AS r(resource_type, resource_id, day)
+        ORDER BY 1
+    LOOP
+        PERFORM pg_advisory_xact_lock(hashtext('booking'), lock_key);
+    END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+/* Locks the resources of an event for every day of "b_period" until commit */
+CREATE OR REPLACE FUNCTION lock_booking_resources(
+    r_types INTEGER[],
+    r_ids BIGINT[],
+    b_period TSRANGE
+)
+RETURNS VOID AS $$
+    SELECT lock_booking_days(array_agg(r.resource_type), array_agg(r.resource_id), array_agg(d.day::DATE))
+    FROM unnest(r_types, r_ids) AS r(resource_type, resource_id)
+    CROSS JOIN generate_series(lower(b_period)::DATE, (upper(b_period) - INTERVAL '1 microsecond')::DATE, INTERVAL '1 day') AS d(day);
+$$ LANGUAGE sql;
+
 /* Checks if doctor is available for appointment */
 CREATE OR REPLACE FUNCTION is_doctor_available_for_appointment(
     d_id INTEGER, 
@@ -21,35 +84,8 @@ CREATE OR REPLACE FUNCTION is_doctor_available_for_appointment(
     app_minutes INTEGER
 )
 RETURNS BOOLEAN AS $$
-DECLARE
-    conflicting_surgeries INTEGER;
-    conflicting_appointments INTEGER;
-    appointment_start INTEGER := app_hour * 60 + app_minutes;
-    appointment_end INTEGER := appointment_start + 30;
-BEGIN
-    -- Verify conflicts with surgeries
-    SELECT COUNT(*)
-    INTO conflicting_surgeries
-    FROM surgeries AS s
-    WHERE s.doctor_id = d_id
-      AND s.surgery_date = a_date
-      AND (
-          (s.surgery_hour * 60 + s.surgery_minutes) < appointment_end
-          AND (s.surgery_hour * 60 + s.surgery_minutes + 120) > appointment_start
-      );
-
-    -- Verify conflicts with appointments
-    SELECT COUNT(*)
-    INTO conflicting_appointments
-    FROM appointments AS a
-    WHERE a.doctor_id = d_id
-      AND a.app_date = a_date
-      AND (
-          (a.app_hour * 60 + a.app_minutes) < appointment_end
-          AND (a.app_hour * 60 + a.app_minutes + a.app_duration) > appointment_start
-      );
-
-    RETURN conflicting_surgeries = 0 AND conflicting_appointments = 0;
+BEGIN
+    RETURN is_resource_available(0, d_id, booking_period(a_date, app_hour, app_minutes, 30));
 END;
 $$ LANGUAGE plpgsql;
 
@@ -61,35 +97,8 @@ CREATE OR REPLACE FUNCTION is_room_available_for_appointment(
     app_minutes INTEGER
 )
 RETURNS BOOLEAN AS $$
-DECLARE
-    conflicting_surgeries INTEGER;
-    conflicting_appointments INTEGER;
-    appointment_start INTEGER := app_hour * 60 + app_minutes;
-    appointment_end INTEGER := appointment_start + 30;
-BEGIN
-    -- Verify conflicts with surgeries
-    SELECT COUNT(*)
-    INTO conflicting_surgeries
-    FROM surgeries AS s
-    WHERE s.surgery_room = a_room
-      AND s.surgery_date = a_date
-      AND (
-          (s.surgery_hour * 60 + s.surgery_minutes) < appointment_end
-          AND (s.surgery_hour * 60 + s.surgery_minutes + 120) > appointment_start
-      );
-
-    -- Verify conflicts with appointments
-    SELECT COUNT(*)
-    INTO conflicting_appointments
-    FROM appointments AS a
-    WHERE a.app_room = a_room
-      AND a.app_date = a_date
-      AND (
-          (a.app_hour * 60 + a.app_minutes) < appointment_end
-          AND (a.app_hour * 60 + a.app_minutes + a.app_duration) > appointment_start
-      );
-
-    RETURN conflicting_surgeries = 0 AND conflicting_appointments = 0;
+BEGIN
+    RETURN is_resource_available(1, a_room, booking_period(a_date, app_hour, app_minutes, 30));
 END;
 $$ LANGUAGE plpgsql;
 
@@ -101,38 +110,8 @@ CREATE OR REPLACE FUNCTION is_nurse_available_for_appointment(
     app_minutes INTEGER
 )
 RETURNS BOOLEAN AS $$
-DECLARE
-    conflicting_surgeries INTEGER;
-    conflicting_appointments INTEGER;
-    appointment_start INTEGER := app_hour * 60 + app_minutes;
-    appointment_end INTEGER := appointment_start + 30;
-BEGIN
-    -- Verify conflicts with surgeries
-    SELECT COUNT(*)
-    INTO conflicting_surgeries
-    FROM surgeries AS s
-    JOIN roles_surgeries AS rs ON s.surgery_id = rs.surgery_id
-    JOIN nurses_roles AS nr ON rs.role_id = nr.role_id
-    WHERE nr.nurse_id = n_id
-      AND s.surgery_date = a_date
-      AND (
-          (s.surgery_hour * 60 + s.surgery_minutes) < appointment_end
-          AND (s.surgery_hour * 60 + s.surgery_minutes + s.surgery_duration) > appointment_start
-      );
-
-    -- Verify conflicts with appointments
-    SELECT COUNT(*)
-    INTO conflicting_appointments
-    FROM appointments AS a
-    JOIN roles_appointments ra ON a.appointment_id = ra.app_id
-    JOIN nurses_roles nr ON ra.role_id = nr.role_id
-    WHERE nr.nurse_id = n_id
-      AND a.app_date = a_date
-      AND (
-          (a.app_hour * 60 + a.app_minutes) < appointment_end
-          AND (a.app_hour * 60 + a.app_minutes + a.app_duration) > appointment_start
-      );
-    RETURN conflicting_surgeries = 0 AND conflicting_appointments = 0;
+BEGIN
+    RETURN is_resource_available(2, n_id, booking_period(a_date, app_hour, app_minutes, 30));
 END;
 $$ LANGUAGE plpgsql;
 
@@ -144,35 +123,8 @@ CREATE OR REPLACE FUNCTION is_doctor_available_for_surgery(
     surgery_minutes INTEGER
 )
 RETURNS BOOLEAN AS $$
-DECLARE
-    conflicting_surgeries INTEGER;
-    conflicting_appointments INTEGER;
-    surgery_start INTEGER := surgery_hour * 60 + surgery_minutes;
-    surgery_end INTEGER := surgery_start + 120; -- 2 hours duration (120 minutes)
-BEGIN
-    -- Verify conflicts with surgeries
-    SELECT COUNT(*)
-    INTO conflicting_surgeries
-    FROM surgeries AS s
-    WHERE s.doctor_id = d_id
-      AND s.surgery_date = s_date
-      AND (
-          (s.surgery_hour * 60 + s.surgery_minutes) < surgery_end
-          AND (s.surgery_hour * 60 + s.surgery_minutes + 120) > surgery_start
-      );
-
-    -- Verify conflicts with appointments
-    SELECT COUNT(*)
-    INTO conflicting_appointments
-    FROM appointments AS a
-    WHERE a.doctor_id = d_id
-      AND a.app_date = s_date
-      AND (
-          (a.app_hour * 60 + a.app_minutes) < surgery_end
-          AND (a.app_hour * 60 + a.app_minutes + a.app_duration) > surgery_start
-      );
-
-    RETURN conflicting_surgeries = 0 AND conflicting_appointments = 0;
+BEGIN
+    RETURN is_resource_available(0, d_id, booking_period(s_date, surgery_hour, surgery_minutes, 120)); -- 2 hours duration (120 minutes)
 END;
 $$ LANGUAGE plpgsql;
 
@@ -184,35 +136,8 @@ CREATE OR REPLACE FUNCTION is_room_available_for_surgery(
     surgery_minutes INTEGER
 )
 RETURNS BOOLEAN AS $$
-DECLARE
-    conflicting_surgeries INTEGER;
-    conflicting_appointments INTEGER;
-    surgery_start INTEGER := surgery_hour * 60 + surgery_minutes;
-    surgery_end INTEGER := surgery_start + 120; -- 2 hours duration (120 minutes)
-BEGIN
-    -- Verify conflicts with surgeries
-    SELECT COUNT(*)
-    INTO conflicting_surgeries
-    FROM surgeries AS s
-    WHERE s.surgery_room = s_room
-      AND s.surgery_date = s_date
-      AND (
-          (s.surgery_hour * 60 + s.surgery_minutes) < surgery_end
-          AND (s.surgery_hour * 60 + s.surgery_minutes + 120) > surgery_start
-      );
-
-    -- Verify conflicts with appointments
-    SELECT COUNT(*)
-    INTO conflicting_appointments
-    FROM appointments AS a
-    WHERE a.app_room = s_room
-      AND a.app_date = s_date
-      AND (
-          (a.app_hour * 60 + a.app_minutes) < surgery_end
-          AND (a.app_hour * 60 + a.app_minutes + a.app_duration) > surgery_start
-      );
-
-    RETURN conflicting_surgeries = 0 AND conflicting_appointments = 0;
+BEGIN
+    RETURN is_resource_available(1, s_room, booking_period(s_date, surgery_hour, surgery_minutes, 120));
 END;
 $$ LANGUAGE plpgsql;
 
@@ -224,119 +149,125 @@ CREATE OR REPLACE FUNCTION is_nurse_available_for_surgery(
     surgery_minutes INTEGER
 )
 RETURNS BOOLEAN AS $$
-DECLARE
-    conflicting_surgeries INTEGER;
-    conflicting_appointments INTEGER;
-    surgery_start INTEGER := surgery_hour * 60 + surgery_minutes;
-    surgery_end INTEGER := surgery_start + 120;
-BEGIN
-    -- Verify conflicts with surgeries
-    SELECT COUNT(*)
-    INTO conflicting_surgeries
-    FROM surgeries AS s
-    JOIN roles_surgeries AS rs ON s.surgery_id = rs.surgery_id
-    JOIN nurses_roles AS nr ON rs.role_id = nr.role_id
-    WHERE nr.nurse_id = n_id
-    AND s.surgery_date = s_date
-    AND (
-        (s.surgery_hour * 60 + s.surgery_minutes) < surgery_end
-        AND (s.surgery_hour * 60 + s.surgery_minutes + s.surgery_duration) > surgery_start
-    );
-
-    -- Verify conflicts with appointments
-    SELECT COUNT(*)
-    INTO conflicting_appointments
-    FROM appointments AS a
-    JOIN roles_appointments AS ra ON a.appointment_id = ra.app_id
-    JOIN nurses_roles AS nr ON ra.role_id = nr.role_id
-    WHERE nr.nurse_id = n_id
-    AND a.app_date = s_date
-    AND (
-        (a.app_hour * 60 + a.app_minutes) < surgery_end
-        AND (a.app_hour * 60 + a.app_minutes + a.app_duration) > surgery_start
-    );
-
-    RETURN conflicting_surgeries = 0 AND conflicting_appointments = 0;
+BEGIN
+    RETURN is_resource_available(2, n_id, booking_period(s_date, surgery_hour, surgery_minutes, 120));
 END;
 $$ LANGUAGE plpgsql;
 
 
-/* Obtains first available room */
-CREATE OR REPLACE FUNCTION get_first_available_room(
-    s_date DATE
+/* Picks a free hospitalization room (71 to 100) for the whole stay [s_start, s_final] and locks it until commit
+ *  - best_fit: the room whose free gap around the stay is the smallest, keeping empty rooms for long stays
+ *  - spread: the room farthest from its closest stay, spreading the patients across the rooms
+ * Returns NULL when every room is taken */
+CREATE OR REPLACE FUNCTION allocate_hospitalization_room(
+    s_start DATE,
+    s_final DATE,
+    policy VARCHAR DEFAULT 'best_fit'
 )
 RETURNS BIGINT AS $$
 DECLARE
-    room_number BIGINT := 71;
-    available_room BIGINT := NULL;
+    requested_stay DATERANGE := daterange(s_start, s_final, '[]');
+    no_gap CONSTANT INTEGER := 100000; -- Gap of a room with no stay before or after
+    candidate RECORD;
 BEGIN
-    WHILE room_number <= 100 LOOP
+    IF policy NOT IN ('best_fit', 'spread') THEN
+        RAISE EXCEPTION 'Invalid room allocation policy %, must be best_fit or spread', policy;
+    END IF;
+
+    FOR candidate IN
+        SELECT r.room
+        FROM generate_series(71, 100) AS r(room)
+        CROSS JOIN LATERAL (
+            SELECT s_start - MAX(h.final_date) AS gap
+            FROM hospitalizations AS h
+            WHERE h.room = r.room AND h.final_date < s_start
+        ) AS gap_before
+        CROSS JOIN LATERAL (
+            SELECT MIN(h.start_date) - s_final AS gap
+            FROM hospitalizations AS h
+            WHERE h.room = r.room AND h.start_date > s_final
+        ) AS gap_after
+        WHERE NOT EXISTS (
+            SELECT 1
+            FROM hospitalizations AS h
+            WHERE h.room = r.room AND h.stay && requested_stay
+        )
+        ORDER BY
+            CASE
+                WHEN policy = 'best_fit' THEN COALESCE(gap_before.gap, no_gap) + COALESCE(gap_after.gap, no_gap)
+                ELSE -LEAST(COALESCE(gap_before.gap, no_gap), COALESCE(gap_after.gap, no_gap))
+            END,
+            r.room
+    LOOP
+        -- Skip rooms being allocated by a concurrent transaction
+        CONTINUE WHEN NOT pg_try_advisory_xact_lock(hashtext('hospitalization_room'), candidate.room);
+
+        -- The room may have been taken by a transaction that committed after the candidates were read
         IF NOT EXISTS (
             SELECT 1
-            FROM hospitalizations
-            WHERE room = room_number
-            AND s_date BETWEEN start_date AND final_date
+            FROM hospitalizations AS h
+            WHERE h.room = candidate.room AND h.stay && requested_stay
         ) THEN
-            available_room := room_number;
-            EXIT;
+            RETURN candidate.room;
         END IF;
-        
-        room_number := room_number + 1;
     END LOOP;
 
-    RETURN available_room;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+/* Obtains first available room */
+CREATE OR REPLACE FUNCTION get_first_available_room(
+    s_date DATE
+)
+RETURNS BIGINT AS $$
+BEGIN
+    RETURN allocate_hospitalization_room(s_date, s_date, 'best_fit');
 END;
 $$ LANGUAGE plpgsql;
 
-/* Update bills */
+/* Pay "amount" of bill "id" as patient "p_patient_id", the bill row is locked until commit so
+ * concurrent payments of the same bill are applied one after the other */
 CREATE OR REPLACE PROCEDURE update_bills(
     amount FLOAT,
     p_method INTEGER, 
     id BIGINT, 
+    p_patient_id INTEGER,
     OUT remaining_amount FLOAT
 )
 LANGUAGE plpgsql AS $$
 DECLARE
-    total_amount bills.total_payment%TYPE;
-    payment_so_far payments.payment%TYPE;
-    current_bill_status BOOLEAN;
+    bill bills%ROWTYPE;
 BEGIN
-    -- Verify bill status
-    SELECT bill_status INTO current_bill_status
+    SELECT * INTO bill
     FROM bills
-    WHERE bill_id = id;
+    WHERE bill_id = id
+    FOR UPDATE;
+
+    IF NOT FOUND THEN
+        RAISE EXCEPTION 'Bill % does not exist!', id;
+    END IF;
+
+    IF bill.patient_id IS DISTINCT FROM p_patient_id THEN
+        RAISE EXCEPTION 'You can only pay your own bills!';
+    END IF;
 
     -- if bill is already paid, raise an exception
-    IF current_bill_status THEN
+    IF bill.bill_status THEN
         RAISE EXCEPTION 'Cannot make a payment on a paid bill.';
     END IF;
 
-    SELECT total_payment INTO total_amount
-    FROM bills
-    WHERE bill_id = id;
-
     -- Insert payment into payments table
     INSERT INTO payments (payment, payment_date, bill_id, method_payment)
     VALUES (amount, CURRENT_DATE, id, p_method);
 
-    -- Calculate total payment so far
-    SELECT COALESCE(SUM(payment), 0) INTO payment_so_far
-    FROM payments
+    -- Running total of the payments, the bill is paid once it reaches the total amount
+    UPDATE bills
+    SET amount_paid = amount_paid + amount,
+        bill_status = amount_paid + amount >= total_payment
     WHERE bill_id = id;
 
-    -- Calculate remaining amount
-    remaining_amount := total_amount - payment_so_far;
-
-    IF remaining_amount < 0 THEN
-        remaining_amount := 0;
-    END IF;
-
-    -- If the total payment so far is greater than or equal to the total amount, update the bill status to 'paid'
-    IF payment_so_far >= total_amount THEN
-        UPDATE bills
-        SET bill_status = TRUE
-        WHERE bill_id = id;
-    END IF;
+    remaining_amount := GREATEST(bill.total_payment - (bill.amount_paid + amount), 0);
 END;
 $$;
 
@@ -424,6 +355,159 @@ BEFORE INSERT OR UPDATE ON surgeries
 FOR EACH ROW
 EXECUTE FUNCTION validate_surgery();
 
+/* Books a resource for an appointment or surgery, overlapping bookings are rejected by bookings_no_overlap */
+CREATE OR REPLACE FUNCTION book_resource(
+    r_type INTEGER,
+    r_id BIGINT,
+    b_period TSRANGE,
+    a_id BIGINT,
+    s_id BIGINT
+)
+RETURNS VOID AS $$
+BEGIN
+    INSERT INTO bookings (resource_type, resource_id, period, appointment_id, surgery_id)
+    VALUES (r_type, r_id, b_period, a_id, s_id);
+EXCEPTION
+    WHEN exclusion_violation THEN
+        CASE r_type
+            WHEN 0 THEN RAISE EXCEPTION 'Doctor % is already booked at this time!', r_id USING ERRCODE = 'exclusion_violation';
+            WHEN 1 THEN RAISE EXCEPTION 'Room % is already booked at this time!', r_id USING ERRCODE = 'exclusion_violation';
+            ELSE RAISE EXCEPTION 'Nurse % is already booked at this time!', r_id USING ERRCODE = 'exclusion_violation';
+        END CASE;
+END;
+$$ LANGUAGE plpgsql;
+
+/* Trigger to book the doctor and room of an appointment */
+CREATE OR REPLACE FUNCTION book_appointment()
+RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP = 'UPDATE' THEN
+        IF NEW.app_period = OLD.app_period AND NEW.doctor_id = OLD.doctor_id AND NEW.app_room = OLD.app_room THEN
+            RETURN NEW;
+        END IF;
+
+        DELETE FROM bookings WHERE appointment_id = OLD.appointment_id AND resource_type IN (0, 1);
+        UPDATE bookings SET period = NEW.app_period WHERE appointment_id = OLD.appointment_id;
+    END IF;
+
+    IF TG_OP = 'DELETE' THEN
+        DELETE FROM bookings WHERE appointment_id = OLD.appointment_id;
+        RETURN OLD;
+    END IF;
+
+    PERFORM book_resource(0, NEW.doctor_id, NEW.app_period, NEW.appointment_id, NULL);
+    PERFORM book_resource(1, NEW.app_room, NEW.app_period, NEW.appointment_id, NULL);
+
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER book_appointment_trigger
+AFTER INSERT OR UPDATE OR DELETE ON appointments
+FOR EACH ROW
+EXECUTE FUNCTION book_appointment();
+
+/* Trigger to book the doctor and room of a surgery */
+CREATE OR REPLACE FUNCTION book_surgery()
+RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP = 'UPDATE' THEN
+        IF NEW.surgery_period = OLD.surgery_period AND NEW.doctor_id = OLD.doctor_id AND NEW.surgery_room = OLD.surgery_room THEN
+            RETURN NEW;
+        END IF;
+
+        DELETE FROM bookings WHERE surgery_id = OLD.surgery_id AND resource_type IN (0, 1);
+        UPDATE bookings SET period = NEW.surgery_period WHERE surgery_id = OLD.surgery_id;
+    END IF;
+
+    IF TG_OP = 'DELETE' THEN
+        DELETE FROM bookings WHERE surgery_id = OLD.surgery_id;
+        RETURN OLD;
+    END IF;
+
+    PERFORM book_resource(0, NEW.doctor_id, NEW.surgery_period, NULL, NEW.surgery_id);
+    PERFORM book_resource(1, NEW.surgery_room, NEW.surgery_period, NULL, NEW.surgery_id);
+
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER book_surgery_trigger
+AFTER INSERT OR UPDATE OR DELETE ON surgeries
+FOR EACH ROW
+EXECUTE FUNCTION book_surgery();
+
+/* Trigger to book the nurses of an appointment */
+CREATE OR REPLACE FUNCTION book_appointment_nurse()
+RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        DELETE FROM bookings WHERE appointment_id = OLD.app_id AND resource_type = 2 AND resource_id = OLD.nurse_id;
+        RETURN OLD;
+    END IF;
+
+    PERFORM book_resource(2, NEW.nurse_id, a.app_period, NEW.app_id, NULL)
+    FROM appointments AS a
+    WHERE a.appointment_id = NEW.app_id;
+
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER book_appointment_nurse_trigger
+AFTER INSERT OR DELETE ON roles_appointments
+FOR EACH ROW
+EXECUTE FUNCTION book_appointment_nurse();
+
+/* Trigger to book the nurses of a surgery */
+CREATE OR REPLACE FUNCTION book_surgery_nurse()
+RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        DELETE FROM bookings WHERE surgery_id = OLD.surgery_id AND resource_type = 2 AND resource_id = OLD.nurse_id;
+        RETURN OLD;
+    END IF;
+
+    PERFORM book_resource(2, NEW.nurse_id, s.surgery_period, NULL, NEW.surgery_id)
+    FROM surgeries AS s
+    WHERE s.surgery_id = NEW.surgery_id;
+
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER book_surgery_nurse_trigger
+AFTER INSERT OR DELETE ON roles_surgeries
+FOR EACH ROW
+EXECUTE FUNCTION book_surgery_nurse();
+
+/* Trigger to send every booking change to the API workers (python/calendar_index.py) */
+CREATE OR REPLACE FUNCTION notify_bookings()
+RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        PERFORM pg_notify('bookings', json_build_object(
+            'op', 'delete', 'booking_id', OLD.booking_id, 'resource_type', OLD.resource_type,
+            'resource_id', OLD.resource_id, 'period_start', lower(OLD.period), 'period_end', upper(OLD.period)
+        )::TEXT);
+    END IF;
+
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        PERFORM pg_notify('bookings', json_build_object(
+            'op', 'add', 'booking_id', NEW.booking_id, 'resource_type', NEW.resource_type,
+            'resource_id', NEW.resource_id, 'period_start', lower(NEW.period), 'period_end', upper(NEW.period)
+        )::TEXT);
+    END IF;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER notify_bookings_trigger
+AFTER INSERT OR UPDATE OR DELETE ON bookings
+FOR EACH ROW
+EXECUTE FUNCTION notify_bookings();
+
 /* Trigger to validate a hospitalization */
 CREATE OR REPLACE FUNCTION validate_hospitalization() RETURNS TRIGGER AS $$
 BEGIN
@@ -473,13 +557,36 @@ BEFORE INSERT ON hospitalizations
 FOR EACH ROW
 EXECUTE FUNCTION create_bill_before_hospitalization();
 
-/* Trigger to create a new bill before appointment */
+/* Creates one unpaid appointment bill per patient of "patient_ids" in one statement, returns (position, bill_id) pairs,
+ * position being the 1-based index of the patient in "patient_ids". The ids are drawn from the sequence before the insert
+ * so each one stays paired with its position */
+CREATE OR REPLACE FUNCTION create_appointment_bills(
+    patient_ids INTEGER[]
+)
+RETURNS TABLE (bill_position BIGINT, bill_id BIGINT) AS $$
+    WITH new_bills AS (
+        SELECT p.position, p.patient_id, nextval(pg_get_serial_sequence('bills', 'bill_id')) AS bill_id
+        FROM unnest(patient_ids) WITH ORDINALITY AS p(patient_id, position)
+    ),
+    inserted AS (
+        INSERT INTO bills (bill_id, total_payment, bill_status, patient_id)
+        SELECT nb.bill_id, 50.0, FALSE, nb.patient_id
+        FROM new_bills AS nb
+        RETURNING bills.bill_id
+    )
+    SELECT nb.position, nb.bill_id
+    FROM new_bills AS nb
+    JOIN inserted AS i ON i.bill_id = nb.bill_id
+    ORDER BY nb.position;
+$$ LANGUAGE sql;
+
+/* Trigger to create a new bill before appointment, unless the bill was created with create_appointment_bills */
 CREATE OR REPLACE FUNCTION create_bill_before_appointment()
 RETURNS TRIGGER AS $$
 BEGIN
-    INSERT INTO bills (total_payment, bill_status)
-    VALUES (50.0, FALSE)
-    RETURNING bill_id INTO NEW.bill_id;
+    IF NEW.bill_id IS NULL THEN
+        SELECT b.bill_id INTO NEW.bill_id FROM create_appointment_bills(ARRAY[NEW.patient_id]) AS b;
+    END IF;
     
     RETURN NEW;
 END;
@@ -490,6 +597,66 @@ BEFORE INSERT ON appointments
 FOR EACH ROW
 EXECUTE FUNCTION create_bill_before_appointment();
 
+/* Trigger to give the bill of a hospitalization to the patient of its first surgery, the bill is created before the surgery */
+CREATE OR REPLACE FUNCTION set_hospitalization_bill_patient()
+RETURNS TRIGGER AS $$
+BEGIN
+    UPDATE bills AS b
+    SET patient_id = NEW.patient_id
+    FROM hospitalizations AS h
+    WHERE h.hosp_id = NEW.hosp_id AND b.bill_id = h.bill_id AND b.patient_id IS NULL;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER hospitalization_bill_patient
+AFTER INSERT ON surgeries
+FOR EACH ROW
+EXECUTE FUNCTION set_hospitalization_bill_patient();
+
+/* Fill patient_id and amount_paid of the bills created before those columns existed: the patient of the appointment,
+ * or of the first surgery of the hospitalization, and the sum of the payments. Returns the number of bills updated */
+CREATE OR REPLACE FUNCTION backfill_bills()
+RETURNS INTEGER AS $$
+DECLARE
+    rows_written INTEGER;
+BEGIN
+    -- No payment or new bill can change the sums while they are recomputed
+    LOCK TABLE bills, payments IN SHARE MODE;
+
+    UPDATE bills AS b
+    SET patient_id = COALESCE(b.patient_id, owners.patient_id),
+        amount_paid = COALESCE(paid.amount_paid, 0),
+        bill_status = b.bill_status OR COALESCE(paid.amount_paid, 0) >= b.total_payment
+    FROM bills AS target
+    LEFT JOIN (
+        SELECT a.bill_id, a.patient_id
+        FROM appointments AS a
+
+        UNION ALL
+
+        (
+            SELECT DISTINCT ON (h.bill_id) h.bill_id, s.patient_id
+            FROM hospitalizations AS h
+            JOIN surgeries AS s ON s.hosp_id = h.hosp_id
+            ORDER BY h.bill_id, s.surgery_id
+        )
+    ) AS owners ON owners.bill_id = target.bill_id
+    LEFT JOIN (
+        SELECT py.bill_id, SUM(py.payment) AS amount_paid
+        FROM payments AS py
+        GROUP BY py.bill_id
+    ) AS paid ON paid.bill_id = target.bill_id
+    WHERE b.bill_id = target.bill_id
+        AND (b.patient_id IS DISTINCT FROM COALESCE(b.patient_id, owners.patient_id)
+             OR b.amount_paid IS DISTINCT FROM COALESCE(paid.amount_paid, 0));
+
+    GET DIAGNOSTICS rows_written = ROW_COUNT;
+    RETURN rows_written;
+END;
+$$ LANGUAGE plpgsql;
+
 /* Encrypts "input_text" with key "encrypt_key" */
 CREATE OR REPLACE FUNCTION encrypt(input_text VARCHAR, encrypt_key VARCHAR)
 RETURNS VARCHAR AS $$
@@ -513,6 +680,208 @@ END;
 $$
 LANGUAGE plpgsql;
 
+/* Trigger to keep the credentials table in sync with employees and patients (inserts, updates and deletes) */
+CREATE OR REPLACE FUNCTION sync_credentials()
+RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        DELETE FROM credentials
+        WHERE username = OLD.person_username AND person_id = OLD.person_id AND person_type = OLD.person_type;
+    END IF;
+
+    -- A deleted user has no credentials left to log in with
+    IF TG_OP = 'DELETE' THEN
+        RETURN NULL;
+    END IF;
+
+    BEGIN
+        INSERT INTO credentials (username, person_id, person_type, password_hash)
+        VALUES (NEW.person_username, NEW.person_id, NEW.person_type, NEW.person_password);
+    EXCEPTION
+        WHEN unique_violation THEN
+            RAISE EXCEPTION 'Person username must be unique';
+    END;
+
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER sync_employee_credentials
+AFTER INSERT OR UPDATE OF person_username, person_password, person_type OR DELETE ON employees
+FOR EACH ROW
+EXECUTE FUNCTION sync_credentials();
+
+CREATE TRIGGER sync_patient_credentials
+AFTER INSERT OR UPDATE OF person_username, person_password, person_type OR DELETE ON patients
+FOR EACH ROW
+EXECUTE FUNCTION sync_credentials();
+
+/* Fill the credentials of users created before the table existed. A username shared by two accounts (an employee and a
+ * patient, for example) is refused with the list of those usernames, they have to be renamed before running it again */
+CREATE OR REPLACE FUNCTION backfill_credentials()
+RETURNS INTEGER AS $$
+DECLARE
+    conflicts TEXT;
+    rows_written INTEGER;
+BEGIN
+    LOCK TABLE employees, patients IN SHARE MODE;
+
+    WITH accounts AS (
+        SELECT person_username AS username, person_id, person_type FROM employees
+        UNION ALL
+        SELECT person_username, person_id, person_type FROM patients
+        UNION ALL
+        SELECT username, person_id, person_type FROM credentials
+    )
+    SELECT string_agg(username, ', ' ORDER BY username) INTO conflicts
+    FROM (
+        SELECT username
+        FROM accounts
+        GROUP BY username
+        HAVING COUNT(DISTINCT (person_id, person_type)) > 1
+    ) AS shared;
+
+    IF conflicts IS NOT NULL THEN
+        RAISE EXCEPTION 'Usernames used by more than one account, rename them before filling the credentials: %', conflicts;
+    END IF;
+
+    INSERT INTO credentials (username, person_id, person_type, password_hash)
+        SELECT person_username, person_id, person_type, person_password FROM employees
+        UNION ALL
+        SELECT person_username, person_id, person_type, person_password FROM patients
+    ON CONFLICT (username) DO NOTHING;
+
+    GET DIAGNOSTICS rows_written = ROW_COUNT;
+    RETURN rows_written;
+END;
+$$ LANGUAGE plpgsql;
+
+SELECT backfill_credentials();
+
+/* Trigger to tell the API workers that a cached reference table changed (python/refdata.py) */
+CREATE OR REPLACE FUNCTION notify_reference_data()
+RETURNS TRIGGER AS $$
+BEGIN
+    PERFORM pg_notify('reference_data', TG_TABLE_NAME);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER notify_roles
+AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON roles
+FOR EACH STATEMENT
+EXECUTE FUNCTION notify_reference_data();
+
+CREATE TRIGGER notify_nurse_categories
+AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON nurse_categories
+FOR EACH STATEMENT
+EXECUTE FUNCTION notify_reference_data();
+
+CREATE TRIGGER notify_specialisations
+AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON specialisations
+FOR EACH STATEMENT
+EXECUTE FUNCTION notify_reference_data();
+
+CREATE TRIGGER notify_sub_specialisations
+AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON sub_specialisations
+FOR EACH STATEMENT
+EXECUTE FUNCTION notify_reference_data();
+
+CREATE TRIGGER notify_medicines
+AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON medicines
+FOR EACH STATEMENT
+EXECUTE FUNCTION notify_reference_data();
+
+CREATE TRIGGER notify_posologies
+AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON posologies
+FOR EACH STATEMENT
+EXECUTE FUNCTION notify_reference_data();
+
+/* Trigger to tell the API workers that the specialisations or the license of a doctor changed */
+CREATE OR REPLACE FUNCTION notify_doctor_capabilities()
+RETURNS TRIGGER AS $$
+DECLARE
+    doctor_row JSONB;
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        doctor_row := to_jsonb(OLD);
+    ELSE
+        doctor_row := to_jsonb(NEW);
+    END IF;
+
+    PERFORM pg_notify('doctor_capabilities', COALESCE(doctor_row->>'doctor_id', doctor_row->>'person_id'));
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER notify_doctors
+AFTER INSERT OR UPDATE OR DELETE ON doctors
+FOR EACH ROW
+EXECUTE FUNCTION notify_doctor_capabilities();
+
+CREATE TRIGGER notify_specialisations_doctors
+AFTER INSERT OR UPDATE OR DELETE ON specialisations_doctors
+FOR EACH ROW
+EXECUTE FUNCTION notify_doctor_capabilities();
+
+CREATE TRIGGER notify_sub_specialisations_doctors
+AFTER INSERT OR UPDATE OR DELETE ON sub_specialisations_doctors
+FOR EACH ROW
+EXECUTE FUNCTION notify_doctor_capabilities();
+
+/* Trigger to bump the change version of the patients whose appointments, surgeries or prescriptions changed,
+ * the version is the ETag of GET /dbproj/appointments and GET /dbproj/prescriptions */
+CREATE OR REPLACE FUNCTION bump_patient_version()
+RETURNS TRIGGER AS $$
+DECLARE
+    changed_rows JSONB[];
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        changed_rows := changed_rows || to_jsonb(OLD);
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        changed_rows := changed_rows || to_jsonb(NEW);
+    END IF;
+
+    INSERT INTO patient_versions (patient_id, version)
+    SELECT DISTINCT patient.patient_id, 1
+    FROM unnest(changed_rows) AS changed(row_data)
+    CROSS JOIN LATERAL (
+        -- Prescriptions of a hospitalization belong to the patients of its surgeries
+        SELECT (changed.row_data->>'patient_id')::INTEGER
+        WHERE changed.row_data ? 'patient_id'
+        UNION
+        SELECT s.patient_id
+        FROM surgeries AS s
+        WHERE TG_TABLE_NAME = 'hospitalizations_prescriptions' AND s.hosp_id = (changed.row_data->>'hosp_id')::BIGINT
+    ) AS patient(patient_id)
+    WHERE patient.patient_id IS NOT NULL
+    ON CONFLICT (patient_id) DO UPDATE SET version = patient_versions.version + 1;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER bump_patient_version_appointments
+AFTER INSERT OR UPDATE OR DELETE ON appointments
+FOR EACH ROW
+EXECUTE FUNCTION bump_patient_version();
+
+CREATE TRIGGER bump_patient_version_surgeries
+AFTER INSERT OR UPDATE OR DELETE ON surgeries
+FOR EACH ROW
+EXECUTE FUNCTION bump_patient_version();
+
+CREATE TRIGGER bump_patient_version_appointments_prescriptions
+AFTER INSERT OR UPDATE OR DELETE ON appointments_prescriptions
+FOR EACH ROW
+EXECUTE FUNCTION bump_patient_version();
+
+CREATE TRIGGER bump_patient_version_hospitalizations_prescriptions
+AFTER INSERT OR UPDATE OR DELETE ON hospitalizations_prescriptions
+FOR EACH ROW
+EXECUTE FUNCTION bump_patient_version();
+
 /* Trigger to validate an employee */
 CREATE OR REPLACE FUNCTION validate_employee_data()
 RETURNS TRIGGER AS $$
@@ -670,4 +1039,258 @@ $$ LANGUAGE plpgsql;
 CREATE TRIGGER medical_license
 BEFORE INSERT OR UPDATE ON doctors
 FOR EACH ROW
-EXECUTE FUNCTION validate_medical_license_data();
\ No newline at end of file
+EXECUTE FUNCTION validate_medical_license_data();
+/* Payments of the services (appointment or hospitalization) of each patient per month, recomputed from the payments
+ * made since from_month (every payment when NULL), the source of the revenue rollup tables */
+CREATE OR REPLACE FUNCTION revenue_services(from_month DATE)
+RETURNS TABLE (patient_id INTEGER, month DATE, service_type VARCHAR, service_id BIGINT, paid FLOAT) AS $$
+    SELECT a.patient_id, date_trunc('month', py.payment_date)::DATE, 'appointment'::VARCHAR, a.appointment_id, SUM(py.payment)
+    FROM payments py
+    JOIN appointments a ON a.bill_id = py.bill_id
+    WHERE from_month IS NULL OR py.payment_date >= from_month
+    GROUP BY 1, 2, 3, 4
+
+    UNION ALL
+
+    SELECT hs.patient_id, date_trunc('month', py.payment_date)::DATE, 'hospitalization'::VARCHAR, h.hosp_id, SUM(py.payment)
+    FROM payments py
+    JOIN hospitalizations h ON h.bill_id = py.bill_id
+    JOIN (SELECT DISTINCT s.hosp_id, s.patient_id FROM surgeries s) hs ON hs.hosp_id = h.hosp_id
+    WHERE from_month IS NULL OR py.payment_date >= from_month
+    GROUP BY 1, 2, 3, 4;
+$$ LANGUAGE sql STABLE;
+
+/* Add "amount" paid on "p_date" to the revenue of the services of the bill and of their patients */
+CREATE OR REPLACE FUNCTION add_bill_revenue(p_bill_id BIGINT, p_date DATE, amount FLOAT)
+RETURNS VOID AS $$
+    WITH bill_services AS (
+        SELECT a.patient_id, 'appointment' AS service_type, a.appointment_id AS service_id
+        FROM appointments a
+        WHERE a.bill_id = p_bill_id
+
+        UNION
+
+        SELECT s.patient_id, 'hospitalization' AS service_type, h.hosp_id AS service_id
+        FROM hospitalizations h
+        JOIN surgeries s ON s.hosp_id = h.hosp_id
+        WHERE h.bill_id = p_bill_id
+    ),
+    patient_revenue AS (
+        INSERT INTO revenue_monthly (patient_id, month, total_paid)
+        SELECT DISTINCT bs.patient_id, date_trunc('month', p_date)::DATE, amount
+        FROM bill_services bs
+        ON CONFLICT (patient_id, month) DO UPDATE SET total_paid = revenue_monthly.total_paid + EXCLUDED.total_paid
+    )
+    INSERT INTO revenue_monthly_services (patient_id, month, service_type, service_id, paid)
+    SELECT bs.patient_id, date_trunc('month', p_date)::DATE, bs.service_type, bs.service_id, amount
+    FROM bill_services bs
+    ON CONFLICT (patient_id, month, service_type, service_id) DO UPDATE SET paid = revenue_monthly_services.paid + EXCLUDED.paid;
+$$ LANGUAGE sql;
+
+/* Trigger to keep the revenue rollup current, in the transaction of the payment */
+CREATE OR REPLACE FUNCTION rollup_payment()
+RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        PERFORM add_bill_revenue(OLD.bill_id, OLD.payment_date, -OLD.payment);
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        PERFORM add_bill_revenue(NEW.bill_id, NEW.payment_date, NEW.payment);
+    END IF;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER rollup_payments
+AFTER INSERT OR UPDATE OR DELETE ON payments
+FOR EACH ROW
+EXECUTE FUNCTION rollup_payment();
+
+/* Rebuild the revenue rollup of the months since from_month (every month when NULL) from the payments,
+ * new payments wait until the rebuild commits. Returns the number of service rows written */
+CREATE OR REPLACE FUNCTION rebuild_revenue_rollup(from_month DATE)
+RETURNS INTEGER AS $$
+DECLARE
+    first_month DATE := date_trunc('month', from_month)::DATE;
+    rows_written INTEGER;
+BEGIN
+    LOCK TABLE payments IN SHARE MODE;
+
+    DELETE FROM revenue_monthly
+    WHERE first_month IS NULL OR month >= first_month;
+
+    INSERT INTO revenue_monthly (patient_id, month, total_paid)
+    SELECT rs.patient_id, rs.month, SUM(rs.paid)
+    FROM revenue_services(first_month) rs
+    GROUP BY rs.patient_id, rs.month;
+
+    INSERT INTO revenue_monthly_services (patient_id, month, service_type, service_id, paid)
+    SELECT rs.patient_id, rs.month, rs.service_type, rs.service_id, rs.paid
+    FROM revenue_services(first_month) rs;
+
+    GET DIAGNOSTICS rows_written = ROW_COUNT;
+    RETURN rows_written;
+END;
+$$ LANGUAGE plpgsql;
+
+/* Rows of the revenue rollup that differ from a full recomputation from the payments, NULL on the side where the row is missing */
+CREATE OR REPLACE FUNCTION check_revenue_rollup()
+RETURNS TABLE (patient_id INTEGER, month DATE, service_type VARCHAR, service_id BIGINT, rollup_paid FLOAT, expected_paid FLOAT) AS $$
+    SELECT COALESCE(r.patient_id, e.patient_id), COALESCE(r.month, e.month), COALESCE(r.service_type, e.service_type),
+           COALESCE(r.service_id, e.service_id), r.paid, e.paid
+    FROM revenue_monthly_services r
+    FULL JOIN revenue_services(NULL) e
+        ON e.patient_id = r.patient_id AND e.month = r.month AND e.service_type = r.service_type AND e.service_id = r.service_id
+    WHERE abs(COALESCE(r.paid, 0) - COALESCE(e.paid, 0)) > 0.005
+
+    UNION ALL
+
+    -- Patient totals that are not the sum of their services, service_type and service_id are NULL
+    SELECT m.patient_id, m.month, NULL, NULL, m.total_paid, COALESCE(SUM(r.paid), 0)
+    FROM revenue_monthly m
+    LEFT JOIN revenue_monthly_services r ON r.patient_id = m.patient_id AND r.month = m.month
+    GROUP BY m.patient_id, m.month, m.total_paid
+    HAVING abs(m.total_paid - COALESCE(SUM(r.paid), 0)) > 0.005
+    ORDER BY 2, 1, 3, 4;
+$$ LANGUAGE sql STABLE;
+
+/* Add to the statistics of a day, the row of the day is created by its first event */
+CREATE OR REPLACE FUNCTION add_daily_stats(p_date DATE, n_surgeries INTEGER, amount FLOAT, n_prescriptions INTEGER)
+RETURNS VOID AS $$
+    INSERT INTO daily_stats (stat_date, surgeries, amount_spent, prescriptions)
+    VALUES (p_date, n_surgeries, amount, n_prescriptions)
+    ON CONFLICT (stat_date) DO UPDATE SET
+        surgeries = daily_stats.surgeries + EXCLUDED.surgeries,
+        amount_spent = daily_stats.amount_spent + EXCLUDED.amount_spent,
+        prescriptions = daily_stats.prescriptions + EXCLUDED.prescriptions;
+$$ LANGUAGE sql;
+
+/* Trigger to keep daily_stats current, read by GET /dbproj/daily */
+CREATE OR REPLACE FUNCTION rollup_daily_stats()
+RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_TABLE_NAME = 'surgeries' THEN
+        IF TG_OP IN ('UPDATE', 'DELETE') THEN
+            PERFORM add_daily_stats(OLD.surgery_date, -1, 0, 0);
+        END IF;
+        IF TG_OP IN ('INSERT', 'UPDATE') THEN
+            PERFORM add_daily_stats(NEW.surgery_date, 1, 0, 0);
+        END IF;
+
+    ELSIF TG_TABLE_NAME = 'payments' THEN
+        IF TG_OP IN ('UPDATE', 'DELETE') THEN
+            PERFORM add_daily_stats(OLD.payment_date, 0, -OLD.payment, 0);
+        END IF;
+        IF TG_OP IN ('INSERT', 'UPDATE') THEN
+            PERFORM add_daily_stats(NEW.payment_date, 0, NEW.payment, 0);
+        END IF;
+
+    ELSIF TG_TABLE_NAME = 'prescriptions' THEN
+        IF TG_OP IN ('UPDATE', 'DELETE') THEN
+            PERFORM add_daily_stats(OLD.presc_date, 0, 0, -1);
+        END IF;
+        IF TG_OP IN ('INSERT', 'UPDATE') THEN
+            PERFORM add_daily_stats(NEW.presc_date, 0, 0, 1);
+        END IF;
+    END IF;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER daily_stats_surgeries
+AFTER INSERT OR DELETE OR UPDATE OF surgery_date ON surgeries
+FOR EACH ROW
+EXECUTE FUNCTION rollup_daily_stats();
+
+CREATE TRIGGER daily_stats_payments
+AFTER INSERT OR DELETE OR UPDATE OF payment, payment_date ON payments
+FOR EACH ROW
+EXECUTE FUNCTION rollup_daily_stats();
+
+CREATE TRIGGER daily_stats_prescriptions
+AFTER INSERT OR DELETE OR UPDATE OF presc_date ON prescriptions
+FOR EACH ROW
+EXECUTE FUNCTION rollup_daily_stats();
+
+/* Recompute daily_stats from the surgeries, payments and prescriptions, e.g. on a database that had them before the triggers */
+CREATE OR REPLACE FUNCTION rebuild_daily_stats()
+RETURNS INTEGER AS $$
+DECLARE
+    rows_written INTEGER;
+BEGIN
+    LOCK TABLE surgeries, payments, prescriptions IN SHARE MODE;
+
+    DELETE FROM daily_stats;
+
+    INSERT INTO daily_stats (stat_date, surgeries, amount_spent, prescriptions)
+    SELECT stat_date, SUM(surgeries), SUM(amount_spent), SUM(prescriptions)
+    FROM (
+        SELECT surgery_date AS stat_date, COUNT(*) AS surgeries, 0 AS amount_spent, 0 AS prescriptions
+        FROM surgeries
+        GROUP BY surgery_date
+
+        UNION ALL
+
+        SELECT payment_date, 0, SUM(payment), 0
+        FROM payments
+        GROUP BY payment_date
+
+        UNION ALL
+
+        SELECT presc_date, 0, 0, COUNT(*)
+        FROM prescriptions
+        GROUP BY presc_date
+    ) AS day_events
+    GROUP BY stat_date;
+
+    GET DIAGNOSTICS rows_written = ROW_COUNT;
+    RETURN rows_written;
+END;
+$$ LANGUAGE plpgsql;
+
+/* Trigger to keep surgery_counts_monthly current, read by GET /dbproj/report */
+CREATE OR REPLACE FUNCTION count_doctor_surgeries()
+RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        UPDATE surgery_counts_monthly
+        SET num_surgeries = num_surgeries - 1
+        WHERE doctor_id = OLD.doctor_id AND month = date_trunc('month', OLD.surgery_date)::DATE;
+    END IF;
+
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        INSERT INTO surgery_counts_monthly (doctor_id, month, num_surgeries)
+        VALUES (NEW.doctor_id, date_trunc('month', NEW.surgery_date)::DATE, 1)
+        ON CONFLICT (doctor_id, month) DO UPDATE SET num_surgeries = surgery_counts_monthly.num_surgeries + 1;
+    END IF;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER surgery_counts_surgeries
+AFTER INSERT OR DELETE OR UPDATE OF doctor_id, surgery_date ON surgeries
+FOR EACH ROW
+EXECUTE FUNCTION count_doctor_surgeries();
+
+/* Recompute surgery_counts_monthly from the surgeries, e.g. on a database that had them before the trigger */
+CREATE OR REPLACE FUNCTION rebuild_surgery_counts()
+RETURNS INTEGER AS $$
+DECLARE
+    rows_written INTEGER;
+BEGIN
+    LOCK TABLE surgeries IN SHARE MODE;
+
+    DELETE FROM surgery_counts_monthly;
+
+    INSERT INTO surgery_counts_monthly (doctor_id, month, num_surgeries)
+    SELECT doctor_id, date_trunc('month', surgery_date)::DATE, COUNT(*)
+    FROM surgeries
+    GROUP BY 1, 2;
+
+    GET DIAGNOSTICS rows_written = ROW_COUNT;
+    RETURN rows_written;
+END;
+$$ LANGUAGE plpgsql;
@@ -105,25 +105,25 @@ VALUES
 */
 INSERT INTO doctors (ml_id, ml_issue_date, ml_expiration_date, person_id)
 VALUES
-    (DEFAULT, '2023-01-15', '2025-01-15', 
+    (DEFAULT, '2023-01-15', '2035-01-15', 
         (SELECT person_id FROM employees WHERE person_name = 'Carlos Mendes')),
-    (DEFAULT, '2022-06-10', '2024-06-10', 
+    (DEFAULT, '2022-06-10', '2034-06-10', 
         (SELECT person_id FROM employees WHERE person_name = 'Ana Silva')),
-    (DEFAULT, '2023-03-20', '2025-03-20', 
+    (DEFAULT, '2023-03-20', '2035-03-20', 
         (SELECT person_id FROM employees WHERE person_name = 'Ricardo Oliveira')),
-    (DEFAULT, '2022-08-05', '2024-08-05', 
+    (DEFAULT, '2022-08-05', '2034-08-05', 
         (SELECT person_id FROM employees WHERE person_name = 'Marta Santos')),
-    (DEFAULT, '2023-02-28', '2025-02-28', 
+    (DEFAULT, '2023-02-28', '2035-02-28', 
         (SELECT person_id FROM employees WHERE person_name = 'José Ferreira')),
-    (DEFAULT, '2022-12-10', '2024-12-10', 
+    (DEFAULT, '2022-12-10', '2034-12-10', 
         (SELECT person_id FROM employees WHERE person_name = 'Sofia Almeida')),
-    (DEFAULT, '2023-04-25', '2025-04-25', 
+    (DEFAULT, '2023-04-25', '2035-04-25', 
         (SELECT person_id FROM employees WHERE person_name = 'Tiago Martins')),
-    (DEFAULT, '2022-11-15', '2024-11-15', 
+    (DEFAULT, '2022-11-15', '2034-11-15', 
         (SELECT person_id FROM employees WHERE person_name = 'Manuel Pereira')),
-	(DEFAULT, '2023-01-15', '2025-01-15', 
+	(DEFAULT, '2023-01-15', '2035-01-15', 
         (SELECT person_id FROM employees WHERE person_name = 'Carlos Meneses')),
-    (DEFAULT, '2022-06-10', '2024-06-10', 
+    (DEFAULT, '2022-06-10', '2034-06-10', 
         (SELECT person_id FROM employees WHERE person_name = 'Ana Carla'));
 
 /*
@@ -184,11 +184,11 @@ VALUES ((SELECT person_id FROM employees WHERE person_name = 'Rodrigo Rodrigues'
 INSERT INTO patients (person_cc, person_name, person_address, person_phone, person_username, person_password, person_email, person_type)
 VALUES
     (12445789, 'João Silva', 'Viana do Castelo', '111232333', 'joao', encrypt('senha1323', 'my_secret_key'), 'joao@email.com', 1),
-    (98764321, 'Ana Sousa', 'Leiria', '444555666', 'ana', encrypt('senha456', 'my_secret_key'), 'ana@email.com', 1),
-    (45689123, 'Carlos Santos', 'Lisboa', '777888999', 'carlos', encrypt('senha789', 'my_secret_key'), 'carlos@email.com', 1),
-    (78123456, 'Marta Ferreira', 'Santarem', '101112131', 'marta', encrypt('senha1011', 'my_secret_key'), 'marta@email.com', 1),
+    (98764321, 'Ana Sousa', 'Leiria', '444555666', 'anasousa', encrypt('senha456', 'my_secret_key'), 'ana@email.com', 1),
+    (45689123, 'Carlos Santos', 'Lisboa', '777888999', 'carlossantos', encrypt('senha789', 'my_secret_key'), 'carlos@email.com', 1),
+    (78123456, 'Marta Ferreira', 'Santarem', '101112131', 'martaferreira', encrypt('senha1011', 'my_secret_key'), 'marta@email.com', 1),
     (24567891, 'Pedro Almeida', 'Viseu', '314151617', 'pedromaria', encrypt('senha1213', 'my_secret_key'), 'pedromaria@email.com', 1),
-    (78912345, 'Sofia Costa', 'Aveiro', '181920212', 'sofia', encrypt('senha1415', 'my_secret_key'), 'sofia@email.com', 1),
+    (78912345, 'Sofia Costa', 'Aveiro', '181920212', 'sofiacosta', encrypt('senha1415', 'my_secret_key'), 'sofia@email.com', 1),
     (45638912, 'Rita Oliveira', 'Coimbra', '222324252', 'rita', encrypt('senha1617', 'my_secret_key'), 'rita@email.com', 1),
     (91234567, 'Hugo Martins', 'Beja', '262728293', 'hugo', encrypt('senha1819', 'my_secret_key'), 'hugo@email.com', 1);
 /*
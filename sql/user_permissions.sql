@@ -43,9 +43,20 @@ GRANT SELECT, INSERT, UPDATE ON sub_specialisations_doctors TO hospital_user;
 GRANT SELECT, INSERT, UPDATE ON posologies TO hospital_user;
 GRANT SELECT, INSERT, UPDATE ON posologies_medicines TO hospital_user;
 GRANT SELECT, INSERT, UPDATE ON posologies_prescriptions TO hospital_user;
+GRANT SELECT, INSERT, DELETE ON revoked_tokens TO hospital_user;
+GRANT SELECT, INSERT, DELETE ON credentials TO hospital_user;
+GRANT SELECT, INSERT, UPDATE, DELETE ON bookings TO hospital_user;
+GRANT SELECT, INSERT, UPDATE ON appointment_series TO hospital_user;
+GRANT SELECT, INSERT, UPDATE ON patient_versions TO hospital_user;
+GRANT SELECT, INSERT, UPDATE, DELETE ON revenue_monthly TO hospital_user;
+GRANT SELECT, INSERT, UPDATE, DELETE ON revenue_monthly_services TO hospital_user;
+GRANT SELECT, INSERT, UPDATE, DELETE ON daily_stats TO hospital_user;
+GRANT SELECT, INSERT, UPDATE, DELETE ON surgery_counts_monthly TO hospital_user;
 
 
 GRANT USAGE, SELECT, UPDATE ON SEQUENCE appointments_appointment_id_seq TO hospital_user;
+GRANT USAGE, SELECT, UPDATE ON SEQUENCE appointment_series_series_id_seq TO hospital_user;
+GRANT USAGE, SELECT, UPDATE ON SEQUENCE bookings_booking_id_seq TO hospital_user;
 GRANT USAGE, SELECT, UPDATE ON SEQUENCE bills_bill_id_seq TO hospital_user;
 GRANT USAGE, SELECT, UPDATE ON SEQUENCE contract_types_ctype_id_seq TO hospital_user;
 GRANT USAGE, SELECT, UPDATE ON SEQUENCE doctors_ml_id_seq TO hospital_user;